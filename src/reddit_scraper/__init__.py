@@ -1,11 +1,8 @@
 import logging
-from importlib.metadata import version
 from pathlib import Path
 from typing import Literal
 from platformdirs import PlatformDirs
 
-__version__ = version("reddit-scraper")
-
 logger = logging.getLogger(__name__)
 
 SORT_TYPE = Literal[
@@ -22,6 +19,24 @@ SORT_TYPE = Literal[
     "controversial-day",
     "controversial-hour",
 ]
+DEDUP_TYPE = Literal["memory", "compact", "lazy"]
+BACKEND_TYPE = Literal["sync", "async"]
+DB_PROFILE = Literal["default", "bulk-ingest"]
+EXPORT_FORMAT = Literal["ndjson", "parquet", "arrow"]
+EXPORT_TABLE = Literal["posts", "comments"]
+MEASUREMENT = Literal["write", "seen", "search", "export", "migrate"]
 DEFAULT_UA = "Scrapes reddit for SQL by Username0103. Programmed in Python, uses PRAW."
+# opened relative to the working directory unless --db says otherwise
+DB_PATH = Path("reddit-scraper.db")
 DATA_DIR = Path(PlatformDirs("reddit-scraper", "Username0103").user_data_dir)
 CREDS_CACHE = DATA_DIR / "data.pkl"
+
+
+def __getattr__(name: str) -> str:
+    # importlib.metadata alone takes longer to import than the rest of the
+    # package, so the version is only looked up when someone asks for it
+    if name == "__version__":
+        from importlib.metadata import version
+
+        return version("reddit-scraper")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,329 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager, suppress
+import inspect
+import sys
+import threading
+from typing import TYPE_CHECKING, Any, AsyncIterator, Generator
+
+import asyncpraw
+from asyncpraw.models import MoreComments
+from asyncprawcore import Forbidden, NotFound, Redirect, Requestor
+
+from reddit_scraper import logger
+from .database import claimed_elsewhere
+from .expand import expansion, serialize_stubs
+from .get_posts import (
+    DRAIN_POLL,
+    QUEUE_AHEAD,
+    FoundPost,
+    ListingScan,
+    RedditData,
+    WorkFeed,
+    format_comments,
+    get_post_data,
+    post_id,
+    refreshed_posts,
+)
+from .metrics import METRICS
+from .records import CommentRecord
+from .ratelimit import MAX_429_RETRIES, TokenBucket
+from .seen import SeenSet, make_seen_set
+
+if TYPE_CHECKING:
+    from .database import WorkItem
+    from .get_credentials import RedditCredentials
+    from .jobs import Job
+    from .main import Options
+
+# the same pipeline as get_posts on asyncpraw, so listings of every job and
+# -w posts at a time are fetched concurrently on one event loop. finished
+# posts are handed over to the same DBWriter as the sync backend's.
+# the database is only touched for short reads and claims, which block the
+# loop for a moment, but not long enough to be worth a thread of their own
+
+
+# asyncprawcore 3 made Requestor.request an async context manager, before it
+# was a coroutine returning the response. asyncpraw 7.8 still comes with 2
+CONTEXT_REQUESTS = not inspect.iscoroutinefunction(Requestor.request)
+
+
+class AsyncRateLimitedRequestor(Requestor):
+    # asyncprawcore only spaces out requests one after the other. coroutines
+    # sending at the same time all have to wait on the shared bucket instead
+    def __init__(self, *args: Any, bucket: TokenBucket, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.bucket = bucket
+
+    def request(self, *args: Any, **kwargs: Any) -> Any:
+        if CONTEXT_REQUESTS:
+            return self.entered_request(*args, **kwargs)
+        return self.awaited_request(*args, **kwargs)
+
+    @asynccontextmanager
+    async def entered_request(self, *args: Any, **kwargs: Any) -> AsyncIterator[Any]:
+        for attempt in range(1, MAX_429_RETRIES + 1):
+            await self.bucket.acquire_async()
+            async with super().request(*args, **kwargs) as response:
+                retry = self.bucket.record(response.status, response.headers)
+                if not retry or attempt == MAX_429_RETRIES:
+                    yield response
+                    return
+
+    async def awaited_request(self, *args: Any, **kwargs: Any) -> Any:
+        for attempt in range(1, MAX_429_RETRIES + 1):
+            await self.bucket.acquire_async()
+            # typed after the asyncprawcore installed, which may be 3 or later
+            response = await super().request(*args, **kwargs)  # type: ignore[misc]
+            retry = self.bucket.record(response.status, response.headers)
+            if not retry or attempt == MAX_429_RETRIES:
+                return response
+            response.release()
+
+
+def create_instance(
+    creds: RedditCredentials,
+    session: Any = None,
+    rate_share: float = 1.0,
+    **config: Any,
+) -> asyncpraw.Reddit:
+    # session replaces the aiohttp.ClientSession, e.g. with AsyncFakeReddit
+    return asyncpraw.Reddit(
+        client_id=creds.client_id,
+        client_secret=creds.api_key,
+        user_agent=creds.user_agent,
+        requestor_class=AsyncRateLimitedRequestor,
+        requestor_kwargs={
+            "bucket": TokenBucket(share=rate_share),
+            "session": session,
+        },
+        **config,
+    )
+
+
+async def make_sort(api: asyncpraw.Reddit, job: Job) -> AsyncIterator[Any]:
+    sort = job.sort_type
+    sub = await api.subreddit(job.subreddit)
+    sort_time = sort.rsplit("-", maxsplit=1)[-1]
+    sort_name = sort.split("-", maxsplit=1)[0]
+    if sort_name in {"top", "controversial"}:
+        posts = getattr(sub, sort_name)(time_filter=sort_time, limit=None)
+    else:
+        posts = getattr(sub, sort_name)(limit=None)
+    async for post in posts:
+        yield post
+
+
+async def expand_more(
+    items: Any, options: Options
+) -> tuple[list[Any], list[MoreComments]]:
+    steps = expansion(items, options, MoreComments)
+    try:
+        stub = next(steps)
+        while True:
+            stub = steps.send(await stub.comments())
+    except StopIteration as done:
+        return done.value
+
+
+async def get_comment_data(
+    post: Any, options: Options
+) -> tuple[list[CommentRecord], list[dict[str, Any]]]:
+    with METRICS.timer("expand"):
+        comments_list, stubs = await expand_more(post.comments, options)
+    with METRICS.timer("serialize"):
+        return (
+            format_comments(comments_list, post.name),
+            serialize_stubs(stubs, post.name),
+        )
+
+
+async def fetch_post(found: FoundPost, options: Options) -> RedditData:
+    post = found.post
+    # posts from a listing already carry everything but their comments,
+    # asyncpraw never loads anything behind our back
+    if not options.skip_comments or found.resumed:
+        await post.load()
+    comment_data: list[CommentRecord] | None = None
+    stubs: list[dict[str, Any]] | None = None
+    if not options.skip_comments:
+        comment_data, stubs = await get_comment_data(post, options)
+    with METRICS.timer("serialize"):
+        post_data = get_post_data(post)
+    return RedditData(post_data, comment_data, found.job, stubs)
+
+
+async def find_posts(
+    api: asyncpraw.Reddit,
+    job: Job,
+    options: Options,
+    seen: SeenSet,
+    found_posts: asyncio.Queue[FoundPost | None],
+) -> None:
+    refreshes: list[tuple[int, Any]] = []
+    scan = ListingScan(job, options, seen, refreshes)
+    try:
+        async for post in METRICS.timed_async("listing", make_sort(api, job)):
+            found = scan.visit(post)
+            if scan.done:
+                break
+            if found:
+                await found_posts.put(found)
+        else:
+            scan.finish()
+    except Redirect:
+        logger.error(f"Invalid subreddit r/{job.subreddit}. Check if it's not privated")
+    except NotFound:
+        # one subreddit gone missing doesn't stop the other jobs
+        logger.error(f"r/{job.subreddit} doesn't exist or was banned. Skipping it.")
+    except Forbidden:
+        logger.error(f"r/{job.subreddit} is private or quarantined. Skipping it.")
+    for found in refreshed_posts(job, refreshes):
+        await found_posts.put(found)
+    # tells feed_posts this listing is done
+    await found_posts.put(None)
+
+
+async def feed_posts(
+    api: asyncpraw.Reddit,
+    options: Options,
+    feed: WorkFeed,
+    found_posts: asyncio.Queue[FoundPost | None],
+    listings: int,
+    work: asyncio.Queue[FoundPost | None],
+) -> None:
+    # queued_posts, with the listings running as tasks of their own
+    async def hand_out(items: list[WorkItem]) -> None:
+        for item in items:
+            found = feed.found(item)
+            if found is None:
+                post = await api.submission(post_id(item.name), fetch=False)
+                found = feed.resume(item, post)
+            await work.put(found)
+
+    # whatever an earlier run left behind is fetched before any listing
+    while items := feed.claim():
+        await hand_out(items)
+    while True:
+        new: list[FoundPost] = []
+        if listings and (wanted := feed.wanted()):
+            # waits for the first post, then takes whatever else is ready
+            while listings and len(new) < wanted:
+                if new and found_posts.empty():
+                    break
+                found = await found_posts.get()
+                if found is None:
+                    listings -= 1
+                else:
+                    new.append(found)
+        items = feed.claim(new)
+        await hand_out(items)
+        if items or listings:
+            continue
+        if options.drain_only and claimed_elsewhere():
+            # another process may still be walking its listings
+            await asyncio.sleep(DRAIN_POLL)
+            continue
+        break
+    for _ in range(options.workers):
+        await work.put(None)
+
+
+async def fetch_posts(
+    options: Options,
+    work: asyncio.Queue[FoundPost | None],
+    results: asyncio.Queue[RedditData | BaseException | None],
+) -> None:
+    while (found := await work.get()) is not None:
+        await results.put(await fetch_post(found, options))
+
+
+async def scrape(
+    creds: RedditCredentials,
+    options: Options,
+    results: asyncio.Queue[RedditData | BaseException | None],
+    session: Any,
+    rate_share: float,
+    config: dict[str, Any],
+) -> None:
+    async with create_instance(creds, session, rate_share, **config) as api:
+        seen = make_seen_set(options.dedup)
+        feed = WorkFeed(options, seen)
+        jobs = [] if options.drain_only else list(options.jobs)
+        found_posts: asyncio.Queue[FoundPost | None] = asyncio.Queue(QUEUE_AHEAD)
+        work: asyncio.Queue[FoundPost | None] = asyncio.Queue(feed.claim_size)
+        tasks = [
+            *(find_posts(api, job, options, seen, found_posts) for job in jobs),
+            feed_posts(api, options, feed, found_posts, len(jobs), work),
+            *(fetch_posts(options, work, results) for _ in range(options.workers)),
+        ]
+        running = [asyncio.ensure_future(task) for task in tasks]
+        try:
+            await asyncio.gather(*running)
+        finally:
+            for task in running:
+                task.cancel()
+
+
+def get_posts(
+    creds: RedditCredentials,
+    options: Options,
+    session: Any = None,
+    rate_share: float = 1.0,
+    **config: Any,
+) -> Generator[RedditData, None, None]:
+    # the event loop runs in a thread of its own, so main.scrape and the
+    # writer see the same plain iterator of posts as with the sync backend
+    loop = asyncio.new_event_loop()
+    results: asyncio.Queue[RedditData | BaseException | None] = asyncio.Queue(
+        options.workers * 2
+    )
+
+    async def run() -> None:
+        try:
+            await scrape(creds, options, results, session, rate_share, config)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            await results.put(e)
+        else:
+            await results.put(None)
+
+    async def start() -> asyncio.Task[None]:
+        return asyncio.ensure_future(run())
+
+    async def stop(task: asyncio.Task[None]) -> None:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+        await loop.shutdown_asyncgens()
+
+    thread = threading.Thread(target=loop.run_forever, name="rdscp-async")
+    thread.start()
+    task = asyncio.run_coroutine_threadsafe(start(), loop).result()
+    try:
+        while True:
+            data = asyncio.run_coroutine_threadsafe(results.get(), loop).result()
+            if data is None:
+                break
+            if isinstance(data, Forbidden):
+                logger.error(
+                    "Recieved 403 forbidden response. Double check your API key and"
+                    " create a new reddit application if nothing else works. "
+                    "Make sure to select the script type of application."
+                )
+                sys.exit(1)
+            if isinstance(data, BaseException):
+                raise data
+            if data.job is not None:
+                data.job.posts += 1
+                data.job.comments += len(data.comments or [])
+            yield data
+    finally:
+        # stopped early, by ctrl-c or an error, the tasks still running are
+        # cancelled and the session closed before the loop goes away
+        asyncio.run_coroutine_threadsafe(stop(task), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
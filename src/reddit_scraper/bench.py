@@ -0,0 +1,693 @@
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field, replace
+from itertools import product
+import json
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import TYPE_CHECKING, Any, Generator, get_args
+
+from reddit_scraper import (
+    BACKEND_TYPE,
+    DB_PATH,
+    DB_PROFILE,
+    DEFAULT_UA,
+    MEASUREMENT,
+    logger,
+)
+from . import main
+from .dbconfig import PROFILES
+from .fake_reddit import START_UTC, AsyncFakeReddit, FakeConfig, FakeReddit, to_base36
+from .get_credentials import RedditCredentials
+from .jobs import make_jobs
+
+if TYPE_CHECKING:
+    from .get_posts import RedditData
+    from .records import CommentRecord, PostRecord
+
+
+@dataclass
+class BenchScenario:
+    subreddits: int
+    posts: int
+    fake: FakeConfig = field(default_factory=FakeConfig)
+    workers: int = 1
+    skip_comments: bool = False
+
+
+SCENARIOS = {
+    "baseline": BenchScenario(2, 100),
+    "deep": BenchScenario(
+        1, 20, FakeConfig(comments=1000, depth=10, inline=100), workers=4
+    ),
+    "skip-comments": BenchScenario(4, 1000, skip_comments=True),
+    "throttled": BenchScenario(
+        2, 50, FakeConfig(latency=0.02, error_rate=0.05), workers=4
+    ),
+}
+
+# commands that have no use for praw or peewee, so they must start without them
+LIGHT_COMMANDS = [
+    ["--help"],
+    ["--version"],
+    ["search", "--help"],
+    ["export", "--help"],
+    ["merge", "--help"],
+    ["import", "--help"],
+    ["bench", "--help"],
+]
+HEAVY_PACKAGES = {
+    "praw",
+    "prawcore",
+    "asyncpraw",
+    "asyncprawcore",
+    "aiohttp",
+    "peewee",
+    "playhouse",
+    "requests",
+    "pyarrow",
+    "zstandard",
+}
+# the standard library the commands can't start without, timed in the same run.
+# they may take this many times as long, however fast the machine is
+BASELINE_MODULES = [
+    "argparse",
+    "dataclasses",
+    "datetime",
+    "importlib.metadata",
+    "logging",
+    "pathlib",
+    "typing",
+]
+IMPORT_BUDGET_FACTOR = 3.0
+IMPORT_RUNS = 3
+# comments on the thread traced by --tracemalloc
+TRACED_COMMENTS = 10_000
+# posts, and comments on each, written by --ingest
+INGEST_POSTS = 2000
+INGEST_COMMENTS = 50
+
+
+@dataclass
+class BenchOptions:
+    loglevel: int | None
+    scenarios: list[str]
+    workers: int | None
+    backends: list[BACKEND_TYPE]
+    profiles: list[DB_PROFILE] | None
+    posts: int | None
+    comments: int | None
+    latency: float | None
+    error_rate: float | None
+    out: Path | None
+    importtime: bool
+    budget: float | None
+    tracemalloc: bool
+    ingest: bool
+    import_dump: bool
+    measure: list[MEASUREMENT]
+
+
+@dataclass
+class BenchResult:
+    scenario: str
+    backend: BACKEND_TYPE
+    profile: DB_PROFILE
+    seconds: float
+    posts: int
+    comments: int
+    requests: int
+    throttled: int
+    peak_rss_mb: float | None
+
+    def __str__(self) -> str:
+        rss = f"{self.peak_rss_mb:.1f} MB" if self.peak_rss_mb is not None else "n/a"
+        return (
+            f"{self.scenario} ({self.backend}, {self.profile}): {self.posts} posts,"
+            f" {self.comments} comments in {self.seconds:.2f}s |"
+            f" {self.posts / self.seconds:.1f} posts/s,"
+            f" {self.comments / self.seconds:.0f} comments/s,"
+            f" {self.requests / max(self.posts, 1):.2f} requests/post,"
+            f" {self.throttled} 429s, peak RSS {rss}"
+        )
+
+
+@dataclass
+class IngestResult:
+    profile: DB_PROFILE
+    seconds: float
+    posts: int
+    comments: int
+    peak_wal_mb: float
+    database_mb: float
+    again_seconds: float
+    again_wal_mb: float
+
+    def __str__(self) -> str:
+        return (
+            f"ingest ({self.profile}): {self.posts} posts, {self.comments} comments"
+            f" in {self.seconds:.2f}s | {self.posts / self.seconds:.1f} posts/s,"
+            f" {self.comments / self.seconds:.0f} comments/s,"
+            f" peak WAL {self.peak_wal_mb:.1f} MB, database {self.database_mb:.1f} MB"
+            f" | written again unchanged in {self.again_seconds:.2f}s,"
+            f" {self.again_wal_mb:.1f} MB of WAL"
+        )
+
+
+@dataclass
+class ImportResult:
+    profile: DB_PROFILE
+    workers: int
+    records: int
+    dump_mb: float
+    seconds: float
+    again_seconds: float
+
+    def __str__(self) -> str:
+        return (
+            f"import ({self.profile}, {self.workers} workers): {self.records} records"
+            f" from {self.dump_mb:.1f} MB of zstd in {self.seconds:.2f}s"
+            f" | {self.records / self.seconds:.0f} records/s,"
+            f" imported again in {self.again_seconds:.2f}s with every row stored"
+        )
+
+
+def peak_rss_mb() -> float | None:
+    try:
+        import resource
+    except ImportError:
+        # not available on windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def apply_overrides(scenario: BenchScenario, options: BenchOptions) -> BenchScenario:
+    fake = scenario.fake
+    if options.comments is not None:
+        fake = replace(fake, comments=options.comments)
+    if options.latency is not None:
+        fake = replace(fake, latency=options.latency)
+    if options.error_rate is not None:
+        fake = replace(fake, error_rate=options.error_rate)
+    return replace(
+        scenario,
+        fake=fake,
+        posts=options.posts if options.posts is not None else scenario.posts,
+        workers=options.workers if options.workers is not None else scenario.workers,
+    )
+
+
+def scenario_options(
+    scenario: BenchScenario,
+    backend: BACKEND_TYPE,
+    loglevel: int,
+    creds: RedditCredentials,
+    profile: DB_PROFILE = "default",
+) -> main.Options:
+    return main.Options(
+        loglevel=loglevel,
+        jobs=make_jobs(
+            [f"bench{i}" for i in range(scenario.subreddits)], ["new"], scenario.posts
+        ),
+        to_clear=False,
+        skip_comments=scenario.skip_comments,
+        dedup="memory",
+        workers=scenario.workers,
+        incremental=False,
+        refresh=False,
+        more_requests=None,
+        more_seconds=None,
+        max_depth=None,
+        fill_stubs=False,
+        drain_only=False,
+        backend=backend,
+        db=DB_PATH,
+        shards=1,
+        db_config=PROFILES[profile],
+        stats_interval=None,
+        stats_file=None,
+        metrics_port=None,
+        creds=creds,
+    )
+
+
+def fake_posts(
+    fake: FakeReddit, options: main.Options
+) -> Generator[RedditData, None, None]:
+    # what main.scrape is handed when scraping the fake api with either backend
+    if options.backend == "async":
+        from .async_posts import get_posts
+
+        return get_posts(
+            options.creds,
+            options,
+            session=AsyncFakeReddit(fake),
+            check_for_updates=False,
+        )
+    from .get_posts import create_instance
+
+    api = create_instance(options.creds, session=fake, check_for_updates=False)
+    return main.sync_posts(api, options)
+
+
+def run_scenario(
+    name: str,
+    scenario: BenchScenario,
+    backend: BACKEND_TYPE,
+    profile: DB_PROFILE,
+    loglevel: int,
+) -> BenchResult:
+    # runs in a fresh process, so peak RSS belongs to this scenario alone
+    logging.basicConfig(
+        level=loglevel, stream=sys.stdout, format="%(levelname)s: %(message)s"
+    )
+    logging.getLogger("peewee").setLevel(logging.INFO)
+    fake = FakeReddit(scenario.fake)
+    creds = RedditCredentials("bench", "bench", DEFAULT_UA)
+    options = scenario_options(scenario, backend, loglevel, creds, profile)
+    posts = fake_posts(fake, options)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="rdscp-bench-") as tmp:
+        # the database is always opened relative to the working directory
+        os.chdir(tmp)
+        try:
+            start = time.perf_counter()
+            main.scrape(posts, options)
+            seconds = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    return BenchResult(
+        scenario=name,
+        backend=backend,
+        profile=profile,
+        seconds=seconds,
+        posts=sum(job.posts for job in options.jobs),
+        comments=sum(job.comments for job in options.jobs),
+        requests=sum(count for kind, count in fake.requests.items() if kind != "token"),
+        throttled=fake.throttled,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+def ingest_data(posts: int, comments: int) -> list[RedditData]:
+    from .get_posts import RedditData
+    from .records import CommentRecord, PostRecord
+
+    batch = []
+    for number in range(posts):
+        post_name = f"t3_{to_base36(number)}"
+        subreddit = f"bench{number % 4}"
+        batch.append(
+            RedditData(
+                PostRecord(
+                    name=post_name,
+                    author=f"author{number % 100}",
+                    created_utc=START_UTC - number * 60,
+                    distinguished=None,
+                    edited=False,
+                    score=number % 500,
+                    subreddit=subreddit,
+                    locked=False,
+                    num_comments=comments,
+                    over_18=False,
+                    selftext=f"synthetic post {number} " * 8,
+                    is_textual=True,
+                    spoiler=False,
+                    title=f"Synthetic post {number}",
+                    img_link_or_permalink=f"https://www.reddit.com/{post_name}/",
+                    upvote_ratio=0.9,
+                ),
+                [
+                    CommentRecord(
+                        name=f"t1_{to_base36(number * comments + index)}",
+                        author=f"author{index % 100}",
+                        created_utc=START_UTC - number * 60 + index,
+                        distinguished=None,
+                        edited=False,
+                        score=index,
+                        subreddit=subreddit,
+                        post=post_name,
+                        parent_id=post_name,
+                        body=f"synthetic comment {index} on post {number} " * 4,
+                        saved=False,
+                        stickied=False,
+                        depth=0,
+                    )
+                    for index in range(comments)
+                ],
+                stubs=[],
+            )
+        )
+    return batch
+
+
+def run_ingest(profile: DB_PROFILE, posts: int, comments: int) -> IngestResult:
+    # runs in a fresh process. synthetic records go straight into the writer,
+    # so only the database side is measured, from opening it to the indexes
+    # and checkpoint at the end. then the same records are written once more,
+    # like a re-scrape finding nothing changed
+    from .database import DB, checkpoint_wal, finish_ingest, start_ingest
+    from .migrations import setup_db
+    from .writer import DBWriter
+
+    config = PROFILES[profile]
+    batch = ingest_data(posts, comments)
+    with tempfile.TemporaryDirectory(prefix="rdscp-bench-") as tmp:
+        path = Path(tmp) / DB_PATH
+        wal = path.with_name(f"{path.name}-wal")
+        peak_wal = 0
+        done = threading.Event()
+
+        def watch_wal() -> None:
+            nonlocal peak_wal
+            while not done.wait(0.01):
+                if wal.exists():
+                    peak_wal = max(peak_wal, wal.stat().st_size)
+
+        watcher = threading.Thread(target=watch_wal, daemon=True)
+        watcher.start()
+
+        def write() -> None:
+            writer = DBWriter(config.checkpoint_interval, config.score_history)
+            writer.start()
+            for data in batch:
+                writer.put(data)
+            writer.close()
+
+        start = time.perf_counter()
+        setup_db(path, config)
+        start_ingest(config)
+        write()
+        finish_ingest(config)
+        seconds = time.perf_counter() - start
+        done.set()
+        watcher.join()
+        # what is still in the WAL belongs to the database as much as the rest
+        checkpoint_wal()
+        database = path.stat().st_size
+        start = time.perf_counter()
+        write()
+        again_seconds = time.perf_counter() - start
+        again_wal = wal.stat().st_size if wal.exists() else 0
+        DB.close()
+    return IngestResult(
+        profile=profile,
+        seconds=seconds,
+        posts=posts,
+        comments=posts * comments,
+        peak_wal_mb=peak_wal / 1024**2,
+        database_mb=database / 1024**2,
+        again_seconds=again_seconds,
+        again_wal_mb=again_wal / 1024**2,
+    )
+
+
+def dump_post(post: PostRecord) -> dict[str, Any]:
+    return {
+        "id": post.name.removeprefix("t3_"),
+        "author": post.author or "[deleted]",
+        "created_utc": post.created_utc,
+        "distinguished": post.distinguished,
+        "edited": post.edited,
+        "score": post.score,
+        "subreddit": post.subreddit,
+        "locked": post.locked,
+        "num_comments": post.num_comments,
+        "over_18": post.over_18,
+        "selftext": post.selftext,
+        "is_self": post.is_textual,
+        "spoiler": post.spoiler,
+        "title": post.title,
+        "url": post.img_link_or_permalink,
+        "upvote_ratio": post.upvote_ratio,
+    }
+
+
+def dump_comment(comment: CommentRecord) -> dict[str, Any]:
+    return {
+        "id": comment.name.removeprefix("t1_"),
+        "author": comment.author or "[deleted]",
+        "created_utc": comment.created_utc,
+        "distinguished": comment.distinguished,
+        "edited": comment.edited,
+        "score": comment.score,
+        "subreddit": comment.subreddit,
+        "link_id": comment.post,
+        "parent_id": comment.parent_id,
+        "body": comment.body,
+        "stickied": comment.stickied,
+    }
+
+
+def write_dumps(directory: Path, posts: int, comments: int) -> list[Path]:
+    # a submissions and a comments dump shaped like pushshift's, made from the
+    # same synthetic records as --ingest
+    from .importer import import_zstandard
+
+    zstandard = import_zstandard()
+    batch = ingest_data(posts, comments)
+    submissions = directory / "bench_submissions.zst"
+    with zstandard.ZstdCompressor().stream_writer(submissions.open("wb")) as file:
+        for data in batch:
+            file.write(json.dumps(dump_post(data.post)).encode() + b"\n")
+    replies = directory / "bench_comments.zst"
+    with zstandard.ZstdCompressor().stream_writer(replies.open("wb")) as file:
+        for data in batch:
+            for comment in data.comments or ():
+                file.write(json.dumps(dump_comment(comment)).encode() + b"\n")
+    return [submissions, replies]
+
+
+def run_import(
+    profile: DB_PROFILE, posts: int, comments: int, workers: int
+) -> ImportResult:
+    # runs in a fresh process. the second import finds every row already
+    # stored, which is what resuming an interrupted import costs
+    from . import importer
+    from .database import DB
+
+    with tempfile.TemporaryDirectory(prefix="rdscp-bench-") as tmp:
+        files = write_dumps(Path(tmp), posts, comments)
+        options = importer.ImportOptions(
+            loglevel=None,
+            files=files,
+            workers=workers,
+            batch_size=10000,
+            db=Path(tmp) / DB_PATH,
+            db_config=PROFILES[profile],
+        )
+        seconds = []
+        for _ in range(2):
+            start = time.perf_counter()
+            importer.run(options)
+            seconds.append(time.perf_counter() - start)
+        DB.close()
+        dump = sum(path.stat().st_size for path in files)
+    return ImportResult(
+        profile=profile,
+        workers=workers,
+        records=posts * (comments + 1),
+        dump_mb=dump / 1024**2,
+        seconds=seconds[0],
+        again_seconds=seconds[1],
+    )
+
+
+def trace_records() -> str:
+    # runs in a fresh process. only the python objects made from the thread
+    # once it is loaded are traced, the comment tree praw builds is not
+    from .database import append_db
+    from .expand import serialize_stubs
+    from .get_posts import (
+        RedditData,
+        create_instance,
+        expand_comments,
+        format_comments,
+        get_post_data,
+        make_sort,
+    )
+    from .migrations import setup_db
+
+    scenario = BenchScenario(1, 1, FakeConfig(comments=TRACED_COMMENTS))
+    creds = RedditCredentials("bench", "bench", DEFAULT_UA)
+    options = scenario_options(scenario, "sync", logging.WARN, creds)
+    api = create_instance(
+        creds, session=FakeReddit(scenario.fake), check_for_updates=False
+    )
+    post = next(make_sort(api, options.jobs[0]))
+    comments, stubs = expand_comments(post, options)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="rdscp-bench-") as tmp:
+        os.chdir(tmp)
+        try:
+            setup_db()
+            tracemalloc.start()
+            data = RedditData(
+                get_post_data(post),
+                format_comments(comments, post.name),
+                stubs=serialize_stubs(stubs, post.name),
+            )
+            held, built = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            append_db(data)
+            written = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        finally:
+            os.chdir(cwd)
+    per_10k = 10_000 / max(len(data.comments or ()), 1) / 1024**2
+    return (
+        f"{len(data.comments or ())} comments, per 10k comments: records hold"
+        f" {held * per_10k:.2f} MB, building them peaks at {built * per_10k:.2f} MB,"
+        f" writing them peaks at {written * per_10k:.2f} MB"
+    )
+
+
+def run_measurements(measurements: list[MEASUREMENT], rows: int | None) -> list[Any]:
+    from . import dbbench
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in measurements:
+        size = dbbench.SIZES[name] if rows is None else rows
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            result = pool.submit(dbbench.MEASUREMENTS[name], size).result()
+        print(result)
+        results.append(result)
+    return results
+
+
+def import_times(args: list[str]) -> dict[str, float]:
+    # milliseconds per module imported by python with these arguments, from
+    # -X importtime. anything imported before site finishes belongs to the
+    # interpreter itself. the fastest run is the one least disturbed by
+    # everything else going on
+    runs = []
+    for _ in range(IMPORT_RUNS):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", *args],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        times: dict[str, float] = {}
+        after_site = False
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            _, cumulative, name = line.split("|")
+            if not after_site:
+                after_site = name.strip() == "site"
+                continue
+            # nesting is shown by indenting two spaces per level
+            top_level = len(name) - len(name.lstrip()) == 1
+            times[name.strip()] = int(cumulative) / 1000 if top_level else 0.0
+        runs.append(times)
+    return min(runs, key=lambda times: sum(times.values()))
+
+
+def check_import_times(budget: float | None) -> None:
+    baseline_import = f"import {', '.join(BASELINE_MODULES)}"
+    baseline = sum(import_times(["-c", baseline_import]).values())
+    print(f"standard library baseline: {baseline:.1f}ms importing")
+    if budget is None:
+        budget = baseline * IMPORT_BUDGET_FACTOR
+    failed = False
+    for command in LIGHT_COMMANDS:
+        times = import_times(["-m", "reddit_scraper.entry", *command])
+        total = sum(times.values())
+        heavy = sorted({name.split(".")[0] for name in times} & HEAVY_PACKAGES)
+        slowest = sorted(times.items(), key=lambda item: item[1], reverse=True)[:3]
+        print(
+            f"rdscp {' '.join(command)}: {total:.1f}ms importing"
+            f" ({', '.join(f'{name} {ms:.1f}ms' for name, ms in slowest)})"
+        )
+        if heavy:
+            print(f"  imports {', '.join(heavy)}, which it has no use for")
+            failed = True
+        if total > budget:
+            print(f"  over the budget of {budget:.0f}ms")
+            failed = True
+    if failed:
+        sys.exit(1)
+    print(f"All commands started within the budget of {budget:.0f}ms.")
+
+
+def run(options: BenchOptions) -> None:
+    if options.importtime:
+        check_import_times(options.budget)
+        return
+    if options.measure:
+        save_results(run_measurements(options.measure, options.posts), options.out)
+        return
+    context = multiprocessing.get_context("spawn")
+    if options.tracemalloc:
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            print(pool.submit(trace_records).result())
+        return
+    if options.ingest:
+        posts = INGEST_POSTS if options.posts is None else options.posts
+        comments = INGEST_COMMENTS if options.comments is None else options.comments
+        ingests = []
+        for profile in options.profiles or get_args(DB_PROFILE):
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                ingest = pool.submit(run_ingest, profile, posts, comments).result()
+            print(ingest)
+            ingests.append(ingest)
+        save_results(ingests, options.out)
+        return
+    if options.import_dump:
+        posts = INGEST_POSTS if options.posts is None else options.posts
+        comments = INGEST_COMMENTS if options.comments is None else options.comments
+        imports = []
+        for profile in options.profiles or get_args(DB_PROFILE):
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                imported = pool.submit(
+                    run_import, profile, posts, comments, options.workers or 0
+                ).result()
+            print(imported)
+            imports.append(imported)
+        save_results(imports, options.out)
+        return
+    unknown = [name for name in options.scenarios if name not in SCENARIOS]
+    if unknown:
+        print(
+            f"Unknown benchmark scenario {', '.join(unknown)},"
+            f" choose from {', '.join(SCENARIOS)}."
+        )
+        sys.exit(1)
+    if "async" in options.backends:
+        main.check_async_backend()
+    # per-post logging would drown out the results, so only -vv turns it back on
+    loglevel = logging.DEBUG if options.loglevel == logging.DEBUG else logging.WARN
+    results = []
+    for name in options.scenarios or SCENARIOS:
+        scenario = apply_overrides(SCENARIOS[name], options)
+        profiles = options.profiles or ["default"]
+        for backend, profile in product(options.backends, profiles):
+            logger.info(f"Running benchmark scenario {name} ({backend}, {profile})...")
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                result = pool.submit(
+                    run_scenario, name, scenario, backend, profile, loglevel
+                ).result()
+            print(result)
+            results.append(result)
+    save_results(results, options.out)
+
+
+def save_results(results: list[Any], out: Path | None) -> None:
+    if out:
+        out.write_text(
+            json.dumps([asdict(result) for result in results], indent=2) + "\n"
+        )
+        print(f"Saved results to {out}")
@@ -1,37 +1,70 @@
 from __future__ import annotations
 
+from datetime import datetime, timedelta
+from functools import cache
+import os
+import socket
+import sqlite3
+import time
+
 from peewee import (
+    AutoField,
     BooleanField,
     CharField,
+    CompositeKey,
     DateTimeField,
+    Expression,
+    Field,
     FloatField,
     ForeignKeyField,
     IntegerField,
     Model,
+    OperationalError,
     TextField,
+    chunked,
+    fn,
 )
 from playhouse.sqlite_ext import SqliteExtDatabase
 
-from typing import TYPE_CHECKING
-from reddit_scraper import logger
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterator
+from reddit_scraper import DB_PATH, logger
+from .dbconfig import PROFILES, DBConfig, Pragma
+from .metrics import METRICS
+from .records import CommentRecord, PostRecord, content_hash
 
 if TYPE_CHECKING:
     from .get_posts import RedditData
 
+# SQLite raised its default bound parameter limit from 999 in 3.32.0
+SQLITE_MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+# INSERT ... ON CONFLICT DO UPDATE arrived in 3.24.0
+SQLITE_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
 
-def make_db() -> SqliteExtDatabase:
-    db = SqliteExtDatabase(
-        "reddit-scraper.db",
-        pragmas=(
-            ("cache_size", -1024 * 64),
-            ("journal_mode", "wal"),
-            ("foreign_keys", 1),
-        ),
-    )
-    return db
+# deferred until init_db, so nothing about the database is settled at import
+DB = SqliteExtDatabase(None)
+# the file and pragmas DB was last initialized with
+_opened: tuple[str, list[tuple[str, Pragma]]] | None = None
+
+
+def connection_pragmas(config: DBConfig) -> list[tuple[str, Pragma]]:
+    pragmas = dict(config.pragmas)
+    if config.defer_foreign_keys:
+        pragmas["foreign_keys"] = 0
+    # the page size can't change anymore once the database is in WAL mode
+    return sorted(pragmas.items(), key=lambda pragma: pragma[0] != "page_size")
 
 
-DB = make_db()
+def init_db(path: str | Path = DB_PATH, config: DBConfig | None = None) -> None:
+    # opening another file, e.g. the next shard, closes the previous one. so
+    # does asking for other pragmas, since they are set on every new connection
+    global _opened
+    pragmas = connection_pragmas(config or PROFILES["default"])
+    if _opened != (str(path), pragmas):
+        if not DB.deferred:
+            DB.close()
+        DB.init(str(path), pragmas=pragmas)
+        _opened = (str(path), pragmas)
 
 
 class BaseModel(Model):
@@ -41,14 +74,27 @@ class BaseModel(Model):
         database = DB
 
 
+class Subreddit(BaseModel):
+    name = TextField(unique=True)
+
+
+class Author(BaseModel):
+    name = TextField(unique=True)
+
+
 class RedditContent(BaseModel):
     name = CharField(primary_key=True, unique=True, max_length=15)
-    author = TextField(null=True)
+    # subreddit and author names repeat on every row, so they are stored once
+    # in lookup tables and referenced by id
+    author = ForeignKeyField(Author, null=True, index=False, backref="+")
     created_utc = DateTimeField()
     distinguished = TextField(null=True)
     edited = BooleanField()
     score = IntegerField(default=0)
-    subreddit = TextField()
+    subreddit = ForeignKeyField(Subreddit, index=False, backref="+")
+    # records.content_hash of the row, so scraping it again unchanged writes
+    # nothing. NULL for rows written before it existed
+    content_hash = IntegerField(null=True)
 
 
 class RedditPost(RedditContent):
@@ -62,54 +108,465 @@ class RedditPost(RedditContent):
     img_link_or_permalink = TextField()
     upvote_ratio = FloatField(null=True)
 
+    class Meta:
+        indexes = ((("subreddit", "created_utc"), False),)
+
 
 class RedditComment(RedditContent):
-    post = ForeignKeyField(RedditPost, backref="comments", field=RedditPost.name)
+    # the (post, created_utc) index below also serves lookups by post alone
+    post = ForeignKeyField(
+        RedditPost, backref="comments", field=RedditPost.name, index=False
+    )
     parent_id = CharField(null=True, max_length=15, index=True)
     body = TextField(null=True)
     saved = BooleanField(default=False)
     stickied = BooleanField(default=False)
     depth = IntegerField()
 
+    class Meta:
+        indexes = (
+            (("post", "created_utc"), False),
+            (("subreddit", "created_utc"), False),
+        )
+
+
+class Checkpoint(BaseModel):
+    subreddit = TextField()
+    sort_type = TextField()
+    name = CharField(max_length=15)
+    created_utc = DateTimeField()
+
+    class Meta:
+        primary_key = CompositeKey("subreddit", "sort_type")
+
+
+class MoreStub(BaseModel):
+    id = AutoField()
+    name = None
+    post = ForeignKeyField(RedditPost, backref="more_stubs", field=RedditPost.name)
+    parent_id = CharField(max_length=15)
+    depth = IntegerField()
+    count = IntegerField()
+    children = TextField()
+
+
+class WorkItem(BaseModel):
+    # posts found in a listing but not written yet. a restarted run fetches
+    # these before touching any listing, and processes sharing the database
+    # split them up by claiming rows
+    name = CharField(primary_key=True, max_length=15)
+    subreddit = TextField()
+    sort_type = TextField()
+    refresh = BooleanField(default=False)
+    found_at = DateTimeField(default=datetime.now)
+    claimed_by = TextField(null=True)
+    claimed_at = DateTimeField(null=True)
+    attempts = IntegerField(default=0)
+
+
+class ScoreHistory(BaseModel):
+    # with score_history, a row for each time a scrape finds a post or comment
+    # with another score than it was stored with, starting with the first one
+    name = CharField(max_length=15)
+    # unix seconds, half the size of a DateTimeField's text
+    seen_at = IntegerField()
+    score = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey("name", "seen_at")
+        without_rowid = True
+
+
+TABLES = [
+    Subreddit,
+    Author,
+    RedditPost,
+    RedditComment,
+    Checkpoint,
+    MoreStub,
+    WorkItem,
+    ScoreHistory,
+]
+
+# the columns each record's values are inserted into, in the record's order,
+# followed by its content hash
+POST_FIELDS = [
+    *(RedditPost._meta.fields[name] for name in PostRecord._fields),
+    RedditPost.content_hash,
+]
+COMMENT_FIELDS = [
+    *(RedditComment._meta.fields[name] for name in CommentRecord._fields),
+    RedditComment.content_hash,
+]
+
+# claims older than this belong to a process that was killed outright
+CLAIM_TIMEOUT = timedelta(minutes=30)
+# posts claimed this many times without being written are left alone
+MAX_ATTEMPTS = 5
+# tries at a claim while other processes keep the write lock past busy_timeout,
+# waiting twice as long before each next one
+CLAIM_RETRIES = 5
+CLAIM_BACKOFF = 1.0
+
+# ids of names already in the lookup tables. only the writer thread interns
+# names, so a plain dict is enough
+_interned: dict[tuple[type[Model], str], int] = {}
+
+
+def get_checkpoint(subreddit: str, sort_type: str) -> Checkpoint | None:
+    return Checkpoint.get_or_none(
+        Checkpoint.subreddit == subreddit.lower(), Checkpoint.sort_type == sort_type
+    )
+
+
+def save_checkpoint(
+    subreddit: str, sort_type: str, name: str, created_utc: datetime
+) -> None:
+    Checkpoint.insert(
+        subreddit=subreddit.lower(),
+        sort_type=sort_type,
+        name=name,
+        created_utc=created_utc,
+    ).on_conflict_replace().execute()
+
+
+def new_comment_count(post_id: str, num_comments: int) -> int:
+    archived = (
+        RedditPost.select(RedditPost.num_comments)
+        .where(RedditPost.name == post_id)
+        .scalar()
+    )
+    if archived is None or archived == num_comments:
+        return 0
+    stored = RedditComment.select().where(RedditComment.post == post_id).count()
+    return max(num_comments - stored, 0)
+
+
+def pending_stubs() -> Iterator[tuple[str, list[dict]]]:
+    post_ids = (
+        MoreStub.select(MoreStub.post)
+        .group_by(MoreStub.post)
+        .order_by(fn.SUM(MoreStub.count).desc())
+        .scalars()
+    )
+    for post_id in list(post_ids):
+        rows = MoreStub.select().where(MoreStub.post == post_id).dicts()
+        yield post_id, list(rows)
+
+
+def worker_name() -> str:
+    # worked out on every call, forked processes must not claim as their parent
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claimable() -> Expression:
+    stale = datetime.now() - CLAIM_TIMEOUT
+    return (WorkItem.claimed_at.is_null() | (WorkItem.claimed_at < stale)) & (
+        WorkItem.attempts < MAX_ATTEMPTS
+    )
+
+
+def claimable_work() -> int:
+    return WorkItem.select().where(claimable()).count()
+
 
-def append_db(data: RedditData) -> None:
+def claim_work(limit: int, new: list[dict] | None = None) -> list[WorkItem]:
+    delay = CLAIM_BACKOFF
+    for _ in range(CLAIM_RETRIES - 1):
+        try:
+            return claim_once(limit, new)
+        except OperationalError as e:
+            # rolled back as a whole, so it can simply be tried again
+            if "locked" not in str(e):
+                raise
+        logger.warning(f"The database is locked, claiming posts again in {delay:.0f}s")
+        time.sleep(delay)
+        delay *= 2
+    return claim_once(limit, new)
+
+
+def claim_once(limit: int, new: list[dict] | None) -> list[WorkItem]:
+    # IMMEDIATE takes the write lock up front, so two processes can never read
+    # the same unclaimed rows before either of them marks them as its own.
+    # newly found posts are queued in the same transaction, one commit instead
+    # of two while the writer thread is competing for the lock
+    with DB.atomic("IMMEDIATE"):
+        if new:
+            # posts already queued, maybe by another process, keep their place
+            for batch in chunked(new, SQLITE_MAX_VARIABLES // len(new[0])):
+                WorkItem.insert_many(batch).on_conflict_ignore().execute()
+        query = (
+            WorkItem.select()
+            .where(claimable())
+            .order_by(WorkItem.found_at)
+            .limit(limit)
+        )
+        items = list(query)
+        if items:
+            WorkItem.update(
+                claimed_by=worker_name(),
+                claimed_at=datetime.now(),
+                attempts=WorkItem.attempts + 1,
+            ).where(WorkItem.name.in_([item.name for item in items])).execute()
+    return items
+
+
+def claimed_elsewhere() -> bool:
+    stale = datetime.now() - CLAIM_TIMEOUT
+    return (
+        WorkItem.select()
+        .where(WorkItem.claimed_by != worker_name(), WorkItem.claimed_at >= stale)
+        .exists()
+    )
+
+
+def release_work() -> int:
+    # hands unfinished posts back, so the next run or another process takes them
+    return (
+        WorkItem.update(claimed_by=None, claimed_at=None)
+        .where(WorkItem.claimed_by == worker_name())
+        .execute()
+    )
+
+
+def process_alive(pid: int) -> bool:
+    if os.name != "posix":
+        # os.kill doesn't just probe on windows, it terminates the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def release_dead_claims() -> int:
+    # claims of processes on this machine that are gone, killed before they
+    # could release them, don't have to wait for CLAIM_TIMEOUT
+    host = socket.gethostname()
+    workers = (
+        WorkItem.select(WorkItem.claimed_by)
+        .where(WorkItem.claimed_by.startswith(f"{host}:"))
+        .distinct()
+        .scalars()
+    )
+    dead = [
+        worker
+        for worker in workers
+        if not process_alive(int(worker.rsplit(":", maxsplit=1)[-1]))
+    ]
+    if not dead:
+        return 0
+    return (
+        WorkItem.update(claimed_by=None, claimed_at=None)
+        .where(WorkItem.claimed_by.in_(dead))
+        .execute()
+    )
+
+
+def abandoned_work() -> int:
+    return WorkItem.select().where(WorkItem.attempts >= MAX_ATTEMPTS).count()
+
+
+def intern(model: type[Model], name: str | None) -> int | None:
+    if name is None:
+        return None
+    key = (model, name)
+    name_id = _interned.get(key)
+    if name_id is None:
+        model.insert(name=name).on_conflict_ignore().execute()
+        name_id = model.select(model.id).where(model.name == name).scalar()
+        _interned[key] = name_id
+    return name_id
+
+
+def insert_row(record: PostRecord | CommentRecord) -> tuple[Any, ...]:
+    # lookup ids, datetimes and the hash only exist for the batch being inserted,
+    # in a plain tuple since they no longer fit the record's field types. the
+    # seven fields of RedditContent come first in both records
+    return (
+        record.name,
+        intern(Author, record.author),
+        datetime.fromtimestamp(record.created_utc),
+        record.distinguished,
+        record.edited,
+        record.score,
+        intern(Subreddit, record.subreddit),
+        *record[7:],
+        content_hash(record),
+    )
+
+
+@cache
+def upsert_sql(table: str, fields: tuple[Field, ...]) -> str:
+    columns = ", ".join(f'"{field.column_name}"' for field in fields)
+    values = ", ".join("?" for _ in fields)
+    if not SQLITE_UPSERT:
+        return f'INSERT OR REPLACE INTO "{table}" ({columns}) VALUES ({values})'
+    updates = ", ".join(
+        f'"{field.column_name}" = excluded."{field.column_name}"'
+        for field in fields
+        if field.column_name != "name"
+    )
+    return (
+        f'INSERT INTO "{table}" ({columns}) VALUES ({values})'
+        f' ON CONFLICT ("name") DO UPDATE SET {updates}'
+        f' WHERE "{table}".content_hash IS NOT excluded.content_hash'
+    )
+
+
+def upsert(model: type[Model], fields: list[Field], rows: list[tuple]) -> int:
+    # REPLACE deletes the stored row and inserts it again, updating every index
+    # and the search index, even when nothing changed. this only updates rows
+    # whose content hash differs, and leaves the rest alone. the statement is
+    # prepared once and run for every row, peewee would build the sql of a
+    # multi-row insert value by value. returns how many rows were written
+    converters = [field.db_value for field in fields]
+    cursor = DB.cursor()
+    cursor.executemany(
+        upsert_sql(model._meta.table_name, tuple(fields)),
+        ([convert(value) for convert, value in zip(converters, row)] for row in rows),
+    )
+    return cursor.rowcount
+
+
+def record_scores(
+    model: type[Model], records: list[PostRecord] | list[CommentRecord]
+) -> None:
+    # before the records are written, while the stored scores are the old ones
+    stored = {}
+    names = [record.name for record in records]
+    for batch in chunked(names, SQLITE_MAX_VARIABLES):
+        query = model.select(model.name, model.score).where(model.name.in_(batch))
+        stored.update(query.tuples())
+    seen_at = int(time.time())
+    rows = [
+        (record.name, seen_at, record.score)
+        for record in records
+        if stored.get(record.name) != record.score
+    ]
+    fields = [ScoreHistory.name, ScoreHistory.seen_at, ScoreHistory.score]
+    for batch in chunked(rows, SQLITE_MAX_VARIABLES // len(fields)):
+        ScoreHistory.insert_many(batch, fields=fields).on_conflict_replace().execute()
+    METRICS.count("scores_recorded", len(rows))
+
+
+def forget_interned(limit: int = 0) -> None:
+    # names interned inside a rolled back transaction are gone again, and a
+    # long import would otherwise remember every author it ever came across
+    if len(_interned) > limit:
+        _interned.clear()
+
+
+def insert_new(
+    model: type[Model],
+    fields: list[Field],
+    records: list[PostRecord] | list[CommentRecord],
+) -> int:
+    # rows already in the archive are left as they are. returns how many of
+    # the records were new
+    inserted = 0
+    for batch in chunked(map(insert_row, records), SQLITE_MAX_VARIABLES // len(fields)):
+        query = model.insert_many(batch, fields=fields).on_conflict_ignore()
+        inserted += query.as_rowcount().execute()
+    return inserted
+
+
+def stored_posts(names: set[str]) -> set[str]:
+    stored = set()
+    for batch in chunked(names, SQLITE_MAX_VARIABLES):
+        query = RedditPost.select(RedditPost.name).where(RedditPost.name.in_(batch))
+        stored.update(query.scalars())
+    return stored
+
+
+def stored_depths(names: set[str]) -> dict[str, int]:
+    depths = {}
+    for batch in chunked(names, SQLITE_MAX_VARIABLES):
+        query = RedditComment.select(RedditComment.name, RedditComment.depth).where(
+            RedditComment.name.in_(batch)
+        )
+        depths.update(query.tuples())
+    return depths
+
+
+def start_ingest(config: DBConfig) -> None:
+    if config.defer_indexes:
+        logger.info("Dropping secondary indexes until everything is written...")
+        for model in (RedditPost, RedditComment):
+            model._schema.drop_indexes(safe=True)
+
+
+def finish_ingest(config: DBConfig) -> None:
+    # setup_db also builds missing indexes, should a run die before this
+    if config.defer_indexes:
+        logger.info("Building secondary indexes...")
+        with METRICS.timer("indexing"):
+            for model in (RedditPost, RedditComment):
+                model._schema.create_indexes(safe=True)
+    if config.defer_foreign_keys:
+        broken = DB.execute_sql("PRAGMA foreign_key_check").fetchall()
+        if broken:
+            logger.warning(f"{len(broken)} rows reference rows that don't exist.")
+    if config.checkpoint_interval is not None:
+        checkpoint_wal()
+
+
+def checkpoint_wal() -> None:
+    # unlike the automatic checkpoints, TRUNCATE also shrinks the WAL file back
+    # to nothing. it gives up if readers are still busy, until the next call
+    with METRICS.timer("checkpoint"):
+        DB.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    METRICS.count("wal_checkpoints")
+
+
+def append_db(data: RedditData, score_history: bool = False) -> bool:
+    comments = 0
     try:
         with DB.atomic():
-            logger.debug(f"saving post: {data.post.get('name', '?')}")
-            RedditPost.insert(data.post).on_conflict_replace().execute()
+            if score_history:
+                record_scores(RedditPost, [data.post])
+            post = upsert(RedditPost, POST_FIELDS, [insert_row(data.post)])
             if data.comments:
-                append_comments(data.comments, data.post["name"])
+                comments = append_comments(data.comments, score_history)
+            if data.stubs is not None:
+                MoreStub.delete().where(MoreStub.post == data.post.name).execute()
+                batch_size = SQLITE_MAX_VARIABLES // len(MoreStub._meta.fields)
+                for batch in chunked(data.stubs, batch_size):
+                    MoreStub.insert_many(batch).execute()
     except Exception as e:
+        # names interned inside the rolled back savepoint are gone again
+        _interned.clear()
         logger.error(
-            f"database post saving error! {data.post['name']}: error {e}",
+            f"database post saving error! {data.post.name}: error {e}",
             exc_info=True,
         )
+        return False
+    METRICS.count("posts_written", post)
+    METRICS.count("posts_unchanged", 1 - post)
+    METRICS.count("comments_written", comments)
+    METRICS.count("comments_unchanged", len(data.comments or ()) - comments)
+    METRICS.count("stubs_written", len(data.stubs or ()))
+    return True
 
 
-def append_comments(comments: list[dict], post_id: str) -> None:
-    to_save: list[dict] = []
-    to_recurse = []
+def append_many(batch: list[RedditData], score_history: bool = False) -> None:
+    # each append_db nests as a savepoint, so one bad post doesn't sink the batch
+    try:
+        with DB.atomic():
+            written = [
+                data.post.name for data in batch if append_db(data, score_history)
+            ]
+            # written posts leave the work queue in the same commit
+            WorkItem.delete().where(WorkItem.name.in_(written)).execute()
+    except Exception:
+        _interned.clear()
+        raise
 
-    for comment_data in comments:
-        replies = comment_data.get("replies", [])
-        comment_data["post"] = post_id
-        if replies:
-            to_recurse.extend(replies)
-        no_replies = {
-            k: v for k, v in comment_data.items() if k not in {"replies", "submission"}
-        }
-        to_save.append(no_replies)
 
-    if to_save:
-        try:
-            for comment in to_save:
-                logger.debug(f"saving comments: {comment.get('name', '???')}")
-                RedditComment.insert(comment).on_conflict_replace().execute()
-        except Exception as e:
-            logger.error(
-                f"database comment saving error! {post_id}: error {e}",
-                exc_info=True,
-            )
-
-    if to_recurse:
-        append_comments(to_recurse, post_id)
+def append_comments(comments: list[CommentRecord], score_history: bool = False) -> int:
+    if score_history:
+        record_scores(RedditComment, comments)
+    return upsert(RedditComment, COMMENT_FIELDS, list(map(insert_row, comments)))
@@ -0,0 +1,480 @@
+from __future__ import annotations
+
+from contextlib import contextmanager, redirect_stdout
+from dataclasses import dataclass
+from datetime import datetime
+import io
+from itertools import accumulate
+import json
+from pathlib import Path
+import random
+import tempfile
+import time
+import tracemalloc
+from typing import TYPE_CHECKING, Callable, Iterator
+
+from playhouse.shortcuts import model_to_dict
+
+from reddit_scraper import DB_PATH
+from .bench import ingest_data
+from .database import (
+    COMMENT_FIELDS,
+    DB,
+    POST_FIELDS,
+    RedditComment,
+    RedditPost,
+    Subreddit,
+    append_comments,
+    checkpoint_wal,
+    forget_interned,
+    init_db,
+    insert_row,
+    intern,
+    upsert,
+)
+from .export import ExportOptions, export
+from .fake_reddit import START_UTC, to_base36
+from .migrations import setup_db
+from .search import INDEXES, SearchOptions, create_index, search
+from .seen import SEEN_SETS
+
+if TYPE_CHECKING:
+    from .records import CommentRecord
+
+# measurements of single database operations, for rdscp bench --measure. each
+# one runs in a fresh process on a throwaway database, and compares the path
+# the scraper takes now with the one it replaced
+
+# comments on each synthetic post
+THREAD_SIZE = 50
+# rows each measurement works on, unless -n says otherwise
+SIZES = {
+    "write": 20_000,
+    "seen": 1_000_000,
+    "search": 100_000,
+    "export": 20_000,
+    "migrate": 1_000_000,
+}
+# names looked up in each seen set, half of them archived
+LOOKUPS = 10_000
+# comment bodies are drawn from this many words, the most common ones the most
+# often, like in real text. each is searched for at a few ranks
+VOCABULARY = 10_000
+SEARCHED_RANKS = [1, 100, 10_000]
+WORDS_PER_COMMENT = 20
+# counts from 0 up to the parameter, for rows built inside sqlite
+NUMBERS = (
+    "WITH RECURSIVE number(n) AS"
+    " (SELECT 0 UNION ALL SELECT n + 1 FROM number WHERE n + 1 < ?)"
+)
+# the content tables as they were before migrations existed, schema version 0
+SCHEMA_V0 = [
+    """CREATE TABLE "redditpost" ("name" VARCHAR(15) NOT NULL PRIMARY KEY,
+    "author" TEXT, "created_utc" DATETIME NOT NULL, "distinguished" TEXT,
+    "edited" INTEGER NOT NULL, "score" INTEGER NOT NULL, "subreddit" TEXT NOT NULL,
+    "locked" INTEGER NOT NULL, "num_comments" INTEGER NOT NULL,
+    "over_18" INTEGER NOT NULL, "selftext" TEXT, "is_textual" INTEGER NOT NULL,
+    "spoiler" INTEGER NOT NULL, "title" TEXT NOT NULL,
+    "img_link_or_permalink" TEXT NOT NULL, "upvote_ratio" REAL)""",
+    """CREATE TABLE "redditcomment" ("name" VARCHAR(15) NOT NULL PRIMARY KEY,
+    "author" TEXT, "created_utc" DATETIME NOT NULL, "distinguished" TEXT,
+    "edited" INTEGER NOT NULL, "score" INTEGER NOT NULL, "subreddit" TEXT NOT NULL,
+    "post_id" VARCHAR(15) NOT NULL, "parent_id" VARCHAR(15), "body" TEXT,
+    "saved" INTEGER NOT NULL, "stickied" INTEGER NOT NULL, "depth" INTEGER NOT NULL,
+    FOREIGN KEY ("post_id") REFERENCES "redditpost" ("name"))""",
+    'CREATE INDEX "redditcomment_post_id" ON "redditcomment" ("post_id")',
+    'CREATE INDEX "redditcomment_parent_id" ON "redditcomment" ("parent_id")',
+]
+# spread over this many subreddits, and posted a second apart
+MIGRATED_SUBREDDITS = 20
+# a post's comments, and a subreddit's newest comments in a time window, as
+# asked of each schema
+QUERIES_V0 = {
+    "comments by post": 'SELECT * FROM "redditcomment" WHERE post_id = ?'
+    " ORDER BY created_utc",
+    "subreddit by time": 'SELECT * FROM "redditcomment" WHERE subreddit = ?'
+    " AND created_utc >= ? ORDER BY created_utc LIMIT 100",
+}
+QUERIES = {
+    "comments by post": 'SELECT * FROM "redditcomment" WHERE post_id = ?'
+    " ORDER BY created_utc",
+    "subreddit by time": 'SELECT * FROM "redditcomment" WHERE subreddit_id ='
+    ' (SELECT id FROM "subreddit" WHERE name = ?)'
+    " AND created_utc >= ? ORDER BY created_utc LIMIT 100",
+}
+# runs of each timed query, the fastest one counts
+RUNS = 5
+
+
+@dataclass
+class WriteResult:
+    comments: int
+    per_row_seconds: float
+    batched_seconds: float
+
+    def __str__(self) -> str:
+        per_row = self.comments / self.per_row_seconds
+        batched = self.comments / self.batched_seconds
+        return (
+            f"write: {self.comments} comments | one insert per row"
+            f" {per_row:.0f} rows/s, batched upserts {batched:.0f} rows/s"
+            f" ({batched / per_row:.1f}x)"
+        )
+
+
+@dataclass
+class SeenResult:
+    posts: int
+    startup_seconds: dict[str, float]
+    held_mb: dict[str, float]
+    peak_mb: dict[str, float]
+    lookup_us: dict[str, float]
+
+    def __str__(self) -> str:
+        return f"seen: {self.posts} archived posts" + "".join(
+            f"\n  {dedup}: loads in {self.startup_seconds[dedup]:.2f}s, holds"
+            f" {self.held_mb[dedup]:.1f} MB after peaking at"
+            f" {self.peak_mb[dedup]:.1f} MB, {self.lookup_us[dedup]:.1f}µs a lookup"
+            for dedup in self.startup_seconds
+        )
+
+
+@dataclass
+class SearchResult:
+    comments: int
+    matches: dict[str, int]
+    fts_ms: dict[str, float]
+    like_ms: dict[str, float]
+
+    def __str__(self) -> str:
+        return f"search: {self.comments} comments, 20 results a query" + "".join(
+            f"\n  {word} (in {self.matches[word]} comments): full-text index"
+            f" {self.fts_ms[word]:.1f}ms, LIKE scan {self.like_ms[word]:.1f}ms"
+            for word in self.fts_ms
+        )
+
+
+@dataclass
+class ExportResult:
+    comments: int
+    streamed_seconds: float
+    streamed_peak_mb: float
+    naive_seconds: float
+    naive_peak_mb: float
+
+    def __str__(self) -> str:
+        return (
+            f"export: {self.comments} comments to ndjson | streamed in"
+            f" {self.streamed_seconds:.2f}s peaking at {self.streamed_peak_mb:.1f} MB,"
+            f" as model instances in {self.naive_seconds:.2f}s peaking at"
+            f" {self.naive_peak_mb:.1f} MB"
+        )
+
+
+@dataclass
+class MigrateResult:
+    comments: int
+    seconds: float
+    before_mb: float
+    after_mb: float
+    vacuumed_mb: float
+    before_ms: dict[str, float]
+    after_ms: dict[str, float]
+
+    def __str__(self) -> str:
+        return (
+            f"migrate: {self.comments} comments from schema version 0 in"
+            f" {self.seconds:.1f}s | {self.before_mb:.0f} MB before,"
+            f" {self.after_mb:.0f} MB after, {self.vacuumed_mb:.0f} MB vacuumed"
+        ) + "".join(
+            f"\n  {query}: {self.before_ms[query]:.2f}ms before,"
+            f" {self.after_ms[query]:.2f}ms after"
+            for query in self.before_ms
+        )
+
+
+@contextmanager
+def temporary_db() -> Iterator[Path]:
+    with tempfile.TemporaryDirectory(prefix="rdscp-bench-") as tmp:
+        path = Path(tmp) / DB_PATH
+        setup_db(path)
+        try:
+            yield path
+        finally:
+            DB.close()
+            # the ids of the next database's names start over
+            forget_interned()
+
+
+def insert_per_row(comments: list[CommentRecord]) -> None:
+    # how comments were written before they were batched
+    for comment in comments:
+        row = dict(zip(COMMENT_FIELDS, insert_row(comment)))
+        RedditComment.insert(row).on_conflict_replace().execute()
+
+
+def measure_write(comments: int) -> WriteResult:
+    # the posts are written up front, then only their comments are timed, in
+    # one transaction per post like a scrape
+    batch = ingest_data(max(comments // THREAD_SIZE, 1), THREAD_SIZE)
+    seconds = []
+    write: Callable[[list[CommentRecord]], object]
+    for write in (insert_per_row, append_comments):
+        with temporary_db():
+            posts = [insert_row(data.post) for data in batch]
+            with DB.atomic():
+                upsert(RedditPost, POST_FIELDS, posts)
+            start = time.perf_counter()
+            for data in batch:
+                with DB.atomic():
+                    write(data.comments or [])
+            seconds.append(time.perf_counter() - start)
+    return WriteResult(
+        comments=len(batch) * THREAD_SIZE,
+        per_row_seconds=seconds[0],
+        batched_seconds=seconds[1],
+    )
+
+
+def fill_posts(count: int) -> None:
+    # bare posts numbered from 0, built inside sqlite. going through the
+    # records would take minutes for an archive of millions
+    DB.connection().create_function("base36", 1, to_base36, deterministic=True)
+    created = datetime.fromtimestamp(START_UTC)
+    DB.execute_sql(
+        f'{NUMBERS} INSERT INTO "redditpost" (name, created_utc, edited, score,'
+        " subreddit_id, locked, num_comments, over_18, is_textual, spoiler, title,"
+        " img_link_or_permalink)"
+        " SELECT 't3_' || base36(n), ?, 0, 0, ?, 0, 0, 0, 1, 0, '', '' FROM number",
+        (count, created, intern(Subreddit, "bench")),
+    )
+
+
+def measure_seen(posts: int) -> SeenResult:
+    # each backend is loaded twice, once timed and once traced, as tracing
+    # slows down the allocations it counts
+    result = SeenResult(posts, {}, {}, {}, {})
+    rng = random.Random(0)
+    names = [f"t3_{to_base36(rng.randrange(posts * 2))}" for _ in range(LOOKUPS)]
+    with temporary_db():
+        with DB.atomic():
+            fill_posts(posts)
+        for dedup, seen_set in SEEN_SETS.items():
+            start = time.perf_counter()
+            seen = seen_set()
+            result.startup_seconds[dedup] = time.perf_counter() - start
+            start = time.perf_counter()
+            sum(name in seen for name in names)
+            result.lookup_us[dedup] = (time.perf_counter() - start) / LOOKUPS * 1e6
+            del seen
+            tracemalloc.start()
+            seen = seen_set()
+            held, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del seen
+            result.held_mb[dedup] = held / 1024**2
+            result.peak_mb[dedup] = peak / 1024**2
+    return result
+
+
+def word(rank: int) -> str:
+    # of equal length, so LIKE never matches one word inside another
+    return f"w{rank:05d}"
+
+
+def fastest(run: Callable[[], object]) -> float:
+    # in milliseconds, the first run also reads the pages into the cache
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def measure_search(comments: int) -> SearchResult:
+    # the same query through the fts5 index rdscp search uses, and as the
+    # LIKE scan over every comment body it would take without one
+    rng = random.Random(0)
+    words = [word(rank) for rank in range(1, VOCABULARY + 1)]
+    weights = list(accumulate(1 / rank for rank in range(1, VOCABULARY + 1)))
+    batch = ingest_data(max(comments // THREAD_SIZE, 1), THREAD_SIZE)
+    result = SearchResult(len(batch) * THREAD_SIZE, {}, {}, {})
+    like = (
+        f'SELECT c.name, s.name, c.body FROM "{RedditComment._meta.table_name}" AS c'
+        f' JOIN "{Subreddit._meta.table_name}" AS s ON s.id = c.subreddit_id'
+        " WHERE c.body LIKE ? LIMIT 20"
+    )
+    with temporary_db() as path:
+        with DB.atomic():
+            upsert(RedditPost, POST_FIELDS, [insert_row(data.post) for data in batch])
+            for data in batch:
+                append_comments(
+                    [
+                        comment._replace(
+                            body=" ".join(
+                                rng.choices(
+                                    words, cum_weights=weights, k=WORDS_PER_COMMENT
+                                )
+                            )
+                        )
+                        for comment in data.comments or ()
+                    ]
+                )
+            for index in INDEXES:
+                create_index(index)
+                index.rebuild()
+        for rank in SEARCHED_RANKS:
+            searched = word(rank)
+            options = SearchOptions(
+                loglevel=None,
+                query=searched,
+                comments=True,
+                subreddit=None,
+                limit=20,
+                rebuild=False,
+                db=path,
+                shards=False,
+            )
+            pattern = f"%{searched}%"
+            result.matches[searched] = (
+                RedditComment.select().where(RedditComment.body.contains(searched))
+            ).count()
+            result.fts_ms[searched] = fastest(lambda: search(options))
+            result.like_ms[searched] = fastest(
+                lambda: DB.execute_sql(like, (pattern,)).fetchall()
+            )
+    return result
+
+
+def export_naively(path: Path) -> None:
+    # every row loaded as a model instance up front, and its author and
+    # subreddit looked up one row at a time
+    comments = list(RedditComment.select())
+    with path.open("w", encoding="utf-8") as file:
+        for comment in comments:
+            record = model_to_dict(comment, recurse=False)
+            del record["content_hash"]
+            record["author"] = comment.author.name if comment.author_id else None
+            record["subreddit"] = comment.subreddit.name
+            file.write(json.dumps(record, default=str, ensure_ascii=False) + "\n")
+
+
+def timed_and_traced(run: Callable[[], object]) -> tuple[float, float]:
+    # seconds of an untraced run, and the peak megabytes of a traced one
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak / 1024**2
+
+
+def measure_export(comments: int) -> ExportResult:
+    batch = ingest_data(max(comments // THREAD_SIZE, 1), THREAD_SIZE)
+    with temporary_db() as path:
+        with DB.atomic():
+            upsert(RedditPost, POST_FIELDS, [insert_row(data.post) for data in batch])
+            for data in batch:
+                append_comments(data.comments or [])
+        options = ExportOptions(
+            loglevel=None,
+            table="comments",
+            file_format="ndjson",
+            out=path.with_name("comments.ndjson"),
+            subreddits=None,
+            since=None,
+            until=None,
+            batch_size=10000,
+            partition=False,
+            db=path,
+            shards=False,
+        )
+        with redirect_stdout(io.StringIO()):
+            streamed = timed_and_traced(lambda: export(options))
+        naive = timed_and_traced(lambda: export_naively(options.out))
+    return ExportResult(len(batch) * THREAD_SIZE, *streamed, *naive)
+
+
+def fill_v0(comments: int) -> None:
+    # built inside sqlite like fill_posts, a comment every second
+    DB.connection().create_function("base36", 1, to_base36, deterministic=True)
+    posts = max(comments // THREAD_SIZE, 1)
+    DB.execute_sql(
+        f'{NUMBERS} INSERT INTO "redditpost"'
+        " SELECT 't3_' || base36(n), 'author' || (n % 5000),"
+        f" datetime({START_UTC} + n * {THREAD_SIZE}, 'unixepoch'), NULL,"
+        " 0, n % 500, 'bench' || (n % ?), 0, ?, 0,"
+        " 'synthetic post ' || n, 1, 0, 'Synthetic post ' || n, '', 0.9 FROM number",
+        (posts, MIGRATED_SUBREDDITS, THREAD_SIZE),
+    )
+    DB.execute_sql(
+        f'{NUMBERS} INSERT INTO "redditcomment"'
+        " SELECT 't1_' || base36(n), 'author' || (n % 5000),"
+        f" datetime({START_UTC} + n, 'unixepoch'), NULL,"
+        f" 0, n % 100, 'bench' || (n / {THREAD_SIZE} % ?),"
+        f" 't3_' || base36(n / {THREAD_SIZE}), 't3_' || base36(n / {THREAD_SIZE}),"
+        " 'synthetic comment ' || n || ' on a synthetic post', 0, 0, 0 FROM number",
+        (comments, MIGRATED_SUBREDDITS),
+    )
+
+
+def time_queries(queries: dict[str, str], comments: int) -> dict[str, float]:
+    post = f"t3_{to_base36(comments // THREAD_SIZE // 2)}"
+    # the newest hundredth of the archive
+    since = datetime.fromtimestamp(START_UTC + comments - comments // 100)
+    params = {"comments by post": (post,), "subreddit by time": ("bench7", since)}
+    return {
+        query: fastest(lambda: DB.execute_sql(sql, params[query]).fetchall())
+        for query, sql in queries.items()
+    }
+
+
+def database_mb(path: Path) -> float:
+    # with the WAL folded back in first
+    checkpoint_wal()
+    return path.stat().st_size / 1024**2
+
+
+def measure_migrate(comments: int) -> MigrateResult:
+    # an archive from before migrations existed, with subreddit and author
+    # names in every row and no index on when they were posted, upgraded in
+    # place to the current schema
+    with tempfile.TemporaryDirectory(prefix="rdscp-bench-") as tmp:
+        path = Path(tmp) / DB_PATH
+        init_db(path)
+        DB.connect()
+        with DB.atomic():
+            for sql in SCHEMA_V0:
+                DB.execute_sql(sql)
+            fill_v0(comments)
+        before_mb = database_mb(path)
+        before_ms = time_queries(QUERIES_V0, comments)
+        start = time.perf_counter()
+        setup_db(path)
+        seconds = time.perf_counter() - start
+        after_mb = database_mb(path)
+        after_ms = time_queries(QUERIES, comments)
+        DB.execute_sql("VACUUM")
+        vacuumed_mb = database_mb(path)
+        DB.close()
+    return MigrateResult(
+        comments=comments,
+        seconds=seconds,
+        before_mb=before_mb,
+        after_mb=after_mb,
+        vacuumed_mb=vacuumed_mb,
+        before_ms=before_ms,
+        after_ms=after_ms,
+    )
+
+
+MEASUREMENTS: dict[str, Callable[[int], object]] = {
+    "write": measure_write,
+    "seen": measure_seen,
+    "search": measure_search,
+    "export": measure_export,
+    "migrate": measure_migrate,
+}
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+import re
+import sys
+from typing import Any, Union
+
+from reddit_scraper import DB_PROFILE
+
+# kept apart from database.py, so the arguments can be parsed into a config
+# without importing peewee
+Pragma = Union[int, str]
+
+
+@dataclass
+class DBConfig:
+    pragmas: dict[str, Pragma] = field(default_factory=dict)
+    # seconds between wal_checkpoint(TRUNCATE) calls by the writer. without it
+    # the WAL file is only ever reused, never shrunk
+    checkpoint_interval: float | None = None
+    # drop secondary indexes while writing and build them once at the end
+    defer_indexes: bool = False
+    # don't enforce foreign keys while writing, check every row at the end
+    defer_foreign_keys: bool = False
+    # keep every score a post or comment is scraped with in ScoreHistory
+    score_history: bool = False
+
+
+BASE_PRAGMAS: dict[str, Pragma] = {
+    "cache_size": -1024 * 64,
+    "journal_mode": "wal",
+    "foreign_keys": 1,
+    # the search index triggers depend on it
+    "recursive_triggers": 1,
+    # milliseconds to wait for another process's write lock. merges, backfills
+    # and shards sharing a database can hold it far longer than peewee's 5s
+    "busy_timeout": 60_000,
+}
+PROFILES: dict[str, DBConfig] = {
+    "default": DBConfig(BASE_PRAGMAS),
+    # for backfills. a power cut may lose the last transactions, but never
+    # corrupts the database, as long as it stays in WAL mode
+    "bulk-ingest": DBConfig(
+        {
+            **BASE_PRAGMAS,
+            "cache_size": -1024 * 256,
+            "synchronous": "normal",
+            "temp_store": "memory",
+            "mmap_size": 1024**3,
+            "wal_autocheckpoint": 10000,
+        },
+        checkpoint_interval=60,
+        defer_indexes=True,
+        defer_foreign_keys=True,
+    ),
+}
+# pragmas that only tune performance. the rest of them are left alone, the
+# schema and the search index rely on their values
+TUNABLE = {
+    "cache_size",
+    "synchronous",
+    "mmap_size",
+    "temp_store",
+    "page_size",
+    "journal_mode",
+    "wal_autocheckpoint",
+    "busy_timeout",
+}
+SETTINGS = {
+    "checkpoint_interval",
+    "defer_indexes",
+    "defer_foreign_keys",
+    "score_history",
+}
+# pragma values end up inside the PRAGMA statement itself
+VALUE = re.compile(r"-?\d+|[A-Za-z_]+")
+
+
+def parse_pragma(name: str, value: Any) -> Pragma:
+    if name not in TUNABLE:
+        print(f'Can\'t set the pragma "{name}", only {", ".join(sorted(TUNABLE))}.')
+        sys.exit(1)
+    if isinstance(value, bool) or not VALUE.fullmatch(str(value)):
+        print(f'Invalid value "{value}" for the pragma "{name}".')
+        sys.exit(1)
+    return int(value) if str(value).lstrip("-").isdigit() else str(value)
+
+
+def read_config_file(path: Path) -> dict[str, Any]:
+    if sys.version_info >= (3, 11):
+        import tomllib
+    else:
+        import tomli as tomllib
+    try:
+        with path.open("rb") as file:
+            return tomllib.load(file)
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        print(f"Couldn't read the database config {path}: {e}")
+        sys.exit(1)
+
+
+def load_db_config(
+    profile: DB_PROFILE | None = None,
+    path: Path | None = None,
+    pragmas: list[str] | None = None,
+    checkpoint_interval: float | None = None,
+    score_history: bool = False,
+) -> DBConfig:
+    # the profile, then the config file, then flags, each overriding the last
+    values = read_config_file(path) if path else {}
+    profile = profile or values.pop("profile", "default")
+    values.pop("profile", None)
+    if profile not in PROFILES:
+        print(
+            f'Unknown database profile "{profile}", choose from {", ".join(PROFILES)}.'
+        )
+        sys.exit(1)
+    config = PROFILES[profile]
+    overrides = dict(values.pop("pragmas", {}))
+    for pragma in pragmas or ():
+        name, _, value = pragma.partition("=")
+        overrides[name.strip()] = value.strip()
+    unknown = set(values) - SETTINGS
+    if unknown:
+        print(f"Unknown database settings {', '.join(sorted(unknown))} in {path}.")
+        sys.exit(1)
+    if checkpoint_interval is not None:
+        values["checkpoint_interval"] = checkpoint_interval
+    if score_history:
+        values["score_history"] = True
+    return replace(
+        config,
+        **values,
+        pragmas={
+            **config.pragmas,
+            **{name: parse_pragma(name, value) for name, value in overrides.items()},
+        },
+    )
@@ -1,21 +1,383 @@
+from __future__ import annotations
+
 import argparse
 import logging
 import sys
-from typing import get_args
+from datetime import date
+from pathlib import Path
+from typing import TYPE_CHECKING, get_args
 
-from reddit_scraper import __version__, DEFAULT_UA, SORT_TYPE
+from reddit_scraper import (
+    BACKEND_TYPE,
+    DB_PATH,
+    DB_PROFILE,
+    DEDUP_TYPE,
+    DEFAULT_UA,
+    EXPORT_FORMAT,
+    EXPORT_TABLE,
+    MEASUREMENT,
+    SORT_TYPE,
+)
 from reddit_scraper import main
+from reddit_scraper.dbconfig import load_db_config
+from reddit_scraper.jobs import make_jobs, read_job_file
+
+# search and export pull in peewee, and bench multiprocessing, as soon as they
+# are imported, so they are only imported once one of them was asked for
+if TYPE_CHECKING:
+    from reddit_scraper import bench, export, importer, search, shards
+
+
+class VersionAction(argparse.Action):
+    # argparse's own version action wants the version up front, looking it up
+    # costs more than parsing the arguments
+    def __init__(self, option_strings: list[str], dest: str, **kwargs) -> None:
+        super().__init__(option_strings, dest, nargs=0, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None) -> None:
+        from reddit_scraper import __version__
+
+        print(f"reddit-scraper {__version__}")
+        parser.exit()
+
+
+def add_db_arguments(parser) -> None:
+    # also accepted after the command. suppressed, so the value given before
+    # the command isn't overwritten by a default
+    parser.add_argument(
+        "--db",
+        dest="db",
+        type=Path,
+        default=argparse.SUPPRESS,
+        help=f'database file to read. defaults to "{DB_PATH}".',
+    )
+    parser.add_argument(
+        "--shards",
+        dest="shards",
+        default=False,
+        action="store_true",
+        help="read every shard of --db written by a --shards run at once, without"
+        " merging them first.",
+    )
+
+
+def add_search_parser(subparsers) -> None:
+    parser = subparsers.add_parser(
+        "search",
+        help="full text search through archived posts or comments",
+        description="full text search through archived posts or comments, best matches"
+        ' first. the query uses SQLite FTS5 syntax, e.g. "rust AND (async OR tokio)".',
+    )
+    parser.add_argument("query", nargs="?", help="what to search for")
+    parser.add_argument(
+        "-c",
+        "--comments",
+        dest="comments",
+        default=False,
+        action="store_true",
+        help="search comment bodies instead of post titles and text",
+    )
+    parser.add_argument(
+        "-s",
+        "--subreddit",
+        dest="subreddit",
+        help="only show results from this subreddit",
+    )
+    parser.add_argument(
+        "-n",
+        "--limit",
+        dest="limit",
+        default=20,
+        type=int,
+        help="number of results to show. defaults to 20.",
+    )
+    parser.add_argument(
+        "--rebuild",
+        dest="rebuild",
+        default=False,
+        action="store_true",
+        help="create the search index, or rebuild it from scratch. once created it is"
+        " kept up to date automatically.",
+    )
+    add_db_arguments(parser)
+
+
+def add_export_parser(subparsers) -> None:
+    parser = subparsers.add_parser(
+        "export",
+        help="stream archived posts or comments into ndjson, parquet or arrow files",
+        description="stream archived posts or comments into ndjson, parquet or arrow"
+        " files. parquet and arrow need pyarrow, installed by"
+        " pip install reddit-scraper[export].",
+    )
+    parser.add_argument(
+        "table",
+        choices=get_args(EXPORT_TABLE),
+        help="what to export",
+    )
+    parser.add_argument(
+        "out",
+        type=Path,
+        help="file to export into, or a directory when using --partition",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        dest="file_format",
+        default="ndjson",
+        choices=get_args(EXPORT_FORMAT),
+        help='file format. defaults to "ndjson".',
+    )
+    parser.add_argument(
+        "-s",
+        "--subreddit",
+        dest="subreddits",
+        nargs="+",
+        help="only export these subreddits",
+    )
+    parser.add_argument(
+        "--since",
+        dest="since",
+        type=date.fromisoformat,
+        help="only export items created on or after this day, as YYYY-MM-DD",
+    )
+    parser.add_argument(
+        "--until",
+        dest="until",
+        type=date.fromisoformat,
+        help="only export items created before this day, as YYYY-MM-DD",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        dest="batch_size",
+        default=10000,
+        type=int,
+        help="rows held in memory before being written out. defaults to 10000.",
+    )
+    parser.add_argument(
+        "-p",
+        "--partition",
+        dest="partition",
+        default=False,
+        action="store_true",
+        help="write one file per subreddit and day. partitions finished by an earlier"
+        " run are skipped, so an interrupted export can just be started again.",
+    )
+    add_db_arguments(parser)
+
+
+def add_merge_parser(subparsers) -> None:
+    parser = subparsers.add_parser(
+        "merge",
+        help="combine the shards written by a --shards run into one database",
+        description="copy the posts, comments, checkpoints and queued work of every"
+        " shard into --db. posts already in --db are replaced by the shard's copy.",
+    )
+    parser.add_argument(
+        "shards",
+        nargs="*",
+        type=Path,
+        help="shard files to merge. defaults to every shard of --db.",
+    )
+    parser.add_argument(
+        "--db",
+        dest="db",
+        type=Path,
+        default=argparse.SUPPRESS,
+        help=f'database file to merge into. defaults to "{DB_PATH}".',
+    )
+
+
+def add_import_parser(subparsers) -> None:
+    parser = subparsers.add_parser(
+        "import",
+        help="import historical pushshift-style ndjson dumps into the archive",
+        description="stream posts and comments from ndjson dumps, zstd compressed"
+        " (.zst) or not, into --db. rows already in --db are kept as they are, so an"
+        " interrupted import can just be started again. comments are only imported"
+        " once their post is in --db, so give the submissions dump first.",
+    )
+    parser.add_argument(
+        "files",
+        nargs="+",
+        type=Path,
+        help="dump files to import, in this order",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        type=int,
+        default=0,
+        help="processes decoding the dump while the main one writes. defaults to 0,"
+        " decoding in the main process.",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        dest="batch_size",
+        default=10000,
+        type=int,
+        help="lines written in each transaction. defaults to 10000.",
+    )
+    parser.add_argument(
+        "--db",
+        dest="db",
+        type=Path,
+        default=argparse.SUPPRESS,
+        help=f'database file to import into. defaults to "{DB_PATH}".',
+    )
 
 
-def parse_args(args) -> main.Options:
+def add_bench_parser(subparsers) -> None:
+    parser = subparsers.add_parser(
+        "bench",
+        help="measure scraping throughput offline, against a fake reddit api",
+        description="run the whole scraper against a fake reddit api serving synthetic"
+        " posts and comment trees, and report posts/s, comments/s, requests per post"
+        " and peak memory for each scenario. nothing touches the real reddit or your"
+        " database.",
+    )
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        help="scenarios to run: baseline, deep, skip-comments or throttled."
+        " runs all of them by default.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        type=int,
+        help="override the number of threads expanding comment trees",
+    )
+    parser.add_argument(
+        "--backend",
+        dest="backends",
+        nargs="+",
+        default=["sync"],
+        choices=get_args(BACKEND_TYPE),
+        help="backends to run every scenario with, to compare them."
+        ' defaults to "sync".',
+    )
+    parser.add_argument(
+        "--db-profile",
+        dest="profiles",
+        nargs="+",
+        choices=get_args(DB_PROFILE),
+        help="database profiles to run every scenario with, to compare them."
+        ' defaults to "default", or every profile with --ingest.',
+    )
+    parser.add_argument(
+        "-n",
+        "--posts",
+        dest="posts",
+        type=int,
+        help="override the number of posts scraped per subreddit",
+    )
+    parser.add_argument(
+        "--comments",
+        dest="comments",
+        type=int,
+        help="override the number of comments on each post",
+    )
+    parser.add_argument(
+        "--latency",
+        dest="latency",
+        type=float,
+        help="override the seconds the fake api waits before answering each request",
+    )
+    parser.add_argument(
+        "--error-rate",
+        dest="error_rate",
+        type=float,
+        help="override the share of requests answered with 429 too many requests",
+    )
+    parser.add_argument(
+        "--out",
+        dest="out",
+        type=Path,
+        help="also save the results as json into this file",
+    )
+    parser.add_argument(
+        "--importtime",
+        dest="importtime",
+        default=False,
+        action="store_true",
+        help="instead of scraping, check that commands which don't scrape start"
+        " without importing praw or peewee and within --budget, using python -X"
+        " importtime. exits with an error otherwise.",
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        dest="tracemalloc",
+        default=False,
+        action="store_true",
+        help="instead of scraping, trace the python memory taken by the records of"
+        " one thread with 10000 comments, while they are built and written.",
+    )
+    parser.add_argument(
+        "--ingest",
+        dest="ingest",
+        default=False,
+        action="store_true",
+        help="instead of scraping, write synthetic posts straight into a temporary"
+        " database with each --db-profile and report the write throughput, peak WAL"
+        " size and final database size. -n sets the number of posts (2000) and"
+        " --comments the comments on each (50).",
+    )
+    parser.add_argument(
+        "--import",
+        dest="import_dump",
+        default=False,
+        action="store_true",
+        help="instead of scraping, write the same synthetic posts into zstd"
+        " compressed pushshift-style dumps, then time rdscp import reading them"
+        " with each --db-profile, twice. -w sets its worker processes.",
+    )
+    parser.add_argument(
+        "--measure",
+        dest="measure",
+        nargs="+",
+        default=[],
+        choices=get_args(MEASUREMENT),
+        help="instead of scraping, time database operations on a temporary"
+        " database. write compares batched comment upserts with one insert per"
+        " row, seen the startup time and memory of each --dedup backend, search"
+        " the full-text index with a LIKE scan, export streamed rows with model"
+        " instances, migrate upgrades a database from schema version 0. -n sets"
+        " the number of rows.",
+    )
+    parser.add_argument(
+        "--budget",
+        dest="budget",
+        default=None,
+        type=float,
+        help="milliseconds each of those commands may spend importing. defaults"
+        " to three times what the standard library modules they need take to"
+        " import in the same run, so it scales with the machine.",
+    )
+
+
+def parse_args(
+    args,
+) -> (
+    main.Options
+    | search.SearchOptions
+    | export.ExportOptions
+    | shards.MergeOptions
+    | importer.ImportOptions
+    | bench.BenchOptions
+):
     parser = argparse.ArgumentParser(
         prog="rdscp",
     )
     parser.add_argument(
         "-V",
         "--version",
-        action="version",
-        version=f"reddit-scraper {__version__}",
+        action=VersionAction,
+        help="show program's version number and exit",
     )
     parser.add_argument(
         "-q",
@@ -36,9 +398,11 @@ def parse_args(args) -> main.Options:
     parser.add_argument(
         "-s",
         "--subreddit",
-        dest="subreddit",
-        default="test",
-        help='select subreddit, does NOT include the leading the r/. defaults to "test"',
+        dest="subreddits",
+        default=["test"],
+        nargs="+",
+        help="select subreddits, does NOT include the leading the r/."
+        ' defaults to "test"',
     )
     parser.add_argument(
         "-n",
@@ -52,11 +416,21 @@ def parse_args(args) -> main.Options:
     parser.add_argument(
         "-o",
         "--sort",
-        dest="sort_type",
-        default="hot",
+        dest="sort_types",
+        default=["hot"],
+        nargs="+",
         choices=sort_types,
         help=f'type of sort to use on the selected sub. options are: "{'", "'.join(sort_types[:-1])}", or "{sort_types[-1]}".',
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="job_file",
+        type=Path,
+        help="read jobs from a file instead of -s/-o, one"
+        ' "subreddit [sort] [number of posts]" per line. missing values fall back'
+        " to -o and -n.",
+    )
     parser.add_argument(
         "-c",
         "--clear",
@@ -73,6 +447,165 @@ def parse_args(args) -> main.Options:
         action="store_true",
         help="skips comments from posts",
     )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        dest="incremental",
+        default=False,
+        action="store_true",
+        help="stop paging through new listings once reaching the newest post archived"
+        " by the last run, instead of skipping over everything archived before.",
+    )
+    parser.add_argument(
+        "-r",
+        "--refresh",
+        dest="refresh",
+        default=False,
+        action="store_true",
+        help="also re-fetch comments of already archived posts whose comment count grew"
+        " since they were archived, biggest growth first.",
+    )
+    parser.add_argument(
+        "--more-requests",
+        dest="more_requests",
+        type=int,
+        help="maximum number of requests spent loading hidden comments of one post."
+        " whatever is left is saved for --fill-stubs. unlimited by default.",
+    )
+    parser.add_argument(
+        "--more-seconds",
+        dest="more_seconds",
+        type=float,
+        help="maximum number of seconds spent loading hidden comments of one post."
+        " whatever is left is saved for --fill-stubs. unlimited by default.",
+    )
+    parser.add_argument(
+        "--max-depth",
+        dest="max_depth",
+        type=int,
+        help="don't load hidden comments nested deeper than this, saving them for"
+        " --fill-stubs instead. unlimited by default.",
+    )
+    parser.add_argument(
+        "--fill-stubs",
+        dest="fill_stubs",
+        default=False,
+        action="store_true",
+        help="instead of scraping new posts, load the hidden comments left behind by"
+        " --more-requests, --more-seconds or --max-depth, still within those limits.",
+    )
+    parser.add_argument(
+        "--drain-only",
+        dest="drain_only",
+        default=False,
+        action="store_true",
+        help="only fetch posts waiting in the work queue, left by an interrupted run or"
+        " queued by other processes scraping into the same database, without reading"
+        " any listing. waits while other processes are still working.",
+    )
+    parser.add_argument(
+        "--dedup",
+        dest="dedup",
+        default="memory",
+        choices=get_args(DEDUP_TYPE),
+        help="how to check for already archived posts."
+        ' "memory" loads every id into a set, "compact" keeps them as a sorted'
+        ' integer array for huge archives, "lazy" looks each candidate up in the'
+        ' database instead. defaults to "memory".',
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        default=1,
+        type=int,
+        help="number of threads expanding comment trees at once. all of them share"
+        " reddit's rate limit. defaults to 1.",
+    )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        default="sync",
+        choices=get_args(BACKEND_TYPE),
+        help='"async" fetches with asyncpraw on one event loop, running the listings of'
+        " every job and -w posts at once as coroutines instead of threads. needs"
+        ' pip install reddit-scraper[async]. defaults to "sync".',
+    )
+    parser.add_argument(
+        "--db",
+        dest="db",
+        type=Path,
+        default=DB_PATH,
+        help=f"database file to write to, or to read with a command. defaults to"
+        f' "{DB_PATH}" in the current directory.',
+    )
+    parser.add_argument(
+        "--shards",
+        dest="shards",
+        default=1,
+        type=int,
+        help="scrape with this many processes, splitting the subreddits between them."
+        " each one writes its own database next to --db, e.g."
+        ' "reddit-scraper.shard0.db". combine them with rdscp merge. defaults to 1.',
+    )
+    parser.add_argument(
+        "--db-profile",
+        dest="db_profile",
+        choices=get_args(DB_PROFILE),
+        help='sqlite settings to write with. "bulk-ingest" trades durability against'
+        " power cuts for speed, and defers index building and foreign key checks to"
+        ' the end of the run, for big backfills. defaults to "default".',
+    )
+    parser.add_argument(
+        "--db-config",
+        dest="db_config",
+        type=Path,
+        help="toml file with database settings: profile, pragmas, checkpoint_interval,"
+        " defer_indexes and defer_foreign_keys. flags override it.",
+    )
+    parser.add_argument(
+        "--pragma",
+        dest="pragmas",
+        action="append",
+        metavar="NAME=VALUE",
+        help="set a sqlite pragma such as cache_size, synchronous, mmap_size,"
+        " temp_store, page_size or wal_autocheckpoint. can be repeated.",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        dest="checkpoint_interval",
+        type=float,
+        help="truncate the WAL file every this many seconds while writing, so it"
+        " doesn't keep the size of its biggest burst.",
+    )
+    parser.add_argument(
+        "--score-history",
+        dest="score_history",
+        default=False,
+        action="store_true",
+        help="also keep each new score a post or comment is scraped with, with the"
+        " time it was seen, in the ScoreHistory table.",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        dest="stats_interval",
+        type=float,
+        help="log a summary of throughput, requests and time spent per stage every"
+        " this many seconds.",
+    )
+    parser.add_argument(
+        "--stats-file",
+        dest="stats_file",
+        type=Path,
+        help="save counters and time spent per stage as json into this file on exit.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        dest="metrics_port",
+        type=int,
+        help="serve the same statistics for prometheus on"
+        " http://127.0.0.1:PORT/metrics while running.",
+    )
     parser.add_argument(
         "--id",
         dest="client_id",
@@ -90,24 +623,131 @@ def parse_args(args) -> main.Options:
         default=DEFAULT_UA,
         help=f'set your user agent. defaults to "{DEFAULT_UA}".',
     )
+    subparsers = parser.add_subparsers(dest="command", title="commands")
+    add_search_parser(subparsers)
+    add_export_parser(subparsers)
+    add_merge_parser(subparsers)
+    add_import_parser(subparsers)
+    add_bench_parser(subparsers)
     parsed_args = parser.parse_args(args)
 
     if not parsed_args.loglevel:
         parsed_args.loglevel = logging.INFO
 
+    if parsed_args.command == "search":
+        from reddit_scraper import search
+
+        return search.SearchOptions(
+            loglevel=parsed_args.loglevel,
+            query=parsed_args.query,
+            comments=parsed_args.comments,
+            subreddit=parsed_args.subreddit,
+            limit=parsed_args.limit,
+            rebuild=parsed_args.rebuild,
+            db=parsed_args.db,
+            shards=parsed_args.shards,
+        )
+    if parsed_args.command == "export":
+        from reddit_scraper import export
+
+        return export.ExportOptions(
+            loglevel=parsed_args.loglevel,
+            table=parsed_args.table,
+            file_format=parsed_args.file_format,
+            out=parsed_args.out,
+            subreddits=parsed_args.subreddits,
+            since=parsed_args.since,
+            until=parsed_args.until,
+            batch_size=parsed_args.batch_size,
+            partition=parsed_args.partition,
+            db=parsed_args.db,
+            shards=parsed_args.shards,
+        )
+    db_config = load_db_config(
+        parsed_args.db_profile,
+        parsed_args.db_config,
+        parsed_args.pragmas,
+        parsed_args.checkpoint_interval,
+        parsed_args.score_history,
+    )
+    if parsed_args.command == "merge":
+        from reddit_scraper import shards
+
+        return shards.MergeOptions(
+            loglevel=parsed_args.loglevel,
+            db=parsed_args.db,
+            shards=parsed_args.shards,
+            db_config=db_config,
+        )
+    if parsed_args.command == "import":
+        from reddit_scraper import importer
+
+        return importer.ImportOptions(
+            loglevel=parsed_args.loglevel,
+            files=parsed_args.files,
+            workers=parsed_args.workers,
+            batch_size=parsed_args.batch_size,
+            db=parsed_args.db,
+            db_config=db_config,
+        )
+    if parsed_args.command == "bench":
+        from reddit_scraper import bench
+
+        return bench.BenchOptions(
+            loglevel=parsed_args.loglevel,
+            scenarios=parsed_args.scenarios,
+            workers=parsed_args.workers,
+            backends=parsed_args.backends,
+            posts=parsed_args.posts,
+            comments=parsed_args.comments,
+            latency=parsed_args.latency,
+            error_rate=parsed_args.error_rate,
+            out=parsed_args.out,
+            importtime=parsed_args.importtime,
+            budget=parsed_args.budget,
+            tracemalloc=parsed_args.tracemalloc,
+            ingest=parsed_args.ingest,
+            import_dump=parsed_args.import_dump,
+            measure=parsed_args.measure,
+            profiles=parsed_args.profiles,
+        )
+
     creds = main.RedditCredentials(
         client_id=parsed_args.client_id,
         api_key=parsed_args.api_key,
         user_agent=parsed_args.user_agent,
     )
 
+    if parsed_args.job_file:
+        jobs = read_job_file(
+            parsed_args.job_file, parsed_args.sort_types[0], parsed_args.num_posts
+        )
+    else:
+        jobs = make_jobs(
+            parsed_args.subreddits, parsed_args.sort_types, parsed_args.num_posts
+        )
+
     options = main.Options(
         loglevel=parsed_args.loglevel,
-        subreddit=parsed_args.subreddit,
-        num_posts=parsed_args.num_posts,
+        jobs=jobs,
         to_clear=parsed_args.to_clear,
-        sort_type=parsed_args.sort_type,
         skip_comments=parsed_args.skip_comments,
+        dedup=parsed_args.dedup,
+        workers=parsed_args.workers,
+        incremental=parsed_args.incremental,
+        refresh=parsed_args.refresh,
+        more_requests=parsed_args.more_requests,
+        more_seconds=parsed_args.more_seconds,
+        max_depth=parsed_args.max_depth,
+        fill_stubs=parsed_args.fill_stubs,
+        drain_only=parsed_args.drain_only,
+        backend=parsed_args.backend,
+        db=parsed_args.db,
+        shards=max(parsed_args.shards, 1),
+        db_config=db_config,
+        stats_interval=parsed_args.stats_interval,
+        stats_file=parsed_args.stats_file,
+        metrics_port=parsed_args.metrics_port,
         creds=creds,
     )
     return options
@@ -116,12 +756,17 @@ def parse_args(args) -> main.Options:
 def setup_logging(loglevel) -> None:
     logformat = "%(levelname)s: %(message)s"
     logging.basicConfig(level=loglevel, stream=sys.stdout, format=logformat)
+    # peewee logs every query with all of its parameters at debug level, which
+    # for bulk inserts costs more than the inserts themselves
+    logging.getLogger("peewee").setLevel(logging.INFO)
 
 
 def enter_main(argses) -> None:
     args = parse_args(argses)
     setup_logging(args.loglevel)
-    main.run(args)
+    # every command's module has a run() taking its options, and parse_args
+    # already imported the module of the command that was asked for
+    sys.modules[type(args).__module__].run(args)
 
 
 def run() -> None:
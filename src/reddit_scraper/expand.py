@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+from heapq import heappop, heappush
+import time
+from typing import TYPE_CHECKING, Any, Generator, Iterable
+
+import praw
+from praw.models import Comment, MoreComments, Submission
+
+from reddit_scraper import logger
+
+if TYPE_CHECKING:
+    from .main import Options
+
+
+def expand_comments(
+    post: Submission, options: Options
+) -> tuple[list[Comment], list[MoreComments]]:
+    return expand_more(post.comments, options)
+
+
+def expand_more(
+    items: Iterable[Comment | MoreComments], options: Options
+) -> tuple[list[Comment], list[MoreComments]]:
+    steps = expansion(items, options, MoreComments)
+    try:
+        stub = next(steps)
+        while True:
+            stub = steps.send(stub.comments())
+    except StopIteration as done:
+        return done.value
+
+
+def expansion(
+    items: Iterable[Any], options: Options, more_type: type
+) -> Generator[Any, Iterable[Any], tuple[list[Any], list[Any]]]:
+    # like CommentForest.replace_more, but the comments are only needed as a flat
+    # list, so nothing is spliced back into the tree and the loop can stop at any
+    # point, handing back the MoreComments it did not get to. it yields each
+    # MoreComments to load and is sent back its comments, so the sync and async
+    # backends share it. more_type is the MoreComments class of their library
+    comments: list[Any] = []
+    names: set[str] = set()
+    more: list[Any] = []
+    skipped: list[Any] = []
+
+    def collect(new_items: Iterable[Any]) -> None:
+        stack = list(new_items)
+        while stack:
+            item = stack.pop()
+            if isinstance(item, more_type):
+                heappush(more, item)
+            elif item.name not in names:
+                names.add(item.name)
+                comments.append(item)
+                stack.extend(item.replies)
+
+    collect(items)
+    requests = 0
+    started = time.monotonic()
+    while more:
+        if over_budget(requests, started, options):
+            skipped.extend(more)
+            break
+        stub = heappop(more)
+        if options.max_depth is not None and stub_depth(stub) > options.max_depth:
+            skipped.append(stub)
+            continue
+        collect((yield stub))
+        requests += 1
+
+    if skipped:
+        logger.debug(
+            f"left {len(skipped)} unexpanded comment stubs after {requests} requests"
+        )
+    return comments, skipped
+
+
+def over_budget(requests: int, started: float, options: Options) -> bool:
+    if options.more_requests is not None and requests >= options.more_requests:
+        return True
+    return (
+        options.more_seconds is not None
+        and time.monotonic() - started >= options.more_seconds
+    )
+
+
+def stub_depth(stub: Any) -> int:
+    return getattr(stub, "depth", 0)
+
+
+def serialize_stubs(stubs: list[Any], post_id: str) -> list[dict[str, Any]]:
+    return [
+        {
+            "post": post_id,
+            "parent_id": stub.parent_id,
+            "depth": stub_depth(stub),
+            "count": stub.count,
+            "children": ",".join(stub.children),
+        }
+        for stub in stubs
+    ]
+
+
+def load_stubs(
+    api: praw.Reddit, submission: Submission, rows: list[dict[str, Any]]
+) -> list[MoreComments]:
+    stubs = []
+    for row in rows:
+        stub = MoreComments(
+            api,
+            {
+                "parent_id": row["parent_id"],
+                "depth": row["depth"],
+                "count": row["count"],
+                "children": row["children"].split(",") if row["children"] else [],
+            },
+        )
+        stub.submission = submission
+        stubs.append(stub)
+    return stubs
@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import date, datetime, time
+import json
+from pathlib import Path
+import sys
+from typing import Any, Iterator
+
+from peewee import (
+    JOIN,
+    BooleanField,
+    DateTimeField,
+    Field,
+    FloatField,
+    ForeignKeyField,
+    IntegerField,
+    Model,
+)
+
+from reddit_scraper import EXPORT_FORMAT, EXPORT_TABLE, logger
+from .database import Author, RedditComment, RedditPost, Subreddit
+from .migrations import setup_db
+from .shards import open_shards
+
+MODELS: dict[str, type[Model]] = {"posts": RedditPost, "comments": RedditComment}
+# exported under their own name, with the value looked up from the interned table
+INTERNED = (Author, Subreddit)
+Column = tuple[str, Field]
+
+
+@dataclass
+class ExportOptions:
+    loglevel: int | None
+    table: EXPORT_TABLE
+    file_format: EXPORT_FORMAT
+    out: Path
+    subreddits: list[str] | None
+    since: date | None
+    until: date | None
+    batch_size: int
+    partition: bool
+    db: Path
+    shards: bool
+
+
+class NdjsonWriter:
+    def __init__(self, path: Path, columns: list[Column]) -> None:
+        self.names = [name for name, _ in columns]
+        self.file = path.open("w", encoding="utf-8")
+
+    def write(self, rows: list[tuple]) -> None:
+        for row in rows:
+            record = {
+                name: value.isoformat() if isinstance(value, datetime) else value
+                for name, value in zip(self.names, row)
+            }
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ArrowWriter:
+    def __init__(
+        self, path: Path, columns: list[Column], file_format: EXPORT_FORMAT
+    ) -> None:
+        self.pa = import_pyarrow()
+        self.schema = self.pa.schema(
+            [(name, arrow_type(self.pa, field)) for name, field in columns]
+        )
+        if file_format == "parquet":
+            import pyarrow.parquet
+
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = self.pa.ipc.new_file(str(path), self.schema)
+
+    def write(self, rows: list[tuple]) -> None:
+        columns = list(zip(*rows))
+        batch = self.pa.RecordBatch.from_arrays(
+            [
+                self.pa.array(column, type=field.type)
+                for column, field in zip(columns, self.schema)
+            ],
+            schema=self.schema,
+        )
+        self.writer.write_batch(batch)
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+def import_pyarrow() -> Any:
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        print(
+            "Exporting to parquet or arrow needs pyarrow, install it with:\n"
+            "   pip install reddit-scraper[export]"
+        )
+        sys.exit(1)
+    return pyarrow
+
+
+def arrow_type(pa: Any, field: Field) -> Any:
+    if isinstance(field, BooleanField):
+        return pa.bool_()
+    if isinstance(field, IntegerField):
+        return pa.int64()
+    if isinstance(field, FloatField):
+        return pa.float64()
+    if isinstance(field, DateTimeField):
+        return pa.timestamp("s")
+    return pa.string()
+
+
+def make_writer(
+    path: Path, columns: list[Column], file_format: EXPORT_FORMAT
+) -> NdjsonWriter | ArrowWriter:
+    if file_format == "ndjson":
+        return NdjsonWriter(path, columns)
+    return ArrowWriter(path, columns, file_format)
+
+
+def export_columns(model: type[Model]) -> list[Column]:
+    columns = []
+    for field in model._meta.sorted_fields:
+        # only there to tell whether a scraped row changed
+        if field is model.content_hash:
+            continue
+        if isinstance(field, ForeignKeyField) and field.rel_model in INTERNED:
+            columns.append((field.name, field.rel_model.name))
+        else:
+            columns.append((field.column_name, field))
+    return columns
+
+
+def query_rows(options: ExportOptions) -> tuple[list[Column], Iterator[tuple]]:
+    model = MODELS[options.table]
+    columns = export_columns(model)
+    query = (
+        model.select(*(field for _, field in columns))
+        .join(Subreddit, on=model.subreddit == Subreddit.id)
+        .switch(model)
+        .join(Author, JOIN.LEFT_OUTER, on=model.author == Author.id)
+    )
+    if options.subreddits:
+        query = query.where(Subreddit.name.in_(options.subreddits))
+    if options.since:
+        since = datetime.combine(options.since, time())
+        query = query.where(model.created_utc >= since)
+    if options.until:
+        until = datetime.combine(options.until, time())
+        query = query.where(model.created_utc < until)
+    if options.partition:
+        # ordering by the subreddit id keeps each subreddit's rows together just
+        # the same, and can walk the (subreddit, created_utc) index
+        query = query.order_by(model.subreddit, model.created_utc)
+    else:
+        query = query.order_by(model.created_utc)
+    # iterator() streams rows straight off the cursor instead of caching them
+    return columns, query.tuples().iterator()
+
+
+def partition_path(options: ExportOptions, subreddit: str, day: date) -> Path:
+    filename = f"{day.isoformat()}.{options.file_format}"
+    return options.out / options.table / subreddit / filename
+
+
+def export(options: ExportOptions) -> None:
+    columns, rows = query_rows(options)
+    subreddit_at = next(i for i, (name, _) in enumerate(columns) if name == "subreddit")
+    created_at = next(i for i, (name, _) in enumerate(columns) if name == "created_utc")
+    writer = None
+    path = partial = None
+    key = None
+    skipping = False
+    batch: list[tuple] = []
+    written = files = skipped = 0
+
+    def finish() -> None:
+        nonlocal writer, written, files
+        if writer:
+            if batch:
+                writer.write(batch)
+                written += len(batch)
+                batch.clear()
+            writer.close()
+            partial.replace(path)
+            files += 1
+            writer = None
+
+    try:
+        for row in rows:
+            if options.partition:
+                row_key = (row[subreddit_at], row[created_at].date())
+                if row_key != key:
+                    finish()
+                    key = row_key
+                    path = partition_path(options, *key)
+                    skipping = path.exists()
+                    if not skipping:
+                        partial = path.with_name(path.name + ".part")
+                        partial.parent.mkdir(parents=True, exist_ok=True)
+                        writer = make_writer(partial, columns, options.file_format)
+                if skipping:
+                    skipped += 1
+                    continue
+            elif writer is None:
+                path = options.out
+                partial = path.with_name(path.name + ".part")
+                path.parent.mkdir(parents=True, exist_ok=True)
+                writer = make_writer(partial, columns, options.file_format)
+            batch.append(row)
+            if writer and len(batch) >= options.batch_size:
+                writer.write(batch)
+                written += len(batch)
+                batch.clear()
+        finish()
+    finally:
+        if writer:
+            writer.close()
+    if skipped:
+        logger.info(f"Skipped {skipped} rows in partitions exported by an earlier run.")
+    print(f"Exported {written} {options.table} into {files} files.")
+
+
+def run(options: ExportOptions) -> None:
+    if options.shards:
+        open_shards(options.db)
+    else:
+        setup_db(options.db)
+    if not MODELS[options.table].select().exists():
+        print("The database has nothing to export yet.")
+        sys.exit(1)
+    export(options)
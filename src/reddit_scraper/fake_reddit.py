@@ -0,0 +1,393 @@
+from __future__ import annotations
+
+import asyncio
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
+import json
+import random
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Coroutine, Generator
+from urllib.parse import urlparse
+
+if TYPE_CHECKING:
+    from requests import Response
+
+# stands in for the requests.Session under prawcore, or the aiohttp session
+# under asyncprawcore, so praw, the rate limiter and everything after them run
+# unchanged against synthetic listings and comment trees. ids encode where
+# they came from, so nothing has to be stored: a post id is its subreddit
+# number * POSTS_PER_SUB + its place in the listing, a comment id is its post
+# id * COMMENTS_PER_POST + its place in the tree
+POSTS_PER_SUB = 10**7
+COMMENTS_PER_POST = 10**6
+# reddit hands out at most this many comments per /api/morechildren call
+MORECHILDREN_LIMIT = 100
+START_UTC = 1_700_000_000
+
+LISTING = re.compile(r"/r/(?P<subreddit>[^/]+)/(?P<sort>[a-z]+)/?")
+SUBMISSION = re.compile(r"/comments/(?P<id>[0-9a-z]+)/?")
+
+
+@dataclass
+class FakeConfig:
+    # listing length, reddit stops serving listings at about 1000 posts
+    posts: int = 1000
+    comments: int = 50
+    depth: int = 4
+    # comments sent with the submission, the rest hide behind MoreComments
+    inline: int = 20
+    latency: float = 0.0
+    # share of requests answered with a 429
+    error_rate: float = 0.0
+    retry_after: float = 0.05
+    # requests per second allowed by the rate limit headers, unlimited when None
+    rate_limit: float | None = None
+    seed: int = 0
+
+
+def to_base36(number: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    encoded = ""
+    while number:
+        number, digit = divmod(number, 36)
+        encoded = digits[digit] + encoded
+    return encoded or "0"
+
+
+class FakeReddit:
+    def __init__(self, config: FakeConfig) -> None:
+        self.config = config
+        self.headers: dict[str, str] = {}
+        self.requests: Counter[str] = Counter()
+        self.throttled = 0
+        self.subreddits: list[str] = []
+        self._random = random.Random(config.seed)
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        pass
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        params: Any = None,
+        data: Any = None,
+        **kwargs: Any,
+    ) -> Response:
+        if self.config.latency:
+            time.sleep(self.config.latency)
+        return make_response(url, *self.handle(url, params, data))
+
+    def handle(
+        self, url: str, params: Any, data: Any
+    ) -> tuple[int, Any, dict[str, str]]:
+        # status, payload and headers of the response, whichever client asked
+        path = urlparse(url).path
+        with self._lock:
+            throttle = self._random.random() < self.config.error_rate
+            if throttle:
+                self.throttled += 1
+        if throttle:
+            return self.respond(
+                429,
+                {"message": "Too Many Requests", "error": 429},
+                {"retry-after": str(self.config.retry_after)},
+            )
+        params = dict(params or {})
+        data = dict(data or {})
+        payload: Any
+        if path == "/api/v1/access_token":
+            kind, payload = "token", self.token()
+        elif path.rstrip("/") == "/api/morechildren":
+            kind, payload = "morechildren", self.morechildren(data)
+        elif match := SUBMISSION.fullmatch(path):
+            kind, payload = "comments", self.submission(match["id"])
+        elif match := LISTING.fullmatch(path):
+            kind, payload = "listing", self.listing(match["subreddit"], params)
+        else:
+            return self.respond(404, {"message": "Not Found", "error": 404})
+        with self._lock:
+            self.requests[kind] += 1
+        return self.respond(200, payload)
+
+    def respond(
+        self,
+        status: int,
+        payload: Any,
+        headers: dict[str, str] | None = None,
+    ) -> tuple[int, Any, dict[str, str]]:
+        # without a rate limit, the headers leave so much room that only the
+        # injected 429s ever slow the client down
+        window = 600
+        rate = self.config.rate_limit
+        remaining = rate * window if rate is not None else 10**9
+        return (
+            status,
+            payload,
+            {
+                "x-ratelimit-remaining": str(remaining),
+                "x-ratelimit-reset": str(window),
+                "x-ratelimit-used": "0",
+                **(headers or {}),
+            },
+        )
+
+    def token(self) -> dict[str, Any]:
+        return {
+            "access_token": "fake-token",
+            "expires_in": 86400,
+            "scope": "*",
+            "token_type": "bearer",
+        }
+
+    def subreddit_number(self, subreddit: str) -> int:
+        with self._lock:
+            if subreddit not in self.subreddits:
+                self.subreddits.append(subreddit)
+            return self.subreddits.index(subreddit) + 1
+
+    def listing(self, subreddit: str, params: dict[str, Any]) -> dict[str, Any]:
+        base = self.subreddit_number(subreddit) * POSTS_PER_SUB
+        start = 0
+        if params.get("after"):
+            start = int(params["after"].split("_", maxsplit=1)[-1], 36) - base + 1
+        end = min(start + int(params.get("limit", 25)), self.config.posts)
+        children = [self.post(base + i) for i in range(start, end)]
+        after = children[-1]["data"]["name"] if end < self.config.posts else None
+        return listing(children, after)
+
+    def post(self, number: int) -> dict[str, Any]:
+        subreddit = self.subreddits[number // POSTS_PER_SUB - 1]
+        post_id = to_base36(number)
+        permalink = f"/r/{subreddit}/comments/{post_id}/"
+        return {
+            "kind": "t3",
+            "data": {
+                "id": post_id,
+                "name": f"t3_{post_id}",
+                "author": f"author{number % 997}",
+                "created_utc": float(START_UTC - number % POSTS_PER_SUB * 60),
+                "distinguished": None,
+                "edited": False,
+                "is_self": True,
+                "locked": False,
+                "num_comments": self.config.comments,
+                "over_18": False,
+                "permalink": permalink,
+                "score": number % 1000,
+                "selftext": f"synthetic post {number} " * 8,
+                "spoiler": False,
+                "stickied": False,
+                "subreddit": subreddit,
+                "title": f"Synthetic post {number}",
+                "upvote_ratio": 0.9,
+                "url": f"https://www.reddit.com{permalink}",
+            },
+        }
+
+    def submission(self, post_id: str) -> list[dict[str, Any]]:
+        number = int(post_id, 36)
+        parents = comment_tree(number, self.config.comments, self.config.depth)
+        shown = min(self.config.inline, len(parents))
+        replies: list[list[dict[str, Any]]] = [[] for _ in range(shown)]
+        top_level: list[dict[str, Any]] = []
+        # children always come after their parent, so walking backwards finishes
+        # each comment's replies before the comment itself is built
+        for index in reversed(range(shown)):
+            thing = self.comment(number, index, parents, replies[index])
+            parent = parents[index]
+            (top_level if parent < 0 else replies[parent]).insert(0, thing)
+        hidden = [
+            to_base36(number * COMMENTS_PER_POST + index)
+            for index in range(shown, len(parents))
+        ]
+        if hidden:
+            top_level.append(more(number, hidden))
+        return [listing([self.post(number)], None), listing(top_level, None)]
+
+    def morechildren(self, data: dict[str, Any]) -> dict[str, Any]:
+        number = int(data["link_id"].split("_", maxsplit=1)[-1], 36)
+        parents = comment_tree(number, self.config.comments, self.config.depth)
+        children = data["children"].split(",")
+        things = [
+            self.comment(number, int(child, 36) % COMMENTS_PER_POST, parents, None)
+            for child in children[:MORECHILDREN_LIMIT]
+        ]
+        if len(children) > MORECHILDREN_LIMIT:
+            things.append(more(number, children[MORECHILDREN_LIMIT:]))
+        return {"json": {"errors": [], "data": {"things": things}}}
+
+    def comment(
+        self,
+        number: int,
+        index: int,
+        parents: tuple[int, ...],
+        replies: list[dict[str, Any]] | None,
+    ) -> dict[str, Any]:
+        comment_id = to_base36(number * COMMENTS_PER_POST + index)
+        parent = parents[index]
+        if parent < 0:
+            parent_id = f"t3_{to_base36(number)}"
+        else:
+            parent_id = f"t1_{to_base36(number * COMMENTS_PER_POST + parent)}"
+        return {
+            "kind": "t1",
+            "data": {
+                "id": comment_id,
+                "name": f"t1_{comment_id}",
+                "author": f"author{(number + index) % 997}",
+                "body": f"synthetic comment {index} on post {number} " * 4,
+                "created_utc": float(START_UTC - number % POSTS_PER_SUB * 60 + index),
+                "depth": comment_depth(parents, index),
+                "distinguished": None,
+                "edited": False,
+                "link_id": f"t3_{to_base36(number)}",
+                "parent_id": parent_id,
+                "replies": listing(replies, None) if replies else "",
+                "saved": False,
+                "score": index % 100,
+                "stickied": False,
+                "subreddit": self.subreddits[number // POSTS_PER_SUB - 1],
+            },
+        }
+
+
+class AsyncFakeReddit:
+    # the same fake behind asyncprawcore, which expects an aiohttp.ClientSession
+    def __init__(self, fake: FakeReddit) -> None:
+        self.fake = fake
+        self.headers: dict[str, str] = {}
+        # where asyncprawcore 2 sets the user agent of an aiohttp session
+        self._default_headers = self.headers
+        self.closed = False
+
+    async def close(self) -> None:
+        self.closed = True
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        params: Any = None,
+        data: Any = None,
+        **kwargs: Any,
+    ) -> FakeRequest:
+        return FakeRequest(self.respond(url, params, data))
+
+    async def respond(self, url: str, params: Any, data: Any) -> FakeClientResponse:
+        if self.fake.config.latency:
+            await asyncio.sleep(self.fake.config.latency)
+        status, payload, headers = self.fake.handle(url, params, data)
+        return FakeClientResponse(url, status, json.dumps(payload).encode(), headers)
+
+
+class FakeRequest:
+    # like aiohttp's, awaited by asyncprawcore 2 and entered by 3 and later
+    def __init__(self, response: Coroutine[Any, Any, FakeClientResponse]) -> None:
+        self.response = response
+
+    def __await__(self) -> Generator[Any, None, FakeClientResponse]:
+        return self.response.__await__()
+
+    async def __aenter__(self) -> FakeClientResponse:
+        return await self.response
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        pass
+
+
+@dataclass
+class FakeClientResponse:
+    # the few parts of aiohttp.ClientResponse asyncprawcore reads
+    url: str
+    status: int
+    content: bytes
+    headers: dict[str, str]
+
+    async def json(self) -> Any:
+        # encoded and decoded again like a real response, so the async backend
+        # doesn't get an unfair head start in benchmarks
+        return json.loads(self.content)
+
+    async def text(self) -> str:
+        return self.content.decode()
+
+    def release(self) -> None:
+        pass
+
+
+@lru_cache(maxsize=256)
+def comment_tree(number: int, comments: int, depth: int) -> tuple[int, ...]:
+    # the parent of each comment by index, -1 for top level comments
+    rng = random.Random(number)
+    parents: list[int] = []
+    depths: list[int] = []
+    for _ in range(comments):
+        candidates = len(parents)
+        if candidates and rng.random() < 0.7:
+            parent = rng.randrange(candidates)
+            if depths[parent] + 1 < depth:
+                parents.append(parent)
+                depths.append(depths[parent] + 1)
+                continue
+        parents.append(-1)
+        depths.append(0)
+    return tuple(parents)
+
+
+def comment_depth(parents: tuple[int, ...], index: int) -> int:
+    depth = 0
+    while parents[index] >= 0:
+        index = parents[index]
+        depth += 1
+    return depth
+
+
+def listing(children: list[dict[str, Any]], after: str | None) -> dict[str, Any]:
+    return {
+        "kind": "Listing",
+        "data": {"after": after, "before": None, "children": children},
+    }
+
+
+def more(number: int, children: list[str]) -> dict[str, Any]:
+    return {
+        "kind": "more",
+        "data": {
+            "children": children,
+            "count": len(children),
+            "depth": 0,
+            "id": "_",
+            "name": "t1__",
+            "parent_id": f"t3_{to_base36(number)}",
+        },
+    }
+
+
+def make_response(
+    url: str,
+    status: int,
+    payload: Any,
+    headers: dict[str, str] | None = None,
+) -> Response:
+    from requests import Response
+    from requests.structures import CaseInsensitiveDict
+
+    content = json.dumps(payload).encode()
+    response = Response()
+    response.url = url
+    response.status_code = status
+    response.encoding = "utf-8"
+    response._content = content
+    response.headers = CaseInsensitiveDict(
+        {
+            "content-type": "application/json; charset=UTF-8",
+            "content-length": str(len(content)),
+            **(headers or {}),
+        }
+    )
+    return response
@@ -1,152 +1,444 @@
 from __future__ import annotations
 
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from dataclasses import dataclass
+from itertools import islice
 import sys
+import time
 from typing import TYPE_CHECKING, Any, Generator, Iterator
 import math
-from datetime import datetime
 
 import praw
-from praw.models import Comment, Submission
-from praw.models.comment_forest import CommentForest
-from prawcore import Forbidden, Redirect
+from praw.models import Comment, MoreComments, Submission
+from prawcore import Forbidden, NotFound, Redirect
 
 from reddit_scraper import logger
-from .database import RedditPost
+from .database import (
+    abandoned_work,
+    claim_work,
+    claimable_work,
+    claimed_elsewhere,
+    get_checkpoint,
+    new_comment_count,
+    pending_stubs,
+    release_dead_claims,
+)
+from .expand import expand_comments, expand_more, load_stubs, serialize_stubs
+from .jobs import Job, interleave
+from .metrics import METRICS
+from .records import CommentRecord, PostRecord
+from .ratelimit import RateLimitedRequestor, TokenBucket
+from .seen import SeenSet, make_seen_set
 
 if TYPE_CHECKING:
+    from .database import WorkItem
     from .get_credentials import RedditCredentials
     from .main import Options
 
 
-def create_instance(creds: RedditCredentials) -> praw.Reddit:
+def create_instance(
+    creds: RedditCredentials,
+    session: Any = None,
+    rate_share: float = 1.0,
+    **config: Any,
+) -> praw.Reddit:
+    # session replaces the requests.Session under prawcore, e.g. with FakeReddit
     return praw.Reddit(
         client_id=creds.client_id,
         client_secret=creds.api_key,
         user_agent=creds.user_agent,
+        requestor_class=RateLimitedRequestor,
+        requestor_kwargs={
+            "bucket": TokenBucket(share=rate_share),
+            "session": session,
+        },
+        **config,
     )
 
 
-def get_comment_data(post: Submission) -> list[dict[str, Any]]:
-    post.comments.replace_more(limit=None)
-    comments_list = post.comments.list()
-    return format_comments(comments_list)  # type: ignore
+def get_comment_data(
+    post: Submission, options: Options
+) -> tuple[list[CommentRecord], list[dict[str, Any]]]:
+    with METRICS.timer("expand"):
+        comments_list, stubs = expand_comments(post, options)
+    with METRICS.timer("serialize"):
+        return (
+            format_comments(comments_list, post.name),
+            serialize_stubs(stubs, post.name),
+        )
+
+
+def redditor_name(redditor: Any) -> str | None:
+    # deleted accounts come back as None, and are stored as NULL like the
+    # "[deleted]" authors of imported dumps
+    return None if redditor is None else str(redditor)
 
 
 def format_comments(
-    comments_list: list[Comment] | CommentForest,
-) -> list[dict[str, Any]]:
+    comments_list: list[Comment | MoreComments], post_id: str
+) -> list[CommentRecord]:
+    # comments_list is already flat, so replies must not be descended into again.
+    # this runs for every comment, so skips aren't logged one by one
     serialized = []
     for comment in comments_list:
-        if isinstance(comment, CommentForest):
-            logger.info(
-                f"skipped comment {comment.id} due to comment having unknown children"
-            )
+        if isinstance(comment, MoreComments):
             continue
-        if str(comment.author) == "AutoModerator":
-            logger.debug(
-                f"skipped comment {comment.id} due to being made by automoderator"
-            )
+        author = redditor_name(comment.author)
+        if author == "AutoModerator":
             continue
         serialized.append(
-            {
-                "name": comment.name,
-                "author": str(comment.author),
-                "body": comment.body,
-                "created_utc": datetime.fromtimestamp(comment.created_utc),
-                "distinguished": comment.distinguished,
-                "edited": comment.edited,
-                "parent_id": comment.parent_id,
-                "replies": format_comments(comment.replies) if comment.replies else [],
-                "saved": comment.saved,
-                "score": comment.score,
-                "stickied": comment.stickied,
-                "submission": str(comment.submission),
-                "subreddit": str(comment.subreddit),
-                "depth": comment.depth,
-            }
+            CommentRecord(
+                name=comment.name,
+                author=author,
+                created_utc=int(comment.created_utc),
+                distinguished=comment.distinguished,
+                edited=bool(comment.edited),
+                score=comment.score,
+                subreddit=str(comment.subreddit),
+                post=post_id,
+                parent_id=comment.parent_id,
+                body=comment.body,
+                saved=comment.saved,
+                stickied=comment.stickied,
+                depth=comment.depth,
+            )
         )
     return serialized
 
 
-def get_post_data(post: Submission) -> dict:
-    author = str(post.author)
-    return {
-        "author": author if author != "None" else None,
-        "created_utc": datetime.fromtimestamp(post.created_utc),
-        "distinguished": post.distinguished,
-        "edited": post.edited,
-        "locked": post.locked,
-        "name": post.name,
-        "num_comments": post.num_comments,
-        "over_18": post.over_18,
-        "score": post.score,
-        "is_textual": post.is_self,
-        "selftext": post.selftext,
-        "spoiler": post.spoiler,
-        "subreddit": str(post.subreddit),
-        "title": post.title,
-        "upvote_ratio": post.upvote_ratio,
-        "img_link_or_permalink": post.url,
-    }
+def get_post_data(post: Submission) -> PostRecord:
+    return PostRecord(
+        name=post.name,
+        author=redditor_name(post.author),
+        created_utc=int(post.created_utc),
+        distinguished=post.distinguished,
+        edited=bool(post.edited),
+        score=post.score,
+        subreddit=str(post.subreddit),
+        locked=post.locked,
+        num_comments=post.num_comments,
+        over_18=post.over_18,
+        selftext=post.selftext,
+        is_textual=post.is_self,
+        spoiler=post.spoiler,
+        title=post.title,
+        img_link_or_permalink=post.url,
+        upvote_ratio=post.upvote_ratio,
+    )
 
 
 @dataclass
 class RedditData:
-    post: dict
-    comments: list[dict] | None
-
+    post: PostRecord
+    comments: list[CommentRecord] | None
+    job: Job | None = None
+    # MoreComments left unexpanded, None when comments weren't fetched at all
+    stubs: list[dict] | None = None
 
-def get_db_ids() -> list[str]:
-    if RedditPost.table_exists():
-        ids = RedditPost.select(RedditPost.name).scalars()
-        return list(ids)
-    return []
 
-
-def make_sort(api: praw.Reddit, options: Options) -> Iterator[Submission]:
-    sort = options.sort_type
-    sub = api.subreddit(options.subreddit)
+def make_sort(api: praw.Reddit, job: Job) -> Iterator[Submission]:
+    sort = job.sort_type
+    sub = api.subreddit(job.subreddit)
     sort_time = sort.rsplit("-", maxsplit=1)[-1]
     sort_name = sort.split("-", maxsplit=1)[0]
+    # praw stops listings after 100 posts unless told otherwise
     if sort_name in {"top", "controversial"}:
-        return getattr(sub, sort_name)(time_filter=sort_time)
-    return getattr(sub, sort_name)()
+        return getattr(sub, sort_name)(time_filter=sort_time, limit=None)
+    return getattr(sub, sort_name)(limit=None)
+
+
+@dataclass
+class FoundPost:
+    job: Job
+    post: Submission
+    refresh: bool = False
+    # taken back from the work queue, so nothing of the post is loaded yet
+    resumed: bool = False
+
+
+class ListingScan:
+    # decides what happens to each post of one job's listing. the async backend
+    # walks its listings with async for, so the loop itself stays outside
+    def __init__(
+        self,
+        job: Job,
+        options: Options,
+        seen: SeenSet,
+        refreshes: list[tuple[int, Any]],
+    ) -> None:
+        self.job = job
+        self.options = options
+        self.seen = seen
+        self.refreshes = refreshes
+        self.max_posts = job.num_posts if job.num_posts != -1 else math.inf
+        self.found = 0
+        # set once the listing doesn't need to be read any further
+        self.done = False
+        job.started = time.monotonic()
+        self.incremental = options.incremental and job.sort_type == "new"
+        if options.incremental and not self.incremental:
+            logger.warning(f"Incremental mode only applies to new listings, not {job}.")
+        self.mark = (
+            get_checkpoint(job.subreddit, job.sort_type) if self.incremental else None
+        )
+
+    def visit(self, post: Any) -> FoundPost | None:
+        job, options, mark = self.job, self.options, self.mark
+        if mark and (
+            post.name == mark.name or post.created_utc < mark.created_utc.timestamp()
+        ):
+            logger.info(f"Caught up with posts archived by the last run of {job}.")
+            job.caught_up = True
+            self.done = True
+            return None
+        if self.incremental and (not job.newest or post.created_utc > job.newest[1]):
+            job.newest = (post.name, post.created_utc)
+        if not post.stickied or post.num_comments < 50 or options.skip_comments:
+            if post.name not in self.seen:
+                self.found += 1
+                if self.found > self.max_posts:
+                    self.done = True
+                    return None
+                self.seen.add(post.name)
+                logger.info(f"Found post: {post.name} on r/{str(post.subreddit)}")
+                return FoundPost(job, post)
+            elif options.refresh and (
+                delta := new_comment_count(post.name, post.num_comments)
+            ):
+                self.refreshes.append((delta, post))
+            else:
+                METRICS.count("dedup_hits")
+        else:
+            logger.debug(
+                f"Skipped post: {post.name} on r/{str(post.subreddit)}"
+                " due to being stickied post with tons of comments"
+            )
+        return None
+
+    def finish(self) -> None:
+        self.job.caught_up = True
+        logger.warning(
+            f"Reached end of submissions for {self.job} without reaching target."
+        )
+
+
+def scan_listing(
+    api: praw.Reddit,
+    job: Job,
+    options: Options,
+    seen: SeenSet,
+    refreshes: list[tuple[int, Submission]],
+) -> Iterator[FoundPost]:
+    scan = ListingScan(job, options, seen, refreshes)
+    try:
+        posts = make_sort(api, job)
+        for post in METRICS.timed("listing", posts):
+            found = scan.visit(post)
+            if scan.done:
+                return
+            if found:
+                yield found
+        scan.finish()
+    except Redirect:
+        logger.error(f"Invalid subreddit r/{job.subreddit}. Check if it's not privated")
+    except NotFound:
+        # one subreddit gone missing doesn't stop the other jobs
+        logger.error(f"r/{job.subreddit} doesn't exist or was banned. Skipping it.")
+    except Forbidden:
+        logger.error(f"r/{job.subreddit} is private or quarantined. Skipping it.")
+
+
+def refreshed_posts(job: Job, refreshes: list[tuple[int, Any]]) -> Iterator[FoundPost]:
+    # threads that grew the most go first
+    refreshes.sort(key=lambda refresh: refresh[0], reverse=True)
+    for delta, post in refreshes:
+        logger.info(f"Refreshing post: {post.name} with about {delta} new comments")
+        yield FoundPost(job, post, refresh=True)
+
+
+def find_posts(
+    api: praw.Reddit, job: Job, options: Options, seen: SeenSet
+) -> Iterator[FoundPost]:
+    refreshes: list[tuple[int, Submission]] = []
+    yield from scan_listing(api, job, options, seen, refreshes)
+    yield from refreshed_posts(job, refreshes)
+
+
+# posts kept queued ahead of the fetching, about one listing page, so
+# processes sharing the database have something to claim
+QUEUE_AHEAD = 100
+# posts claimed in one transaction, each claim is a commit of its own
+CLAIM_BATCH = QUEUE_AHEAD // 2
+# how long --drain-only waits for other processes to queue more posts
+DRAIN_POLL = 1.0
+
+
+class WorkFeed:
+    # the work queue side of queued_posts, shared with the async backend
+    def __init__(self, options: Options, seen: SeenSet) -> None:
+        self.options = options
+        self.seen = seen
+        self.jobs = {
+            (job.subreddit.lower(), job.sort_type): job for job in options.jobs
+        }
+        # submissions found here already carry their listing data, fetching them
+        # again would cost a request each when comments are skipped
+        self.found_here: dict[str, FoundPost] = {}
+        self.claim_size = max(CLAIM_BATCH, options.workers * 2)
+        if released := release_dead_claims():
+            logger.info(f"Took back {released} posts claimed by processes that died.")
+        if abandoned := abandoned_work():
+            logger.warning(
+                f"{abandoned} queued posts failed too often and are left alone."
+            )
+
+    def wanted(self) -> int:
+        # how many posts the listings should add, topped up once half of the
+        # queue is claimed so rows are inserted in bulk
+        queued = claimable_work()
+        return QUEUE_AHEAD - queued if queued < QUEUE_AHEAD // 2 else 0
+
+    def claim(self, new: list[FoundPost] | None = None) -> list[WorkItem]:
+        rows = []
+        for found in new or ():
+            self.found_here[found.post.name] = found
+            rows.append(
+                {
+                    "name": found.post.name,
+                    "subreddit": found.job.subreddit,
+                    "sort_type": found.job.sort_type,
+                    "refresh": found.refresh,
+                }
+            )
+        return claim_work(self.claim_size, rows)
+
+    def found(self, item: WorkItem) -> FoundPost | None:
+        # the post as the listing found it, None when it has to be loaded again
+        self.seen.add(item.name)
+        if item.name in self.found_here:
+            return self.found_here.pop(item.name)
+        METRICS.count("queue_resumed")
+        return None
+
+    def resume(self, item: WorkItem, post: Any) -> FoundPost:
+        key = (item.subreddit.lower(), item.sort_type)
+        if key not in self.jobs:
+            self.jobs[key] = Job(item.subreddit, item.sort_type, -1)
+            self.options.jobs.append(self.jobs[key])
+        return FoundPost(self.jobs[key], post, item.refresh, resumed=True)
+
+
+def post_id(name: str) -> str:
+    return name.split("_", maxsplit=1)[-1]
+
+
+def queued_posts(
+    api: praw.Reddit, options: Options, found_posts: Iterator[FoundPost], seen: SeenSet
+) -> Iterator[FoundPost]:
+    # every post found goes through the work queue table before it is fetched,
+    # and only leaves it once it is written, so a run stopped at any point
+    # leaves exactly the unfinished posts behind
+    feed = WorkFeed(options, seen)
+    listing: Iterator[FoundPost] | None = None if options.drain_only else found_posts
+
+    def to_found(item: WorkItem) -> FoundPost:
+        # praw loads the submission on first use, so making it costs nothing
+        return feed.found(item) or feed.resume(
+            item, api.submission(id=post_id(item.name))
+        )
+
+    # whatever an earlier run left behind is fetched before any listing
+    while items := feed.claim():
+        for item in items:
+            yield to_found(item)
+    while True:
+        new: list[FoundPost] = []
+        if listing is not None and (wanted := feed.wanted()):
+            new = list(islice(listing, wanted))
+            if len(new) < wanted:
+                listing = None
+        items = feed.claim(new)
+        for item in items:
+            yield to_found(item)
+        if items or listing is not None:
+            continue
+        if options.drain_only and claimed_elsewhere():
+            # another process may still be walking its listings
+            time.sleep(DRAIN_POLL)
+            continue
+        return
+
+
+def fetch_post(found: FoundPost, options: Options) -> RedditData:
+    post = found.post
+    comment_data: list[CommentRecord] | None = None
+    stubs: list[dict[str, Any]] | None = None
+    if not options.skip_comments:
+        comment_data, stubs = get_comment_data(post, options)
+    with METRICS.timer("serialize"):
+        post_data = get_post_data(post)
+    return RedditData(post_data, comment_data, found.job, stubs)
+
+
+def fetch_concurrently(
+    posts: Iterator[FoundPost], options: Options
+) -> Iterator[RedditData]:
+    # keep a couple of posts queued per worker so the pool never idles on the listing
+    max_pending = options.workers * 2
+    pending: set[Future[RedditData]] = set()
+    pool = ThreadPoolExecutor(options.workers, thread_name_prefix="rdscp-comments")
+    try:
+        for found in posts:
+            pending.add(pool.submit(fetch_post, found, options))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def fill_stubs(api: praw.Reddit, options: Options) -> Generator[RedditData, None, None]:
+    for post_id, rows in pending_stubs():
+        submission = api.submission(id=post_id.split("_", maxsplit=1)[-1])
+        logger.info(f"Filling in {len(rows)} comment stubs of post: {post_id}")
+        with METRICS.timer("expand"):
+            comments_list, stubs = expand_more(
+                load_stubs(api, submission, rows), options
+            )
+        # the submission itself is only loaded once its fields are read here
+        post_data = get_post_data(submission)
+        with METRICS.timer("serialize"):
+            comment_data = format_comments(comments_list, post_id)
+            stub_data = serialize_stubs(stubs, post_id)
+        yield RedditData(post_data, comment_data, stubs=stub_data)
 
 
 def get_posts(api: praw.Reddit, options: Options) -> Generator[Any, None, None]:
-    max_posts = options.num_posts if options.num_posts != -1 else math.inf
-    i = 0
-    ids = get_db_ids()
-    has_broken = False
+    seen = make_seen_set(options.dedup)
+    # a list, so jobs added for posts resumed from the queue get no listing
+    found_posts = interleave(
+        [find_posts(api, job, options, seen) for job in options.jobs]
+    )
+    posts = queued_posts(api, options, found_posts, seen)
+    if options.workers > 1:
+        results = fetch_concurrently(posts, options)
+    else:
+        results = (fetch_post(found, options) for found in posts)
     try:
-        posts = make_sort(api, options)
-        for post in posts:
-            if not post.stickied or post.num_comments < 50 or options.skip_comments:
-                if post.name not in ids:
-                    i += 1
-                    if i > max_posts:
-                        has_broken = True
-                        break
-                    ids.append(post.name)
-                    logger.info(f"Found post: {post.name} on r/{str(post.subreddit)}")
-
-                    if not options.skip_comments:
-                        comment_data = get_comment_data(post)
-                    else:
-                        comment_data = None
-
-                    yield RedditData(get_post_data(post), comment_data)
-                else:
-                    logger.debug(
-                        f"Skipped post: {post.name} on r/{str(post.subreddit)}"
-                        " due to already being archived"
-                    )
-            else:
-                logger.debug(
-                    f"Skipped post: {post.name} on r/{str(post.subreddit)}"
-                    " due to being stickied post with tons of comments"
-                )
+        for data in results:
+            if data.job is not None:
+                data.job.posts += 1
+                data.job.comments += len(data.comments or [])
+            yield data
     except Forbidden:
         logger.error(
             "Recieved 403 forbidden response. Double check your API key and create"
@@ -154,11 +446,3 @@ def get_posts(api: praw.Reddit, options: Options) -> Generator[Any, None, None]:
             "Make sure to select the script type of application."
         )
         sys.exit(1)
-    except Redirect:
-        logger.error(
-            "Invalid subreddit. Check if it's not privated"
-        )
-        sys.exit(1)
-
-    if not has_broken:
-        logger.warn("Reached end of submissions without reaching target.")
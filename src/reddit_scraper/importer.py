@@ -0,0 +1,283 @@
+from __future__ import annotations
+
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+import io
+from itertools import islice
+import json
+import multiprocessing
+from pathlib import Path
+import sys
+import time
+from typing import IO, Any, Iterable, Iterator
+
+from reddit_scraper import logger
+from .database import (
+    COMMENT_FIELDS,
+    DB,
+    POST_FIELDS,
+    RedditComment,
+    RedditPost,
+    checkpoint_wal,
+    finish_ingest,
+    forget_interned,
+    insert_new,
+    start_ingest,
+    stored_depths,
+    stored_posts,
+)
+from .dbconfig import DBConfig
+from .migrations import setup_db
+from .records import CommentRecord, PostRecord
+
+# pushshift dumps are compressed with a window of up to 2 GiB, far over what
+# zstd decompresses by default
+MAX_WINDOW = 2**31
+# author and subreddit ids remembered between batches, before starting over
+INTERNED_LIMIT = 1_000_000
+
+# the records of a batch of lines, how many of the lines were malformed, and
+# how many were comments by AutoModerator, which are left out like when scraping
+ParsedBatch = tuple[list[PostRecord | CommentRecord], int, int]
+
+
+@dataclass
+class ImportOptions:
+    loglevel: int | None
+    files: list[Path]
+    workers: int
+    batch_size: int
+    db: Path
+    db_config: DBConfig
+
+
+def import_zstandard() -> Any:
+    try:
+        import zstandard
+    except ImportError:
+        print(
+            "Importing .zst dumps needs zstandard, install it with:\n"
+            "   pip install reddit-scraper[import]"
+        )
+        sys.exit(1)
+    return zstandard
+
+
+def open_dump(path: Path) -> IO[str]:
+    if path.suffix != ".zst":
+        return path.open(encoding="utf-8", errors="replace")
+    zstandard = import_zstandard()
+    decompressor = zstandard.ZstdDecompressor(max_window_size=MAX_WINDOW)
+    # streamed, only a window's worth of the file is ever decompressed at once
+    reader = decompressor.stream_reader(path.open("rb"))
+    return io.TextIOWrapper(reader, encoding="utf-8", errors="replace")
+
+
+def read_batches(path: Path, batch_size: int) -> Iterator[list[str]]:
+    with open_dump(path) as file:
+        while batch := list(islice(file, batch_size)):
+            yield batch
+
+
+def author_name(record: dict[str, Any]) -> str | None:
+    author = record.get("author")
+    return None if author in (None, "[deleted]") else str(author)
+
+
+def parse_post(record: dict[str, Any]) -> PostRecord:
+    url = record.get("url") or f"https://www.reddit.com{record.get('permalink', '')}"
+    return PostRecord(
+        name=record.get("name") or f"t3_{record['id']}",
+        author=author_name(record),
+        # older dumps store timestamps as strings
+        created_utc=int(float(record["created_utc"])),
+        distinguished=record.get("distinguished"),
+        # either false or the time of the edit
+        edited=bool(record.get("edited")),
+        score=int(record.get("score") or 0),
+        subreddit=str(record["subreddit"]),
+        locked=bool(record.get("locked")),
+        num_comments=int(record.get("num_comments") or 0),
+        over_18=bool(record.get("over_18")),
+        selftext=record.get("selftext"),
+        is_textual=bool(record.get("is_self")),
+        spoiler=bool(record.get("spoiler")),
+        title=record.get("title") or "",
+        img_link_or_permalink=url,
+        upvote_ratio=record.get("upvote_ratio"),
+    )
+
+
+def parse_comment(record: dict[str, Any]) -> CommentRecord:
+    return CommentRecord(
+        name=record.get("name") or f"t1_{record['id']}",
+        author=author_name(record),
+        created_utc=int(float(record["created_utc"])),
+        distinguished=record.get("distinguished"),
+        edited=bool(record.get("edited")),
+        score=int(record.get("score") or 0),
+        subreddit=str(record["subreddit"]),
+        post=record["link_id"],
+        parent_id=record.get("parent_id") or record["link_id"],
+        body=record.get("body"),
+        saved=bool(record.get("saved")),
+        stickied=bool(record.get("stickied")),
+        # None until the comment is written, dumps rarely record it
+        depth=record.get("depth"),
+    )
+
+
+def parse_lines(lines: list[str]) -> ParsedBatch:
+    # runs in the worker processes with -w. only the records come back, which
+    # pickle to a fraction of the json they were decoded from
+    records: list[PostRecord | CommentRecord] = []
+    malformed = skipped = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                malformed += 1
+            elif "link_id" in record:
+                if record.get("author") == "AutoModerator":
+                    skipped += 1
+                    continue
+                records.append(parse_comment(record))
+            else:
+                records.append(parse_post(record))
+        except (ValueError, KeyError, TypeError):
+            malformed += 1
+    return records, malformed, skipped
+
+
+def parse_batches(batches: Iterable[list[str]], workers: int) -> Iterator[ParsedBatch]:
+    if not workers:
+        yield from map(parse_lines, batches)
+        return
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context) as pool:
+        pending: deque[Future[ParsedBatch]] = deque()
+        for lines in batches:
+            pending.append(pool.submit(parse_lines, lines))
+            # a couple of batches per worker in flight keeps them busy, and
+            # memory bounded no matter how large the dump is. results are
+            # taken in order, posts have to be written before their comments
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def with_depths(comments: list[CommentRecord]) -> list[CommentRecord]:
+    # a comment is one deeper than its parent, which is either earlier in the
+    # batch or already in the archive. replies to comments missing from both
+    # are counted as direct replies to one
+    depths = stored_depths(
+        {
+            comment.parent_id
+            for comment in comments
+            if comment.depth is None and comment.parent_id.startswith("t1_")
+        }
+    )
+    resolved = []
+    for comment in comments:
+        depth = comment.depth
+        if depth is None:
+            parent = comment.parent_id
+            depth = depths.get(parent, 0) + 1 if parent.startswith("t1_") else 0
+        depths[comment.name] = depth
+        resolved.append(comment._replace(depth=depth))
+    return resolved
+
+
+def write_batch(records: list[PostRecord | CommentRecord], totals: Counter) -> None:
+    posts = [record for record in records if isinstance(record, PostRecord)]
+    comments = [record for record in records if isinstance(record, CommentRecord)]
+    try:
+        with DB.atomic():
+            if posts:
+                added = insert_new(RedditPost, POST_FIELDS, posts)
+                totals["posts"] += added
+                totals["duplicates"] += len(posts) - added
+            if comments:
+                # comments can't be stored without their post
+                stored = stored_posts({comment.post for comment in comments})
+                kept = [comment for comment in comments if comment.post in stored]
+                totals["orphans"] += len(comments) - len(kept)
+                added = insert_new(RedditComment, COMMENT_FIELDS, with_depths(kept))
+                totals["comments"] += added
+                totals["duplicates"] += len(kept) - added
+    except Exception:
+        forget_interned()
+        raise
+    forget_interned(INTERNED_LIMIT)
+
+
+def import_file(options: ImportOptions, path: Path, totals: Counter) -> None:
+    logger.info(f"Importing {path}...")
+    checkpointed = time.monotonic()
+    interval = options.db_config.checkpoint_interval
+    # a .zst that is damaged fails to decompress where the damage starts. the
+    # batches read before that are written already, and stay
+    corrupt = (import_zstandard().ZstdError,) if path.suffix == ".zst" else ()
+    read = totals["lines"]
+    batches = read_batches(path, options.batch_size)
+    try:
+        for records, malformed, skipped in parse_batches(batches, options.workers):
+            write_batch(records, totals)
+            totals["malformed"] += malformed
+            totals["skipped"] += skipped
+            totals["lines"] += len(records) + malformed + skipped
+            if interval is not None and time.monotonic() - checkpointed >= interval:
+                checkpoint_wal()
+                checkpointed = time.monotonic()
+            logger.debug(
+                f"{totals['lines']} records read, {totals['posts']} posts and"
+                f" {totals['comments']} comments imported so far."
+            )
+    except corrupt as e:
+        logger.error(
+            f"{path} is corrupt, stopped reading it after"
+            f" {totals['lines'] - read} records: {e}"
+        )
+        totals["corrupt"] += 1
+
+
+def run(options: ImportOptions) -> None:
+    missing = [str(path) for path in options.files if not path.exists()]
+    if missing:
+        print(f"Can't find {', '.join(missing)}.")
+        sys.exit(1)
+    if any(path.suffix == ".zst" for path in options.files):
+        # before the database is touched
+        import_zstandard()
+    setup_db(options.db, options.db_config)
+    start_ingest(options.db_config)
+    totals: Counter[str] = Counter()
+    start = time.perf_counter()
+    try:
+        for path in options.files:
+            import_file(options, path, totals)
+    finally:
+        finish_ingest(options.db_config)
+    seconds = time.perf_counter() - start
+    if totals["skipped"]:
+        logger.info(f"Skipped {totals['skipped']} comments by AutoModerator.")
+    if totals["malformed"]:
+        logger.warning(
+            f"Skipped {totals['malformed']} lines that aren't posts or comments."
+        )
+    if totals["orphans"]:
+        logger.warning(
+            f"Skipped {totals['orphans']} comments on posts that aren't in the archive."
+            " Import the submissions dump before the comments dump."
+        )
+    print(
+        f"Imported {totals['posts']} posts and {totals['comments']} comments from"
+        f" {totals['lines']} records in {seconds:.1f}s. {totals['duplicates']} were"
+        " already in the archive."
+    )
+    if totals["corrupt"]:
+        sys.exit(1)
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+import sys
+import time
+from typing import Iterable, Iterator, TypeVar, cast, get_args
+
+from reddit_scraper import logger, SORT_TYPE
+
+T = TypeVar("T")
+
+
+@dataclass
+class Job:
+    subreddit: str
+    sort_type: SORT_TYPE
+    num_posts: int
+    posts: int = 0
+    comments: int = 0
+    started: float = field(default_factory=time.monotonic)
+    # when the last of its posts was written
+    finished: float | None = None
+    # newest post seen in the listing, and whether everything newer than the
+    # previous checkpoint was found so the checkpoint can be moved up to it
+    newest: tuple[str, float] | None = None
+    caught_up: bool = False
+
+    def __str__(self) -> str:
+        return f"r/{self.subreddit} ({self.sort_type})"
+
+
+def make_jobs(
+    subreddits: list[str], sort_types: list[SORT_TYPE], num_posts: int
+) -> list[Job]:
+    return [Job(sub, sort, num_posts) for sub in subreddits for sort in sort_types]
+
+
+def read_job_file(path: Path, sort_type: SORT_TYPE, num_posts: int) -> list[Job]:
+    # one job per line: "subreddit [sort] [number of posts]", # starts a comment
+    jobs = []
+    sort_types = get_args(SORT_TYPE)
+    for lineno, line in enumerate(path.read_text().splitlines(), start=1):
+        parts = line.split("#", maxsplit=1)[0].split()
+        if not parts:
+            continue
+        if len(parts) > 3 or (len(parts) > 1 and parts[1] not in sort_types):
+            print(f"Invalid job on line {lineno} of {path}: {line.strip()}")
+            sys.exit(1)
+        try:
+            job_posts = int(parts[2]) if len(parts) > 2 else num_posts
+        except ValueError:
+            print(f"Invalid number of posts on line {lineno} of {path}: {parts[2]}")
+            sys.exit(1)
+        job_sort = cast(SORT_TYPE, parts[1]) if len(parts) > 1 else sort_type
+        jobs.append(Job(parts[0], job_sort, job_posts))
+    if not jobs:
+        print(f"No jobs found in {path}")
+        sys.exit(1)
+    return jobs
+
+
+def interleave(iterators: Iterable[Iterator[T]]) -> Iterator[T]:
+    # round robin so a job with a deep listing can't starve the others
+    active = deque(iterators)
+    while active:
+        iterator = active.popleft()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            continue
+        yield item
+        active.append(iterator)
+
+
+def log_job_stats(jobs: list[Job]) -> None:
+    for job in jobs:
+        if job.finished is None:
+            logger.info(f"{job}: no posts written")
+            continue
+        elapsed = job.finished - job.started
+        rate = job.posts / elapsed if elapsed else 0
+        logger.info(
+            f"{job}: {job.posts} posts, {job.comments} comments in {elapsed:.1f}s"
+            f" ({rate:.2f} posts/s)"
+        )
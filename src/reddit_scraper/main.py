@@ -1,23 +1,49 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from datetime import datetime
+from pathlib import Path
 import sys
+import time
+from importlib.util import find_spec
+from typing import TYPE_CHECKING, Generator
 
-from reddit_scraper import logger, SORT_TYPE
+from reddit_scraper import logger, BACKEND_TYPE, DEDUP_TYPE
 
 from .get_credentials import RedditCredentials, handle_credentials, CREDS_CACHE
-from .get_posts import get_posts, create_instance
-from .database import append_db, DB, RedditComment, RedditPost
+from .jobs import Job, log_job_stats
+
+# praw, peewee and everything built on them are imported where they are used,
+# so --clear and the argument parsing in front of every command start quickly
+if TYPE_CHECKING:
+    import praw
+
+    from .dbconfig import DBConfig
+    from .get_posts import RedditData
 
 
 @dataclass
 class Options:
     loglevel: int | None
-    subreddit: str
-    num_posts: int
+    jobs: list[Job]
     to_clear: bool
     skip_comments: bool
-    sort_type: SORT_TYPE
+    dedup: DEDUP_TYPE
+    workers: int
+    incremental: bool
+    refresh: bool
+    more_requests: int | None
+    more_seconds: float | None
+    max_depth: int | None
+    fill_stubs: bool
+    drain_only: bool
+    backend: BACKEND_TYPE
+    db: Path
+    shards: int
+    db_config: DBConfig
+    stats_interval: float | None
+    stats_file: Path | None
+    metrics_port: int | None
     creds: RedditCredentials
 
 
@@ -31,6 +57,18 @@ def check_options(args: Options) -> None:
         sys.exit(1)
 
 
+def save_checkpoints(jobs: list[Job]) -> None:
+    from .database import save_checkpoint
+
+    for job in jobs:
+        if job.caught_up and job.newest:
+            name, created_utc = job.newest
+            save_checkpoint(
+                job.subreddit, job.sort_type, name, datetime.fromtimestamp(created_utc)
+            )
+            logger.debug(f"Saved checkpoint {name} for {job}")
+
+
 def run(args: Options) -> None:
     logger.info("Program has started up.")
     check_options(args)
@@ -38,20 +76,98 @@ def run(args: Options) -> None:
         logger.debug(f"Program is using cached credentials from {str(CREDS_CACHE)}")
     args.creds = handle_credentials(args.creds)
     logger.info("Got credentials.")
-    api = create_instance(args.creds)
-    post_generator = get_posts(api, args)
+    if args.shards > 1:
+        from .shards import scrape_shards
+
+        scrape_shards(args)
+        return
+    scrape_with_backend(args)
+
+
+def scrape_with_backend(args: Options) -> None:
+    # shards split reddit's rate limit between their processes
+    rate_share = 1 / args.shards
+    if args.backend == "async" and not args.fill_stubs:
+        check_async_backend()
+        from .async_posts import get_posts
+
+        scrape(get_posts(args.creds, args, rate_share=rate_share), args)
+        return
+    if args.backend == "async":
+        logger.info("Filling in comment stubs always uses the sync backend.")
+    from .get_posts import create_instance
+
+    api = create_instance(args.creds, rate_share=rate_share)
+    scrape(sync_posts(api, args), args)
+
+
+def check_async_backend() -> None:
+    if find_spec("asyncpraw") is None:
+        print(
+            "The async backend needs asyncpraw, install it with:\n"
+            "   pip install reddit-scraper[async]"
+        )
+        sys.exit(1)
+
+
+def sync_posts(api: praw.Reddit, args: Options) -> Generator[RedditData, None, None]:
+    from .get_posts import fill_stubs, get_posts
+
+    if args.fill_stubs:
+        return fill_stubs(api, args)
+    return get_posts(api, args)
+
+
+def scrape(post_generator: Generator[RedditData, None, None], args: Options) -> None:
+    from .database import finish_ingest, release_work, start_ingest
+    from .metrics import METRICS, StatsReporter, save_stats, serve_metrics
+    from .migrations import setup_db
+    from .writer import DBWriter
 
-    DB.connect(reuse_if_open=True)
-    DB.create_tables([RedditPost, RedditComment], safe=True)
-    logger.info("connected to database.")
+    config = args.db_config
+    if config.defer_indexes and args.refresh:
+        # refreshing looks up the stored comments of every post by index
+        logger.warning("Keeping the indexes while refreshing, they are needed.")
+        config = replace(config, defer_indexes=False)
+    setup_db(args.db, config)
+    logger.info(f"connected to database {args.db}.")
+    start_ingest(config)
+    METRICS.started = time.monotonic()
+    reporter = StatsReporter(args.stats_interval) if args.stats_interval else None
+    server = serve_metrics(args.metrics_port) if args.metrics_port else None
+    if reporter:
+        reporter.start()
+    writer = DBWriter(config.checkpoint_interval, config.score_history)
+    writer.start()
+    interrupted = False
     try:
-        for reddit_data in post_generator:
+        for reddit_data in METRICS.timed("network_wait", post_generator):
             if reddit_data:
-                append_db(reddit_data)
+                writer.put(reddit_data)
             else:
                 break
     except KeyboardInterrupt:
+        interrupted = True
         print("Exited.")
+    finally:
+        # stops whatever is still fetching, before its posts are flushed
+        post_generator.close()
+        logger.info("Flushing posts waiting to be written...")
+        writer.close()
+        if released := release_work():
+            logger.info(f"Left {released} unfinished posts in the work queue.")
+        finish_ingest(config)
+        if reporter:
+            reporter.stop()
+        if server:
+            server.shutdown()
+        if args.stats_file:
+            save_stats(args.stats_file)
+    if not interrupted and not args.fill_stubs:
+        save_checkpoints(args.jobs)
+    logger.info(f"Totals: {METRICS.summary()}")
+    if not args.fill_stubs:
+        log_job_stats(args.jobs)
     print("Finished writing to database with all posts found")
 
 
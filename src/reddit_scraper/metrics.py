@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from pathlib import Path
+import threading
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, Iterator, TypeVar
+
+from reddit_scraper import logger
+
+T = TypeVar("T")
+
+# stages timed across the pipeline. their seconds are summed over every thread,
+# so with -w they can add up to more than the run itself took
+STAGES = [
+    "listing",
+    "expand",
+    "serialize",
+    "commit",
+    "checkpoint",
+    "indexing",
+    "network_wait",
+    "queue_wait",
+]
+COUNTERS = [
+    "http_requests",
+    "http_429",
+    "dedup_hits",
+    "queue_resumed",
+    "posts_written",
+    "posts_unchanged",
+    "comments_written",
+    "comments_unchanged",
+    "scores_recorded",
+    "stubs_written",
+    "transactions",
+    "wal_checkpoints",
+]
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.counters: Counter[str] = Counter()
+        self.seconds: defaultdict[str, float] = defaultdict(float)
+        self.calls: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += amount
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += 1
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed(self, stage: str, iterable: Iterable[T]) -> Iterator[T]:
+        # times each step of a lazy iterator, like praw's paginated listings
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    async def timed_async(
+        self, stage: str, iterable: AsyncIterable[T]
+    ) -> AsyncIterator[T]:
+        iterator = aiter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = await anext(iterator)
+            except StopAsyncIteration:
+                return
+            finally:
+                self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "uptime_seconds": time.monotonic() - self.started,
+                "counters": {name: self.counters[name] for name in COUNTERS},
+                "stages": {
+                    stage: {"seconds": self.seconds[stage], "calls": self.calls[stage]}
+                    for stage in STAGES
+                },
+            }
+
+    def summary(self) -> str:
+        stats = self.snapshot()
+        counters = stats["counters"]
+        uptime = max(stats["uptime_seconds"], 1e-9)
+        stages = ", ".join(
+            f"{stage} {stats['stages'][stage]['seconds']:.1f}s"
+            for stage in STAGES
+            if stats["stages"][stage]["calls"]
+        )
+        # unchanged rows were scraped all the same, only their write was skipped
+        posts = counters["posts_written"] + counters["posts_unchanged"]
+        comments = counters["comments_written"] + counters["comments_unchanged"]
+        return (
+            f"{posts / uptime:.2f} posts/s, {comments / uptime:.1f} comments/s |"
+            f" {counters['posts_written']} posts written,"
+            f" {counters['posts_unchanged']} unchanged,"
+            f" {counters['comments_written']} comments written,"
+            f" {counters['comments_unchanged']} unchanged,"
+            f" {counters['http_requests']} requests,"
+            f" {counters['http_429']} 429s, {counters['dedup_hits']} dedup hits"
+            f" | {stages or 'nothing timed yet'}"
+        )
+
+    def prometheus(self) -> str:
+        stats = self.snapshot()
+        lines = [
+            "# TYPE rdscp_uptime_seconds gauge",
+            f"rdscp_uptime_seconds {stats['uptime_seconds']:.3f}",
+        ]
+        for name, value in stats["counters"].items():
+            lines.append(f"# TYPE rdscp_{name}_total counter")
+            lines.append(f"rdscp_{name}_total {value}")
+        for key in ("seconds", "calls"):
+            lines.append(f"# TYPE rdscp_stage_{key}_total counter")
+            for stage, timing in stats["stages"].items():
+                lines.append(
+                    f'rdscp_stage_{key}_total{{stage="{stage}"}} {timing[key]}'
+                )
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class StatsReporter(threading.Thread):
+    def __init__(self, interval: float) -> None:
+        super().__init__(name="rdscp-stats", daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            logger.info(METRICS.summary())
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?", maxsplit=1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = METRICS.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # keep scrapes of the endpoint out of the scraper's own log
+        pass
+
+
+def serve_metrics(port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="rdscp-metrics", daemon=True
+    ).start()
+    logger.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+    return server
+
+
+def save_stats(path: Path) -> None:
+    path.write_text(json.dumps(METRICS.snapshot(), indent=2) + "\n")
+    logger.info(f"Saved run statistics to {path}")
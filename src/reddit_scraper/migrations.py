@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sqlite3
+import sys
+from typing import Callable
+
+from peewee import ForeignKeyField, IntegerField
+from playhouse.migrate import SqliteMigrator, migrate
+
+from reddit_scraper import DB_PATH, logger
+from .database import (
+    DB,
+    TABLES,
+    Author,
+    RedditComment,
+    RedditPost,
+    Subreddit,
+    init_db,
+)
+from .dbconfig import DBConfig
+
+# the schema version lives in the database file itself, in PRAGMA user_version.
+# databases created before migrations existed report version 0
+Migration = Callable[[SqliteMigrator], None]
+
+
+def intern_names(migrator: SqliteMigrator) -> None:
+    # moves the subreddit and author text columns into the lookup tables
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        print(
+            "Upgrading this database needs SQLite 3.35 or newer,"
+            f" but Python is using SQLite {sqlite3.sqlite_version}."
+        )
+        sys.exit(1)
+    DB.create_tables([Subreddit, Author])
+    for model in (RedditPost, RedditComment):
+        table = model._meta.table_name
+        for lookup, column in ((Subreddit, "subreddit"), (Author, "author")):
+            lookup_table = lookup._meta.table_name
+            DB.execute_sql(
+                f'INSERT OR IGNORE INTO "{lookup_table}" (name)'
+                f' SELECT DISTINCT "{column}" FROM "{table}"'
+                f' WHERE "{column}" IS NOT NULL'
+            )
+            # added as nullable, making it NOT NULL would mean rebuilding the
+            # table, which renumbers the rowids the search index points at
+            migrate(
+                migrator.add_column(
+                    table,
+                    f"{column}_id",
+                    ForeignKeyField(lookup, field=lookup.id, null=True, index=False),
+                )
+            )
+            DB.execute_sql(
+                f'UPDATE "{table}" SET "{column}_id" = (SELECT id'
+                f' FROM "{lookup_table}" WHERE name = "{table}"."{column}")'
+            )
+            migrate(migrator.drop_column(table, column))
+
+
+def add_indexes(migrator: SqliteMigrator) -> None:
+    # the (post, created_utc) index takes over from the one on post alone
+    DB.execute_sql('DROP INDEX IF EXISTS "redditcomment_post_id"')
+    for model in (RedditPost, RedditComment):
+        model._schema.create_indexes(safe=True)
+
+
+def add_content_hash(migrator: SqliteMigrator) -> None:
+    # existing rows keep NULL, and are rewritten the next time they're scraped
+    for model in (RedditPost, RedditComment):
+        migrate(
+            migrator.add_column(
+                model._meta.table_name, "content_hash", IntegerField(null=True)
+            )
+        )
+
+
+def null_deleted_authors(migrator: SqliteMigrator) -> None:
+    # comments by deleted accounts used to be stored with the author "None",
+    # where posts and imported dumps have NULL. the account actually named
+    # None, if there is one, loses its comments' author as its posts already did
+    DB.execute_sql(
+        'UPDATE "redditcomment" SET author_id = NULL'
+        ' WHERE author_id = (SELECT id FROM "author" WHERE name = ?)',
+        ("None",),
+    )
+
+
+MIGRATIONS: list[Migration] = [
+    intern_names,
+    add_indexes,
+    add_content_hash,
+    null_deleted_authors,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def setup_db(path: str | Path = DB_PATH, config: DBConfig | None = None) -> None:
+    init_db(path, config)
+    DB.connect(reuse_if_open=True)
+    if not RedditPost.table_exists():
+        DB.create_tables(TABLES)
+        DB.pragma("user_version", SCHEMA_VERSION)
+        return
+    version = DB.pragma("user_version")
+    if version > SCHEMA_VERSION:
+        print(
+            f"This database has schema version {version}, but this version of"
+            f" reddit-scraper only knows up to {SCHEMA_VERSION}. Please upgrade."
+        )
+        sys.exit(1)
+    if version < SCHEMA_VERSION:
+        migrator = SqliteMigrator(DB)
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"Upgrading database to schema version {number}...")
+            with DB.atomic():
+                migration(migrator)
+                DB.pragma("user_version", number)
+        logger.info(
+            "Database upgraded, run VACUUM on it to give the freed space back"
+            " to the filesystem."
+        )
+    DB.create_tables(TABLES, safe=True)
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from typing import Any, Mapping
+
+from prawcore import Requestor
+from requests import Response
+
+from reddit_scraper import logger
+from .metrics import METRICS
+
+# reddit allows 100 requests per minute per oauth client
+DEFAULT_RATE = 100 / 60
+MAX_429_RETRIES = 5
+
+
+class TokenBucket:
+    def __init__(
+        self, rate: float = DEFAULT_RATE, capacity: float = 10, share: float = 1.0
+    ) -> None:
+        # share is the part of the rate limit this process may use, when
+        # several processes scrape with the same oauth client
+        self.share = share
+        self.rate = rate * share
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _take(self) -> float:
+        # takes a token if there is one, otherwise says how long to wait for it
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self.blocked_until and self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+
+    def acquire(self) -> None:
+        while wait := self._take():
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        # the same bucket can govern coroutines, as long as they all share it
+        while wait := self._take():
+            await asyncio.sleep(wait)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        if "x-ratelimit-remaining" not in headers:
+            return
+        remaining = float(headers["x-ratelimit-remaining"]) * self.share
+        seconds_to_reset = max(float(headers["x-ratelimit-reset"]), 1)
+        with self._lock:
+            self._refill(time.monotonic())
+            if remaining < 1:
+                self._block(seconds_to_reset)
+                return
+            self.rate = remaining / seconds_to_reset
+            self.tokens = min(self.tokens, remaining)
+
+    def record(self, status: int, headers: Mapping[str, str]) -> bool:
+        # feeds a response back into the bucket, True when it was a 429 and the
+        # request should be sent again once the bucket allows it
+        METRICS.count("http_requests")
+        self.update(headers)
+        if status != 429:
+            return False
+        METRICS.count("http_429")
+        retry_after = float(headers.get("retry-after", 1))
+        logger.warning(f"Received 429 too many requests, waiting {retry_after}s.")
+        self.backoff(retry_after)
+        return True
+
+    def backoff(self, seconds: float) -> None:
+        with self._lock:
+            self._block(seconds)
+
+    def _block(self, seconds: float) -> None:
+        self.tokens = 0
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RateLimitedRequestor(Requestor):
+    def __init__(self, *args: Any, bucket: TokenBucket, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.bucket = bucket
+
+    def request(self, *args: Any, **kwargs: Any) -> Response:
+        for _ in range(MAX_429_RETRIES):
+            self.bucket.acquire()
+            response = super().request(*args, **kwargs)
+            if not self.bucket.record(response.status_code, response.headers):
+                break
+        return response
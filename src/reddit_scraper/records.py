@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+from hashlib import blake2b
+from operator import itemgetter
+from typing import NamedTuple
+
+# what is kept of each post and comment between fetching it and writing it.
+# tuples carry no per-instance dict, and the field names match the model
+# fields they are inserted into, so rows go to the database without being
+# copied into dicts first. timestamps stay plain ints until they are written.
+# both start with the fields of RedditContent, in the same order
+
+
+class PostRecord(NamedTuple):
+    name: str
+    author: str | None
+    created_utc: int
+    distinguished: str | None
+    edited: bool
+    score: int
+    subreddit: str
+    locked: bool
+    num_comments: int
+    over_18: bool
+    selftext: str | None
+    is_textual: bool
+    spoiler: bool
+    title: str
+    img_link_or_permalink: str
+    upvote_ratio: float | None
+
+
+class CommentRecord(NamedTuple):
+    name: str
+    author: str | None
+    created_utc: int
+    distinguished: str | None
+    edited: bool
+    score: int
+    subreddit: str
+    post: str
+    parent_id: str
+    body: str | None
+    saved: bool
+    stickied: bool
+    # None for imported comments until their parent's depth is known
+    depth: int | None
+
+
+# what identifies a post or comment, and never changes once it exists. the
+# content hash covers every other field
+IDENTITY = {"name", "created_utc", "subreddit", "post", "parent_id", "depth"}
+MUTABLE = {
+    record: itemgetter(
+        *(index for index, name in enumerate(record._fields) if name not in IDENTITY)
+    )
+    for record in (PostRecord, CommentRecord)
+}
+
+
+def content_hash(record: PostRecord | CommentRecord) -> int:
+    # 64 bits, the size of a SQLite integer. python's own hash() of a string
+    # changes with every interpreter started, so it can't be stored
+    digest = blake2b(repr(MUTABLE[type(record)](record)).encode(), digest_size=8)
+    return int.from_bytes(digest.digest(), "big", signed=True)
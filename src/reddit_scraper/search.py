@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+import heapq
+from itertools import chain
+from pathlib import Path
+import sys
+import time
+
+from peewee import OperationalError
+from playhouse.sqlite_ext import FTS5Model, SearchField
+
+from reddit_scraper import logger
+from .database import DB, RedditComment, RedditPost, Subreddit
+from .migrations import setup_db
+from .shards import open_shards, require_shards
+
+
+class PostIndex(FTS5Model):
+    title = SearchField()
+    selftext = SearchField()
+
+    class Meta:
+        database = DB
+        options = {"content": RedditPost, "tokenize": "porter unicode61"}
+
+
+class CommentIndex(FTS5Model):
+    body = SearchField()
+
+    class Meta:
+        database = DB
+        options = {"content": RedditComment, "tokenize": "porter unicode61"}
+
+
+# external content tables don't follow their content on their own. the delete
+# triggers also catch rows removed by INSERT OR REPLACE, since the connection
+# pragmas turn on recursive_triggers
+TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS {index}_ai AFTER INSERT ON {table} BEGIN
+    INSERT INTO {index}(rowid, {columns}) VALUES (new.rowid, {new});
+END""",
+    """CREATE TRIGGER IF NOT EXISTS {index}_ad AFTER DELETE ON {table} BEGIN
+    INSERT INTO {index}({index}, rowid, {columns}) VALUES ('delete', old.rowid, {old});
+END""",
+    """CREATE TRIGGER IF NOT EXISTS {index}_au AFTER UPDATE ON {table} BEGIN
+    INSERT INTO {index}({index}, rowid, {columns}) VALUES ('delete', old.rowid, {old});
+    INSERT INTO {index}(rowid, {columns}) VALUES (new.rowid, {new});
+END""",
+]
+
+INDEXES: list[type[FTS5Model]] = [PostIndex, CommentIndex]
+
+
+@dataclass
+class SearchOptions:
+    loglevel: int | None
+    query: str | None
+    comments: bool
+    subreddit: str | None
+    limit: int
+    rebuild: bool
+    db: Path
+    shards: bool
+
+
+def create_index(index: type[FTS5Model]) -> None:
+    index.create_table(safe=True)
+    columns = [
+        field.column_name
+        for field in index._meta.sorted_fields
+        if isinstance(field, SearchField)
+    ]
+    for trigger in TRIGGERS:
+        DB.execute_sql(
+            trigger.format(
+                index=index._meta.table_name,
+                table=index._meta.options["content"]._meta.table_name,
+                columns=", ".join(columns),
+                new=", ".join(f"new.{column}" for column in columns),
+                old=", ".join(f"old.{column}" for column in columns),
+            )
+        )
+
+
+def rebuild_indexes() -> None:
+    if not PostIndex.fts5_installed():
+        print("This build of SQLite does not include FTS5, so search is unavailable.")
+        sys.exit(1)
+    with DB.atomic():
+        for index in INDEXES:
+            create_index(index)
+            logger.info(f"Rebuilding {index._meta.table_name}...")
+            index.rebuild()
+    print("Successfully rebuilt the search index.")
+
+
+def search(options: SearchOptions, schema: str = "main") -> list[tuple]:
+    index = CommentIndex if options.comments else PostIndex
+    table = RedditComment if options.comments else RedditPost
+    text = "body" if options.comments else "title"
+    index_name = index._meta.table_name
+    sql = (
+        f"SELECT c.name, s.name, c.{text},"
+        f" snippet({index_name}, -1, '[', ']', '...', 16), bm25({index_name})"
+        f" FROM {schema}.{index_name} JOIN {schema}.{table._meta.table_name} AS c"
+        f" ON c.rowid = {index_name}.rowid"
+        f" JOIN {schema}.{Subreddit._meta.table_name} AS s ON s.id = c.subreddit_id"
+        f" WHERE {index_name} MATCH ?"
+    )
+    params: list = [options.query]
+    if options.subreddit:
+        sql += " AND s.name = ? COLLATE NOCASE"
+        params.append(options.subreddit)
+    sql += f" ORDER BY bm25({index_name}) LIMIT ?"
+    params.append(options.limit)
+    return DB.execute_sql(sql, params).fetchall()
+
+
+def run(options: SearchOptions) -> None:
+    if not options.query and not options.rebuild:
+        print("Nothing to search for, see rdscp search --help")
+        sys.exit(1)
+    paths = require_shards(options.db) if options.shards else [options.db]
+    if options.rebuild:
+        for path in paths:
+            setup_db(path)
+            rebuild_indexes()
+        if not options.query:
+            return
+    if options.shards:
+        schemas = open_shards(options.db)
+    else:
+        setup_db(options.db)
+        schemas = ["main"]
+    index_name = PostIndex._meta.table_name
+    if not all(DB.table_exists(index_name, schema=schema) for schema in schemas):
+        print(
+            "The search index does not exist yet,"
+            ' create it with "rdscp search --rebuild".'
+        )
+        sys.exit(1)
+
+    start = time.perf_counter()
+    try:
+        # every shard has an index of its own. their bm25 scores are weighed
+        # against each shard's own rows, so the merged ranking is approximate
+        results = heapq.nsmallest(
+            options.limit,
+            chain.from_iterable(search(options, schema) for schema in schemas),
+            key=lambda row: row[-1],
+        )
+    except OperationalError as e:
+        print(f"Invalid search query: {e}")
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+
+    for name, subreddit, text, snippet, score in results:
+        first_line = text.splitlines()[0] if text else ""
+        print(f"{score:8.2f}  r/{subreddit}  {name}  {first_line[:80]}")
+        if snippet != first_line:
+            print(f"          {' '.join(snippet.split())}")
+    print(f"{len(results)} results in {elapsed * 1000:.1f}ms")
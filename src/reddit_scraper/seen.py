@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+
+from peewee import fn
+
+from reddit_scraper import logger, DEDUP_TYPE
+from .database import RedditPost
+
+
+class SeenSet(ABC):
+    @abstractmethod
+    def __contains__(self, name: str) -> bool: ...
+
+    @abstractmethod
+    def add(self, name: str) -> None: ...
+
+
+class MemorySeenSet(SeenSet):
+    def __init__(self) -> None:
+        self.names: set[str] = set()
+        if RedditPost.table_exists():
+            self.names.update(RedditPost.select(RedditPost.name).scalars())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.names
+
+    def add(self, name: str) -> None:
+        self.names.add(name)
+
+
+def decode_name(name: str) -> int | None:
+    try:
+        return int(name.split("_", maxsplit=1)[-1], 36)
+    except ValueError:
+        return None
+
+
+class CompactSeenSet(SeenSet):
+    # base36 ids sort numerically when ordered by length first, so SQLite hands
+    # them back already sorted and they can be streamed straight into the array
+    def __init__(self) -> None:
+        self.ids = array("Q")
+        self.added: set[str] = set()
+        if RedditPost.table_exists():
+            query = (
+                RedditPost.select(RedditPost.name)
+                .order_by(fn.length(RedditPost.name), RedditPost.name)
+                .tuples()
+            )
+            for (name,) in query.iterator():
+                decoded = decode_name(name)
+                if decoded is None:
+                    self.added.add(name)
+                else:
+                    self.ids.append(decoded)
+
+    def __contains__(self, name: str) -> bool:
+        if name in self.added:
+            return True
+        decoded = decode_name(name)
+        if decoded is None:
+            return False
+        i = bisect_left(self.ids, decoded)
+        return i < len(self.ids) and self.ids[i] == decoded
+
+    def add(self, name: str) -> None:
+        self.added.add(name)
+
+
+class LazySeenSet(SeenSet):
+    def __init__(self) -> None:
+        self.added: set[str] = set()
+        self.has_table = RedditPost.table_exists()
+
+    def __contains__(self, name: str) -> bool:
+        if name in self.added:
+            return True
+        if not self.has_table:
+            return False
+        return RedditPost.select().where(RedditPost.name == name).exists()
+
+    def add(self, name: str) -> None:
+        self.added.add(name)
+
+
+SEEN_SETS: dict[str, type[SeenSet]] = {
+    "memory": MemorySeenSet,
+    "compact": CompactSeenSet,
+    "lazy": LazySeenSet,
+}
+
+
+def make_seen_set(dedup: DEDUP_TYPE) -> SeenSet:
+    seen = SEEN_SETS[dedup]()
+    logger.debug(f"loaded {dedup} index of archived posts")
+    return seen
@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, replace
+import logging
+import multiprocessing
+from pathlib import Path
+import sys
+from typing import TYPE_CHECKING
+import zlib
+
+from peewee import AutoField, Field, ForeignKeyField, Model
+
+from reddit_scraper import logger
+from .database import (
+    DB,
+    Author,
+    Checkpoint,
+    MoreStub,
+    RedditComment,
+    RedditPost,
+    ScoreHistory,
+    Subreddit,
+    WorkItem,
+    finish_ingest,
+    init_db,
+    start_ingest,
+)
+from .migrations import setup_db
+
+if TYPE_CHECKING:
+    from .dbconfig import DBConfig
+    from .jobs import Job
+    from .main import Options
+
+# a sharded run scrapes with one process per shard, each writing its own
+# database file next to --db. subreddits always land in the same shard for the
+# same number of shards, so checkpoints and dedup keep working across runs
+INTERNED = (Subreddit, Author)
+# SQLite attaches at most this many databases to one connection by default
+MAX_ATTACHED = 10
+
+
+@dataclass
+class MergeOptions:
+    loglevel: int | None
+    db: Path
+    shards: list[Path]
+    db_config: DBConfig
+
+
+def shard_path(path: Path, index: int) -> Path:
+    return path.with_name(f"{path.stem}.shard{index}{path.suffix}")
+
+
+def find_shards(path: Path) -> list[Path]:
+    shards = path.parent.glob(f"{path.stem}.shard*{path.suffix}")
+    numbered = []
+    for shard in shards:
+        number = shard.name[len(path.stem) + len(".shard") :].removesuffix(path.suffix)
+        if number.isdigit():
+            numbered.append((int(number), shard))
+    return [shard for _, shard in sorted(numbered)]
+
+
+def shard_of(subreddit: str, shards: int) -> int:
+    # crc32 rather than hash(), which changes with every interpreter started
+    return zlib.crc32(subreddit.lower().encode()) % shards
+
+
+def split_jobs(jobs: list[Job], shards: int) -> list[list[Job]]:
+    split: list[list[Job]] = [[] for _ in range(shards)]
+    for job in jobs:
+        split[shard_of(job.subreddit, shards)].append(job)
+    return split
+
+
+def scrape_shard(args: Options, index: int) -> None:
+    # runs in a fresh process, which has to set up logging on its own
+    from .main import scrape_with_backend
+
+    logging.basicConfig(
+        level=args.loglevel,
+        stream=sys.stdout,
+        format=f"%(levelname)s: [shard {index}] %(message)s",
+    )
+    logging.getLogger("peewee").setLevel(logging.INFO)
+    scrape_with_backend(args)
+
+
+def scrape_shards(args: Options) -> None:
+    context = multiprocessing.get_context("spawn")
+    # queued posts and stubs can wait in any shard, whatever its subreddits
+    every_shard = args.drain_only or args.fill_stubs
+    processes = []
+    for index, jobs in enumerate(split_jobs(args.jobs, args.shards)):
+        if not jobs and not every_shard:
+            continue
+        shard_args = replace(
+            args,
+            jobs=jobs,
+            db=shard_path(args.db, index),
+            stats_file=args.stats_file and shard_path(args.stats_file, index),
+            metrics_port=args.metrics_port and args.metrics_port + index,
+        )
+        process = context.Process(
+            target=scrape_shard, args=(shard_args, index), name=f"rdscp-shard{index}"
+        )
+        process.start()
+        processes.append((index, process))
+    logger.info(f"Started {len(processes)} shard processes.")
+    try:
+        for _, process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # every shard got the same ctrl-c and is flushing its posts
+        for _, process in processes:
+            process.join()
+    failed = [str(index) for index, process in processes if process.exitcode]
+    if failed:
+        logger.error(f"Shards {', '.join(failed)} exited with an error.")
+        sys.exit(1)
+    print(f'Scraped into {args.shards} shards, combine them with "rdscp merge".')
+
+
+def upgrade_shards(paths: list[Path]) -> None:
+    # shards are plain databases, written by whatever version scraped them
+    for path in paths:
+        if not path.exists():
+            print(f"Shard {path} does not exist.")
+            sys.exit(1)
+        setup_db(path)
+        DB.close()
+
+
+def copied_fields(model: type[Model]) -> list[Field]:
+    # ids handed out by the shard mean nothing in the main database
+    return [
+        field for field in model._meta.sorted_fields if not isinstance(field, AutoField)
+    ]
+
+
+def shard_select(model: type[Model], schema: str, overrides: dict[str, str]) -> str:
+    # the model's rows in the shard, with interned ids swapped for the ids the
+    # same names have in the main database
+    columns = []
+    joins = []
+    for field in copied_fields(model):
+        if field.column_name in overrides:
+            columns.append(overrides[field.column_name])
+        elif isinstance(field, ForeignKeyField) and field.rel_model in INTERNED:
+            table = field.rel_model._meta.table_name
+            kind = "LEFT JOIN" if field.null else "JOIN"
+            joins.append(
+                f'{kind} {schema}."{table}" AS "shard_{field.name}"'
+                f' ON "shard_{field.name}".id = t."{field.column_name}"'
+                f' {kind} main."{table}" AS "main_{field.name}"'
+                f' ON "main_{field.name}".name = "shard_{field.name}".name'
+            )
+            columns.append(f'"main_{field.name}".id')
+        else:
+            columns.append(f't."{field.column_name}"')
+    return (
+        f"SELECT {', '.join(columns)}"
+        f' FROM {schema}."{model._meta.table_name}" AS t {" ".join(joins)}'
+    )
+
+
+def copy_table(
+    model: type[Model],
+    schema: str,
+    conflict: str = "REPLACE",
+    overrides: dict[str, str] | None = None,
+) -> int:
+    names = ", ".join(f'"{field.column_name}"' for field in copied_fields(model))
+    return DB.execute_sql(
+        f'INSERT OR {conflict} INTO main."{model._meta.table_name}" ({names})'
+        f" {shard_select(model, schema, overrides or {})}"
+    ).rowcount
+
+
+def merge_shard(path: Path) -> None:
+    # attaching has to happen outside of a transaction
+    DB.attach(str(path), "shard")
+    try:
+        with DB.atomic():
+            for model in INTERNED:
+                copy_table(model, "shard", conflict="IGNORE")
+            # posts before comments, which reference them
+            posts = copy_table(RedditPost, "shard")
+            comments = copy_table(RedditComment, "shard")
+            copy_table(Checkpoint, "shard")
+            copy_table(ScoreHistory, "shard", conflict="IGNORE")
+            # stubs have no natural key, so a post's stubs replace the old ones
+            stubs = MoreStub._meta.table_name
+            DB.execute_sql(
+                f'DELETE FROM main."{stubs}"'
+                f' WHERE post_id IN (SELECT post_id FROM shard."{stubs}")'
+            )
+            copy_table(MoreStub, "shard")
+            # unfinished posts keep their place in the queue, unclaimed
+            queued = copy_table(
+                WorkItem,
+                "shard",
+                conflict="IGNORE",
+                overrides={"claimed_by": "NULL", "claimed_at": "NULL"},
+            )
+    finally:
+        DB.detach("shard")
+    logger.info(
+        f"Merged {posts} posts, {comments} comments and {queued} queued posts"
+        f" from {path}."
+    )
+
+
+def require_shards(path: Path) -> list[Path]:
+    shards = find_shards(path)
+    if not shards:
+        print(f"Found no shards of {path}.")
+        sys.exit(1)
+    return shards
+
+
+def run(options: MergeOptions) -> None:
+    shards = options.shards or require_shards(options.db)
+    upgrade_shards(shards)
+    setup_db(options.db, options.db_config)
+    start_ingest(options.db_config)
+    try:
+        for path in shards:
+            merge_shard(path)
+    finally:
+        finish_ingest(options.db_config)
+    print(f"Merged {len(shards)} shards into {options.db}.")
+
+
+def open_shards(path: Path) -> list[str]:
+    # lets search and export read every shard of path at once, without merging.
+    # the main database is empty and only holds temporary views, each one a
+    # UNION ALL of its table in every shard, which peewee's models query in
+    # place of the tables. interned ids are spread out so shards never collide
+    shards = require_shards(path)
+    if len(shards) > MAX_ATTACHED:
+        print(
+            f"Found {len(shards)} shards of {path}, but SQLite can only read"
+            f' {MAX_ATTACHED} at once. Combine them with "rdscp merge" first.'
+        )
+        sys.exit(1)
+    upgrade_shards(shards)
+    init_db(":memory:")
+    schemas = [f"shard{index}" for index in range(len(shards))]
+    for schema, shard in zip(schemas, shards):
+        DB.attach(str(shard), schema)
+    DB.connect(reuse_if_open=True)
+    for model in (*INTERNED, RedditPost, RedditComment):
+        selects = [
+            f"SELECT {', '.join(spread_columns(model, index, len(shards)))}"
+            f' FROM shard{index}."{model._meta.table_name}"'
+            for index in range(len(shards))
+        ]
+        DB.execute_sql(
+            f'CREATE TEMP VIEW "{model._meta.table_name}" AS'
+            f" {' UNION ALL '.join(selects)}"
+        )
+    return schemas
+
+
+def spread_columns(model: type[Model], index: int, shards: int) -> list[str]:
+    columns = []
+    for field in model._meta.sorted_fields:
+        column = f'"{field.column_name}"'
+        interned = model in INTERNED and field is model._meta.primary_key
+        if interned or (
+            isinstance(field, ForeignKeyField) and field.rel_model in INTERNED
+        ):
+            column = f"{column} * {shards} + {index} AS {column}"
+        columns.append(column)
+    return columns
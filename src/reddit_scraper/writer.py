@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+from queue import Queue
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from reddit_scraper import logger
+from .database import DB, append_many, checkpoint_wal
+from .metrics import METRICS
+
+if TYPE_CHECKING:
+    from .get_posts import RedditData
+
+# fetching pauses once this many posts are waiting to be written
+QUEUE_SIZE = 32
+# posts committed together in a single transaction
+BATCH_SIZE = 16
+
+
+class DBWriter(threading.Thread):
+    def __init__(
+        self, checkpoint_interval: float | None = None, score_history: bool = False
+    ) -> None:
+        super().__init__(name="rdscp-writer")
+        self.queue: Queue[RedditData | None] = Queue(maxsize=QUEUE_SIZE)
+        self.checkpoint_interval = checkpoint_interval
+        self.score_history = score_history
+        self.checkpointed = time.monotonic()
+
+    def put(self, data: RedditData) -> None:
+        with METRICS.timer("queue_wait"):
+            self.queue.put(data)
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.join()
+
+    def run(self) -> None:
+        done = False
+        while not done:
+            batch = []
+            item = self.queue.get()
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= BATCH_SIZE or self.queue.empty():
+                    break
+                item = self.queue.get()
+            done = item is None
+            if batch:
+                self.write(batch)
+                self.checkpoint()
+        DB.close()
+
+    def checkpoint(self) -> None:
+        if self.checkpoint_interval is None:
+            return
+        if time.monotonic() - self.checkpointed < self.checkpoint_interval:
+            return
+        try:
+            checkpoint_wal()
+        except Exception as e:
+            logger.warning(f"WAL checkpoint failed: {e}")
+        self.checkpointed = time.monotonic()
+
+    def write(self, batch: list[RedditData]) -> None:
+        try:
+            with METRICS.timer("commit"):
+                append_many(batch, self.score_history)
+        except Exception as e:
+            logger.error(f"database batch saving error! error {e}", exc_info=True)
+            return
+        METRICS.count("transactions")
+        # a job is done once its last post is written, which with -w and the
+        # work queue is long after its listing ran out
+        written = time.monotonic()
+        for data in batch:
+            if data.job is not None:
+                data.job.finished = written
@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+from dataclasses import replace
+import logging
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+import pytest
+
+from reddit_scraper import BACKEND_TYPE, DB_PATH, DEFAULT_UA
+from reddit_scraper import main
+from reddit_scraper.bench import BenchScenario, fake_posts, scenario_options
+from reddit_scraper.database import DB, forget_interned
+from reddit_scraper.fake_reddit import FakeConfig, FakeReddit
+from reddit_scraper.get_credentials import RedditCredentials
+
+Scrape = Callable[..., main.Options]
+
+
+@pytest.fixture
+def db_path(tmp_path: Path) -> Iterator[Path]:
+    yield tmp_path / DB_PATH
+    # the next test starts a database of its own, where the interned ids of
+    # this one point nowhere
+    DB.close()
+    forget_interned()
+
+
+@pytest.fixture
+def creds() -> RedditCredentials:
+    return RedditCredentials("test", "test", DEFAULT_UA)
+
+
+@pytest.fixture
+def scrape(db_path: Path, creds: RedditCredentials) -> Scrape:
+    # scrapes a fake reddit into db_path the way the bench scenarios do. every
+    # call writes to the same database, so a test can scrape it again
+    def run(
+        fake: FakeReddit | None = None,
+        backend: BACKEND_TYPE = "sync",
+        subreddits: int = 1,
+        posts: int = 10,
+        **overrides: Any,
+    ) -> main.Options:
+        fake = fake or FakeReddit(FakeConfig())
+        scenario = BenchScenario(subreddits, posts, fake.config)
+        options = replace(
+            scenario_options(scenario, backend, logging.WARNING, creds),
+            db=db_path,
+            **overrides,
+        )
+        main.scrape(fake_posts(fake, options), options)
+        return options
+
+    return run
@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+import pytest
+from conftest import Scrape
+
+from reddit_scraper.database import RedditComment, RedditPost
+from reddit_scraper.fake_reddit import FakeConfig, FakeReddit
+
+# runs against whichever asyncprawcore is installed, whose requests are
+# awaited before version 3 and entered as a context since
+pytest.importorskip("asyncpraw")
+
+
+def test_async_scrape_writes_every_post_and_comment(scrape: Scrape) -> None:
+    scrape(
+        FakeReddit(FakeConfig(comments=12, inline=5)),
+        backend="async",
+        subreddits=2,
+        posts=10,
+    )
+    assert RedditPost.select().count() == 20
+    assert RedditComment.select().count() == 20 * 12
+
+
+def test_async_scrape_retries_throttled_requests(scrape: Scrape) -> None:
+    fake = FakeReddit(FakeConfig(comments=3, error_rate=0.3, retry_after=0.01))
+    scrape(fake, backend="async")
+    assert fake.throttled
+    assert RedditPost.select().count() == 10
+    assert RedditComment.select().count() == 10 * 3
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+from collections import Counter
+import logging
+from pathlib import Path
+import re
+
+from reddit_scraper.bench import BenchScenario, scenario_options
+from reddit_scraper.database import DB, RedditComment, append_db
+from reddit_scraper.fake_reddit import FakeConfig, FakeReddit
+from reddit_scraper.get_credentials import RedditCredentials
+from reddit_scraper.get_posts import (
+    RedditData,
+    create_instance,
+    get_comment_data,
+    get_post_data,
+    make_sort,
+)
+from reddit_scraper.metrics import METRICS
+from reddit_scraper.migrations import setup_db
+
+# a deep thread, with most of its comments behind MoreComments
+COMMENTS = 5000
+DEPTH = 20
+# the name of the comment in each insert, as traced by sqlite
+INSERTED_NAME = re.compile(r"""^INSERT INTO "redditcomment" .*? VALUES \('([^']+)'""")
+
+
+def test_deep_thread_writes_each_comment_once(
+    db_path: Path, creds: RedditCredentials
+) -> None:
+    # the thread goes through the same expansion, serialization and write as
+    # when it is scraped. sqlite reports every inserted row, even within
+    # executemany, so a comment written twice can't hide behind the upsert
+    fake = FakeConfig(comments=COMMENTS, depth=DEPTH, inline=100)
+    options = scenario_options(BenchScenario(1, 1, fake), "sync", logging.WARN, creds)
+    api = create_instance(creds, session=FakeReddit(fake), check_for_updates=False)
+    post = next(make_sort(api, options.jobs[0]))
+    comments, stubs = get_comment_data(post, options)
+    inserted: Counter[str] = Counter()
+
+    def trace(sql: str) -> None:
+        if match := INSERTED_NAME.match(sql):
+            inserted[match[1]] += 1
+
+    setup_db(db_path)
+    written_before = METRICS.counters["comments_written"]
+    DB.connection().set_trace_callback(trace)
+    assert append_db(RedditData(get_post_data(post), comments, stubs=stubs))
+    DB.connection().set_trace_callback(None)
+
+    serialized = Counter(comment.name for comment in comments)
+    for counts in (serialized, inserted):
+        assert len(counts) == COMMENTS
+        assert set(counts.values()) == {1}
+    assert METRICS.counters["comments_written"] - written_before == COMMENTS
+    assert RedditComment.select().count() == COMMENTS
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import json
+import logging
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from reddit_scraper import importer
+from reddit_scraper.database import DB
+from reddit_scraper.dbconfig import PROFILES
+from reddit_scraper.fake_reddit import START_UTC
+
+zstandard = pytest.importorskip("zstandard")
+
+# a few lines of a dump as (id, post, parent, author), out of order and with the
+# oddities real dumps have: a comment and a reply before their post, deleted
+# authors, AutoModerator, a comment on a post missing from the dump, and a line
+# cut short after them all
+DUMP = [
+    ("c1", "t3_p1", "t3_p1", "alice"),
+    ("c2", "t3_p1", "t1_c1", "[deleted]"),
+    ("p1", None, None, "bob"),
+    ("p2", None, None, "[deleted]"),
+    ("c3", "t3_p2", "t3_p2", "[deleted]"),
+    ("c4", "t3_p2", "t3_p2", "AutoModerator"),
+    ("c5", "t3_p9", "t3_p9", "carol"),
+]
+TRUNCATED = '{"id": "c6", "link_id": "t3_p1"'
+POSTS_SQL = (
+    'SELECT p.name, a.name FROM "redditpost" AS p'
+    ' LEFT JOIN "author" AS a ON a.id = p.author_id ORDER BY p.name'
+)
+COMMENTS_SQL = (
+    'SELECT c.name, a.name, c.depth FROM "redditcomment" AS c'
+    ' LEFT JOIN "author" AS a ON a.id = c.author_id ORDER BY c.name'
+)
+
+
+def dump_line(
+    name: str, post: str | None, parent: str | None, author: str
+) -> dict[str, Any]:
+    line = {
+        "id": name,
+        "author": author,
+        "subreddit": "test",
+        "created_utc": START_UTC,
+    }
+    if post is None:
+        return {**line, "title": f"post {name}", "is_self": True}
+    return {**line, "link_id": post, "parent_id": parent, "body": f"comment {name}"}
+
+
+def write_dump(path: Path, lines: list[str]) -> Path:
+    path.write_bytes(zstandard.compress("\n".join(lines).encode()))
+    return path
+
+
+def import_options(db_path: Path, *files: Path) -> importer.ImportOptions:
+    return importer.ImportOptions(
+        loglevel=None,
+        files=list(files),
+        workers=0,
+        batch_size=10000,
+        db=db_path,
+        db_config=PROFILES["default"],
+    )
+
+
+def archive() -> list[list[tuple[Any, ...]]]:
+    return [
+        DB.execute_sql(f'SELECT * FROM "{table}" ORDER BY name').fetchall()
+        for table in ("redditpost", "redditcomment")
+    ]
+
+
+def test_import_twice(db_path: Path, tmp_path: Path) -> None:
+    # the second import has to leave the archive exactly as the first did
+    lines = [json.dumps(dump_line(*line)) for line in DUMP] + [TRUNCATED]
+    options = import_options(db_path, write_dump(tmp_path / "dump.zst", lines))
+    importer.run(options)
+    first = archive()
+    importer.run(options)
+
+    assert archive() == first
+    assert DB.execute_sql(POSTS_SQL).fetchall() == [("t3_p1", "bob"), ("t3_p2", None)]
+    assert DB.execute_sql(COMMENTS_SQL).fetchall() == [
+        ("t1_c1", "alice", 0),
+        ("t1_c2", None, 1),
+        ("t1_c3", None, 0),
+    ]
+    assert not DB.execute_sql("PRAGMA foreign_key_check").fetchall()
+
+
+def test_import_counts_every_line(
+    db_path: Path,
+    tmp_path: Path,
+    caplog: pytest.LogCaptureFixture,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    lines = [json.dumps(dump_line(*line)) for line in DUMP]
+    lines += [TRUNCATED, "[1, 2]", '"a string"']
+    caplog.set_level(logging.INFO, "reddit_scraper")
+    importer.run(import_options(db_path, write_dump(tmp_path / "dump.zst", lines)))
+    # 3 lines that aren't records, AutoModerator, and a comment on a missing post
+    assert "Skipped 3 lines" in caplog.text
+    assert "Skipped 1 comments by AutoModerator" in caplog.text
+    assert "Skipped 1 comments on posts" in caplog.text
+    assert f"from {len(lines)} records" in capsys.readouterr().out
+
+
+def test_import_reports_corrupt_dump(
+    db_path: Path, tmp_path: Path, caplog: pytest.LogCaptureFixture
+) -> None:
+    good = write_dump(tmp_path / "good.zst", [json.dumps(dump_line(*DUMP[2]))])
+    corrupt = tmp_path / "corrupt.zst"
+    corrupt.write_bytes(b"not zstd at all" * 100)
+    with pytest.raises(SystemExit):
+        importer.run(import_options(db_path, corrupt, good))
+    assert f"{corrupt} is corrupt" in caplog.text
+    # the files after it are still imported
+    assert DB.execute_sql(POSTS_SQL).fetchall() == [("t3_p1", "bob")]
@@ -0,0 +1,22 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+from conftest import Scrape
+
+from reddit_scraper.database import DB, Author, RedditComment
+from reddit_scraper.fake_reddit import FakeConfig, FakeReddit
+from reddit_scraper.migrations import SCHEMA_VERSION, setup_db
+
+
+def test_deleted_comment_authors_become_null(scrape: Scrape, db_path: Path) -> None:
+    # comments by deleted accounts were once stored with the author "None"
+    scrape(FakeReddit(FakeConfig(comments=3)))
+    deleted = Author.create(name="None")
+    RedditComment.update(author=deleted).where(RedditComment.depth == 0).execute()
+    DB.pragma("user_version", SCHEMA_VERSION - 1)
+    DB.close()
+    setup_db(db_path)
+    assert DB.pragma("user_version") == SCHEMA_VERSION
+    assert not RedditComment.select().where(RedditComment.author == deleted).count()
+    assert RedditComment.select().where(RedditComment.author.is_null()).count()
@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from dataclasses import replace
+from typing import Any
+
+from conftest import Scrape
+
+from reddit_scraper.database import (
+    Author,
+    RedditComment,
+    RedditPost,
+    ScoreHistory,
+)
+from reddit_scraper.dbconfig import PROFILES
+from reddit_scraper.fake_reddit import FakeConfig, FakeReddit
+
+
+class ChangingReddit(FakeReddit):
+    # once changed, every post has gained a comment and the first comment of
+    # each post has been voted up and edited
+    changed = False
+
+    def post(self, number: int) -> dict[str, Any]:
+        thing = super().post(number)
+        if self.changed:
+            thing["data"]["num_comments"] += 1
+        return thing
+
+    def comment(self, number: int, index: int, *args: Any) -> dict[str, Any]:
+        thing = super().comment(number, index, *args)
+        if self.changed and index == 0:
+            thing["data"]["score"] += 1000
+            thing["data"]["body"] = "edited"
+            thing["data"]["edited"] = True
+        return thing
+
+
+class DeletedReddit(FakeReddit):
+    # every post and the first comment of each were written by since deleted
+    # accounts, which reddit shows as "[deleted]"
+    def post(self, number: int) -> dict[str, Any]:
+        thing = super().post(number)
+        thing["data"]["author"] = "[deleted]"
+        return thing
+
+    def comment(self, number: int, index: int, *args: Any) -> dict[str, Any]:
+        thing = super().comment(number, index, *args)
+        if index == 0:
+            thing["data"]["author"] = "[deleted]"
+        return thing
+
+
+def test_scrape_writes_every_post_and_comment(scrape: Scrape) -> None:
+    scrape(FakeReddit(FakeConfig(comments=12, inline=5)), subreddits=2, posts=10)
+    assert RedditPost.select().count() == 20
+    assert RedditComment.select().count() == 20 * 12
+
+
+def test_scrape_again_goes_past_stored_posts(scrape: Scrape) -> None:
+    fake = FakeReddit(FakeConfig(comments=3))
+    scrape(fake)
+    first = {post.name for post in RedditPost.select()}
+    scrape(fake)
+    second = {post.name for post in RedditPost.select()} - first
+    assert len(first) == len(second) == 10
+    assert RedditComment.select().count() == 20 * 3
+
+
+def test_refresh_updates_changed_comments(scrape: Scrape) -> None:
+    fake = ChangingReddit(FakeConfig(posts=10, comments=3))
+    db_config = replace(PROFILES["default"], score_history=True)
+    scrape(fake, db_config=db_config)
+    first = RedditComment.select().order_by(RedditComment.name).first()
+    # a minute later, the scores seen in the same second would replace these
+    ScoreHistory.update(seen_at=ScoreHistory.seen_at - 60).execute()
+    fake.changed = True
+    scrape(fake, db_config=db_config, refresh=True)
+
+    assert RedditComment.select().count() == 10 * 3
+    refreshed = RedditComment.get_by_id(first.name)
+    assert refreshed.score == first.score + 1000
+    assert refreshed.body == "edited"
+    assert refreshed.edited
+    history = ScoreHistory.select().where(ScoreHistory.name == first.name)
+    assert [row.score for row in history.order_by(ScoreHistory.seen_at)] == [
+        first.score,
+        first.score + 1000,
+    ]
+
+
+def test_deleted_authors_are_null(scrape: Scrape) -> None:
+    scrape(DeletedReddit(FakeConfig(comments=3)))
+    assert not RedditPost.select().where(RedditPost.author.is_null(False)).count()
+    assert RedditComment.select().where(RedditComment.author.is_null()).count() == 10
+    assert not Author.select().where(Author.name == "None").count()